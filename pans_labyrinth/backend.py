@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+
+"""
+Graph backends that can stand in for a dgraph client.
+The dgraph module hands the operations it needs to a Backend when one is passed
+in place of a client: schema add, kmer lookup, node and edge insert, genome path
+retrieval, metadata and drop. MemoryBackend keeps the graph in the process, so a
+pangenome can be built and queried without a running dgraph.
+"""
+
+import json
+import logging
+import os
+import threading
+import numpy as np
+from pans_labyrinth import kmers
+
+LOG = logging.getLogger('pans_labyrinth')
+
+# Metadata nodes are numbered from here, apart from the kmer nodes
+METADATA_UID_BASE = 1 << 48
+
+# Orientation facets of canonical edges, stored as their index here
+ORIENTATIONS = ["++", "+-", "-+", "--"]
+
+# Values of KmerIndex slots holding no kmer
+EMPTY = -1
+DELETED = -2
+
+# Knuth's multiplicative hash constant, 2^64 / golden ratio
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def get_uid(index):
+	"""
+	:param index: Index of a kmer node
+	:return: uid of the node, in the form dgraph gives them
+	"""
+	return hex(index + 1)
+
+
+def get_index(uid):
+	"""
+	:param uid: uid of a kmer node
+	:return: Index of the node
+	"""
+	return int(uid, 16) - 1
+
+
+def save_array(path, name, array):
+	"""
+	Write an array to <path>/<name>.npy through a temporary file, so an array memory
+	mapped from the file it replaces stays readable
+	:param path: Directory to write to
+	:param name: Name of the array
+	:param array: numpy array
+	"""
+	filename = os.path.join(path, name + ".npy")
+	with open(filename + ".tmp", "wb") as f:
+		np.save(f, array)
+	os.replace(filename + ".tmp", filename)
+
+
+class Backend(object):
+	"""
+	The graph operations used by the dgraph module. A Backend passed in place of a
+	dgraph client has each of these called instead of sending DQL.
+	"""
+
+	def drop_all(self):
+		raise NotImplementedError
+
+	def add_schema(self):
+		raise NotImplementedError
+
+	def query_kmers(self, kmer_array, kmer_size):
+		"""
+		:param kmer_array: numpy array of packed kmers
+		:param kmer_size: Size of kmer
+		:return: [{'kmer':kmer, 'uid':uid}] of the kmers in the graph, or None
+		"""
+		raise NotImplementedError
+
+	def add_kmers(self, kmer_array, kmer_size):
+		"""
+		:param kmer_array: numpy array of distinct packed kmers
+		:param kmer_size: Size of kmer
+		:return: [{'kmer':kmer, 'uid':uid}] for every kmer
+		"""
+		raise NotImplementedError
+
+	def add_genome(self, genome):
+		raise NotImplementedError
+
+	def add_edges(self, genome, uids, orientations=None):
+		"""
+		:param genome: The genome name in the form genome_hash
+		:param uids: uids of a run of kmers, each linked to the one after it
+		:param orientations: orientation facet of each edge, if canonical
+		"""
+		raise NotImplementedError
+
+	def query_genomes(self):
+		"""
+		:return: set of genome names in the form genome_hash
+		"""
+		raise NotImplementedError
+
+	def query_genome_edges(self, genome, page_size):
+		"""
+		:param genome: The genome name in the form genome_hash
+		:param page_size: Number of source kmers per page
+		:return: Generator of pages as from dgraph.query_genome_predicate_edges()
+		"""
+		raise NotImplementedError
+
+	def query_kmer_genomes(self, uids, genomes):
+		"""
+		:param uids: list of kmer node uids
+		:param genomes: list of genome names in the form genome_hash
+		:return: numpy bool array with a row for each uid and a column for each genome,
+		True where the genome has an edge into or out of the kmer
+		"""
+		raise NotImplementedError
+
+	def add_metadata(self, genome, filename, kmer_size, canonical, contigs, end_uids):
+		"""
+		:return: uid of the metadata node
+		"""
+		raise NotImplementedError
+
+	def query_metadata(self, genome):
+		"""
+		:return: metadata as from dgraph.query_metadata_dgraph(), or None
+		"""
+		raise NotImplementedError
+
+	def query_metadata_genomes(self):
+		"""
+		:return: set of the genome names with metadata, in the form genome_hash
+		"""
+		raise NotImplementedError
+
+	def query_kmer_size(self):
+		"""
+		:return: kmer size of the graph, or None for an empty graph
+		"""
+		raise NotImplementedError
+
+	def query_canonical(self):
+		"""
+		:return: True if the graph holds canonical kmers, or None for a graph without metadata
+		"""
+		raise NotImplementedError
+
+	def query_kmer_filter_stamp(self):
+		"""
+		:return: stamp of the kmer filter saved with the graph, or None
+		"""
+		raise NotImplementedError
+
+	def set_kmer_filter_stamp(self, stamp):
+		"""
+		:param stamp: stamp of the kmer filter saved with the graph, or None
+		"""
+		raise NotImplementedError
+
+	def delete_genome(self, genome):
+		"""
+		Remove a genome's edges and metadata, and the kmers no other genome holds
+		:param genome: The genome name in the form genome_hash
+		:return: numpy uint64 array of the packed kmers deleted
+		"""
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+
+class KmerIndex(object):
+	"""
+	Open addressing hash table from packed kmer to node index, held in two numpy
+	arrays. Lookups and inserts probe a whole batch of kmers at a time.
+	"""
+
+	def __init__(self, capacity=1024):
+		"""
+		:param capacity: Initial number of slots, a power of two
+		"""
+		self._keys = np.zeros(capacity, dtype=np.uint64)
+		self._values = np.full(capacity, EMPTY, dtype=np.int64)
+		self._size = 0
+		self._deleted = 0
+
+	def __len__(self):
+		return self._size
+
+	def _slots(self, keys):
+		bits = np.uint64(64 - (len(self._keys).bit_length() - 1))
+		return ((keys * HASH_MULTIPLIER) >> bits).astype(np.int64)
+
+	def get(self, keys):
+		"""
+		:param keys: numpy uint64 array of packed kmers
+		:return: numpy int64 array of node indexes, -1 where the kmer is absent
+		"""
+		keys = np.asarray(keys, dtype=np.uint64)
+		result = np.full(len(keys), -1, dtype=np.int64)
+		mask = len(self._keys) - 1
+		pending = np.arange(len(keys))
+		slots = self._slots(keys)
+		while len(pending):
+			values = self._values[slots]
+			found = (values >= 0) & (self._keys[slots] == keys[pending])
+			result[pending[found]] = values[found]
+			# A slot holding another kmer, or one deleted, means probing on to the next
+			probing = (values != EMPTY) & ~found
+			pending = pending[probing]
+			slots = (slots[probing] + 1) & mask
+		return result
+
+	def add(self, keys, values):
+		"""
+		:param keys: numpy uint64 array of distinct packed kmers, none already present
+		:param values: numpy int64 array of their node indexes
+		"""
+		keys = np.asarray(keys, dtype=np.uint64)
+		values = np.asarray(values, dtype=np.int64)
+		if 2 * (self._size + self._deleted + len(keys)) > len(self._keys):
+			self._grow(self._size + len(keys))
+
+		mask = len(self._keys) - 1
+		pending = np.arange(len(keys))
+		slots = self._slots(keys)
+		while len(pending):
+			empty = np.flatnonzero(self._values[slots] < 0)
+			# Of the kmers reaching the same empty slot, the first takes it
+			taken, first = np.unique(slots[empty], return_index=True)
+			placed = empty[first]
+			self._keys[taken] = keys[pending[placed]]
+			self._values[taken] = values[pending[placed]]
+			left = np.ones(len(pending), dtype=bool)
+			left[placed] = False
+			pending = pending[left]
+			slots = (slots[left] + 1) & mask
+		self._size += len(keys)
+
+	def discard(self, keys):
+		"""
+		:param keys: numpy uint64 array of distinct packed kmers to remove
+		"""
+		keys = np.asarray(keys, dtype=np.uint64)
+		mask = len(self._keys) - 1
+		pending = np.arange(len(keys))
+		slots = self._slots(keys)
+		while len(pending):
+			values = self._values[slots]
+			found = (values >= 0) & (self._keys[slots] == keys[pending])
+			# The slot is marked deleted rather than emptied, so probing carries on past it
+			self._values[slots[found]] = DELETED
+			self._size -= int(found.sum())
+			self._deleted += int(found.sum())
+			probing = (values != EMPTY) & ~found
+			pending = pending[probing]
+			slots = (slots[probing] + 1) & mask
+
+	def _grow(self, size):
+		used = self._values >= 0
+		keys = self._keys[used]
+		values = self._values[used]
+		capacity = len(self._keys)
+		while 2 * size > capacity:
+			capacity *= 2
+		self._keys = np.zeros(capacity, dtype=np.uint64)
+		self._values = np.full(capacity, EMPTY, dtype=np.int64)
+		self._size = 0
+		self._deleted = 0
+		self.add(keys, values)
+
+
+class MemoryBackend(Backend):
+	"""
+	A graph held in numpy arrays: one array of packed kmers, indexed by node, with a
+	KmerIndex over it, and for each genome arrays of the source and target node of
+	its edges. Edges are kept as added, and repeats are removed when read, as dgraph
+	stores an edge once. The graph can be saved to a directory, and loaded back with
+	its arrays memory mapped.
+	"""
+
+	def __init__(self, path=None):
+		"""
+		:param path: Directory the graph is saved to on close(), or None
+		"""
+		self.path = path
+		self._lock = threading.RLock()
+		self.drop_all()
+
+	def drop_all(self):
+		with self._lock:
+			self.kmer_size = None
+			self._kmers = np.zeros(1024, dtype=np.uint64)
+			self._count = 0
+			self._index = KmerIndex()
+			self._edges = {}
+			self._metadata = {}
+			self._deleted = np.zeros(0, dtype=np.int64)
+			self.kmer_filter_stamp = None
+
+	def add_schema(self):
+		pass
+
+	def query_kmers(self, kmer_array, kmer_size):
+		with self._lock:
+			indexes = self._index.get(kmer_array)
+		found = indexes >= 0
+		if not found.any():
+			return None
+		return [{'kmer': kmer, 'uid': get_uid(index)}
+				for kmer, index in zip(np.asarray(kmer_array)[found].tolist(), indexes[found].tolist())]
+
+	def add_kmers(self, kmer_array, kmer_size):
+		kmer_array = np.asarray(kmer_array, dtype=np.uint64)
+		with self._lock:
+			self.kmer_size = kmer_size
+			# Another thread may have added some of these since they were looked up
+			indexes = self._index.get(kmer_array)
+			missing = np.flatnonzero(indexes < 0)
+			new = np.arange(self._count, self._count + len(missing), dtype=np.int64)
+			if self._count + len(missing) > len(self._kmers):
+				grown = np.zeros(max(2 * len(self._kmers), self._count + len(missing)), dtype=np.uint64)
+				grown[:self._count] = self._kmers[:self._count]
+				self._kmers = grown
+			self._kmers[new] = kmer_array[missing]
+			self._count += len(missing)
+			self._index.add(kmer_array[missing], new)
+			indexes[missing] = new
+		return [{'kmer': kmer, 'uid': get_uid(index)} for kmer, index in zip(kmer_array.tolist(), indexes.tolist())]
+
+	def add_genome(self, genome):
+		with self._lock:
+			self._edges.setdefault(genome, [])
+
+	def add_edges(self, genome, uids, orientations=None):
+		indexes = np.array([get_index(uid) for uid in uids], dtype=np.int64)
+		if orientations is None:
+			codes = np.full(len(indexes) - 1, -1, dtype=np.int8)
+		else:
+			codes = np.array([ORIENTATIONS.index(o) for o in orientations], dtype=np.int8)
+		with self._lock:
+			self._edges.setdefault(genome, []).append((indexes[:-1], indexes[1:], codes))
+
+	def get_edges(self, genome):
+		"""
+		:param genome: The genome name in the form genome_hash
+		:return: numpy arrays of the source, target and orientation code of each
+		distinct edge, ordered by source
+		"""
+		with self._lock:
+			parts = self._edges.get(genome, [])
+			if len(parts) > 1:
+				# Keep the edges merged, so they are only concatenated once
+				parts[:] = [tuple(np.concatenate(column) for column in zip(*parts))]
+		if not parts:
+			empty = np.zeros(0, dtype=np.int64)
+			return empty, empty, np.zeros(0, dtype=np.int8)
+
+		sources, targets, codes = parts[0]
+		order = np.lexsort((targets, sources))
+		sources, targets, codes = sources[order], targets[order], codes[order]
+		distinct = np.ones(len(sources), dtype=bool)
+		distinct[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+		return sources[distinct], targets[distinct], codes[distinct]
+
+	def query_genomes(self):
+		with self._lock:
+			return set(self._edges)
+
+	def query_genome_edges(self, genome, page_size):
+		sources, targets, codes = self.get_edges(genome)
+		if not len(sources):
+			return
+		kmer_strings = self.get_kmer_strings
+		starts = np.flatnonzero(np.concatenate(([True], sources[1:] != sources[:-1])))
+		stops = np.append(starts[1:], len(sources))
+		for page in range(0, len(starts), page_size):
+			first, last = starts[page], stops[min(page + page_size, len(starts)) - 1]
+			source_kmers = kmer_strings(sources[first:last])
+			target_kmers = kmer_strings(targets[first:last])
+			nodes = []
+			for i in range(first, last):
+				if i == first or sources[i] != sources[i - 1]:
+					node = {"uid": get_uid(int(sources[i])), "kmer": source_kmers[i - first], genome: []}
+					nodes.append(node)
+				target = {"uid": get_uid(int(targets[i])), "kmer": target_kmers[i - first]}
+				if codes[i] >= 0:
+					target[genome + "|orientation"] = ORIENTATIONS[codes[i]]
+				node[genome].append(target)
+			yield nodes
+
+	def query_kmer_genomes(self, uids, genomes):
+		indexes = np.array([get_index(uid) for uid in uids], dtype=np.int64)
+		present = np.zeros((len(uids), len(genomes)), dtype=bool)
+		for j, genome in enumerate(genomes):
+			sources, targets, codes = self.get_edges(genome)
+			present[:, j] = np.isin(indexes, sources) | np.isin(indexes, targets)
+		return present
+
+	def get_kmer_strings(self, indexes):
+		"""
+		:param indexes: numpy array of node indexes
+		:return: [kmers] of the nodes
+		"""
+		return kmers.decode_kmers(self._kmers[indexes], self.kmer_size)
+
+	def add_metadata(self, genome, filename, kmer_size, canonical, contigs, end_uids):
+		with self._lock:
+			self.kmer_size = kmer_size
+			metadata = self._metadata.get(genome)
+			if metadata is None:
+				number = max([int(m['uid'], 16) - METADATA_UID_BASE for m in self._metadata.values()] + [-1]) + 1
+				metadata = {'uid': hex(METADATA_UID_BASE + number)}
+				self._metadata[genome] = metadata
+			# A genome loaded again replaces its contigs
+			metadata.update({'genome_hash': genome[len("genome_"):], 'filename': filename,
+							 'kmer_size': kmer_size, 'canonical': canonical, 'contigs': []})
+			for i, contig in enumerate(contigs):
+				metadata['contigs'].append({
+					'contig_id': contig['contig_id'],
+					'contig_length': contig['contig_length'],
+					'first_kmer': {'uid': end_uids[2 * i]},
+					'last_kmer': {'uid': end_uids[2 * i + 1]},
+				})
+			return metadata['uid']
+
+	def query_metadata(self, genome):
+		with self._lock:
+			metadata = self._metadata.get(genome)
+			if metadata is None:
+				return None
+			metadata = json.loads(json.dumps(metadata))
+		for contig in metadata['contigs']:
+			for end in ('first_kmer', 'last_kmer'):
+				contig[end]['kmer'] = self.get_kmer_strings(np.array([get_index(contig[end]['uid'])]))[0]
+		return metadata
+
+	def query_metadata_genomes(self):
+		with self._lock:
+			return set(self._metadata)
+
+	def query_kmer_size(self):
+		return self.kmer_size
+
+	def query_canonical(self):
+		with self._lock:
+			for metadata in self._metadata.values():
+				if 'canonical' in metadata:
+					return metadata['canonical']
+		return None
+
+	def query_kmer_filter_stamp(self):
+		return self.kmer_filter_stamp
+
+	def set_kmer_filter_stamp(self, stamp):
+		self.kmer_filter_stamp = stamp
+
+	def get_end_indexes(self, metadata):
+		"""
+		:param metadata: metadata of a genome
+		:return: numpy int64 array of the first and last node of each of its contigs
+		"""
+		return np.array([get_index(contig[end]['uid']) for contig in metadata['contigs']
+						 for end in ('first_kmer', 'last_kmer')], dtype=np.int64)
+
+	def delete_genome(self, genome):
+		with self._lock:
+			sources, targets, codes = self.get_edges(genome)
+			self._edges.pop(genome, None)
+			metadata = self._metadata.pop(genome, None)
+			nodes = np.concatenate((sources, targets, self.get_end_indexes(metadata) if metadata else sources[:0]))
+			nodes = np.unique(nodes)
+			for other in self._edges:
+				other_sources, other_targets, other_codes = self.get_edges(other)
+				nodes = nodes[~np.isin(nodes, other_sources) & ~np.isin(nodes, other_targets)]
+			for other in self._metadata.values():
+				nodes = nodes[~np.isin(nodes, self.get_end_indexes(other))]
+
+			orphans = np.array(self._kmers[nodes])
+			self._index.discard(orphans)
+			self._deleted = np.union1d(self._deleted, nodes)
+		return orphans
+
+	def save(self, path):
+		"""
+		Write the graph to a directory, as a .npy file for each array and a JSON
+		file of the genomes and metadata
+		:param path: Directory to write to
+		"""
+		os.makedirs(path, exist_ok=True)
+		with self._lock:
+			save_array(path, "kmers", self._kmers[:self._count])
+			save_array(path, "deleted", self._deleted)
+			genomes = sorted(self._edges)
+			for i, genome in enumerate(genomes):
+				for name, column in zip(("sources", "targets", "orientations"), self.get_edges(genome)):
+					save_array(path, "{0}_{1}".format(name, i), column)
+			with open(os.path.join(path, "graph.json"), "w") as f:
+				json.dump({'kmer_size': self.kmer_size, 'genomes': genomes, 'metadata': self._metadata,
+						   'kmer_filter_stamp': self.kmer_filter_stamp}, f)
+		LOG.info("Saved {0} kmers and {1} genomes to {2}".format(self._count, len(genomes), path))
+
+	@classmethod
+	def load(cls, path, mmap=False):
+		"""
+		Read a graph written by save()
+		:param path: Directory to read from
+		:param mmap: Memory map the arrays rather than reading them in; the kmers are
+		copied on the first insert
+		:return: MemoryBackend saving back to path on close()
+		"""
+		mmap_mode = "r" if mmap else None
+		backend = cls(path)
+		with open(os.path.join(path, "graph.json")) as f:
+			graph = json.load(f)
+		backend.kmer_size = graph['kmer_size']
+		backend._metadata = graph['metadata']
+		backend.kmer_filter_stamp = graph.get('kmer_filter_stamp')
+		backend._kmers = np.load(os.path.join(path, "kmers.npy"), mmap_mode=mmap_mode)
+		backend._count = len(backend._kmers)
+		deleted_filename = os.path.join(path, "deleted.npy")
+		if os.path.exists(deleted_filename):
+			backend._deleted = np.load(deleted_filename)
+		live = np.setdiff1d(np.arange(backend._count, dtype=np.int64), backend._deleted)
+		backend._index.add(backend._kmers[live], live)
+		for i, genome in enumerate(graph['genomes']):
+			backend._edges[genome] = [tuple(np.load(os.path.join(path, "{0}_{1}.npy".format(name, i)), mmap_mode=mmap_mode)
+											for name in ("sources", "targets", "orientations"))]
+		return backend
+
+	def close(self):
+		if self.path:
+			self.save(self.path)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the graph against a running dgraph, or the memory backend, using
+synthetic genomes. Results are printed as JSON, one object per measurement.
+
+	python -m pans_labyrinth.benchmark --edge-models
+	python -m pans_labyrinth.benchmark --hot-paths --backend memory
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+import numpy as np
+from pans_labyrinth import dgraph, kmers, backend
+
+# Genome counts the edge models are compared at
+EDGE_MODEL_GENOME_COUNTS = (100, 1000, 10000)
+
+
+def get_synthetic_genomes(count, length, similarity=0.99, contigs=1, seed=0):
+	"""
+	Generate genomes that share a random ancestor, each differing from it by point
+	mutations at a rate of 1 - similarity.
+	:param count: Number of genomes
+	:param length: Length in bases of each genome
+	:param similarity: Fraction of bases kept from the ancestor
+	:param contigs: Number of equal contigs each genome is split into
+	:param seed: Random seed, so runs are repeatable
+	:return: Generator of (genome name, [(contig id, sequence)])
+	"""
+	rng = np.random.default_rng(seed)
+	bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+	ancestor = rng.integers(0, 4, length)
+	bounds = np.linspace(0, length, contigs + 1).astype(int)
+
+	for i in range(count):
+		genome = ancestor.copy()
+		mutated = rng.random(length) > similarity
+		genome[mutated] = rng.integers(0, 4, int(mutated.sum()))
+		sequence = bases[genome].tobytes().decode("ascii")
+		name = "genome_synthetic{0:06d}".format(i)
+		yield name, [("contig_{0}".format(c), sequence[bounds[c]:bounds[c + 1]]) for c in range(contigs)]
+
+
+def get_kmers_synthetic(contigs, kmer_size):
+	"""
+	:param contigs: [(contig id, sequence)] of a synthetic genome
+	:param kmer_size: Size of kmer
+	:return: Generator of (contig, packed kmers) as from dgraph.get_kmers_chunks()
+	"""
+	for contig, sequence in contigs:
+		for chunk in kmers.get_kmers_sequence(sequence, kmer_size, dgraph.KMER_CHUNK_SIZE):
+			yield contig, chunk
+
+
+def add_genome_synthetic(client, genome, contigs, kmer_size):
+	"""
+	Insert a synthetic genome the way create_graph() inserts a fasta file
+	:param client: dgraph client
+	:param genome: genome name
+	:param contigs: [(contig id, sequence)]
+	:param kmer_size: Size of kmer
+	:return: None
+	"""
+	dgraph.add_genome_to_schema(client, genome)
+	segments = dgraph.add_kmers_dgraph(client, get_kmers_synthetic(contigs, kmer_size), genome, kmer_size)
+	dgraph.add_metadata_dgraph(client, genome, genome, kmer_size, segments)
+
+
+class CountingTxn(object):
+	"""
+	A transaction counting each request it sends through its CountingClient
+	"""
+
+	def __init__(self, counter, txn):
+		self._counter = counter
+		self._txn = txn
+
+	def __getattr__(self, name):
+		return getattr(self._txn, name)
+
+	def query(self, query, variables=None, *args, **kwargs):
+		self._counter.count(query, variables)
+		return self._txn.query(query, variables, *args, **kwargs)
+
+	def mutate(self, *args, **kwargs):
+		self._counter.count(kwargs.get('set_nquads'), kwargs.get('del_nquads'), kwargs.get('set_obj'))
+		return self._txn.mutate(*args, **kwargs)
+
+	def do_request(self, request, *args, **kwargs):
+		self._counter.count(request.query, [m.set_nquads for m in request.mutations])
+		return self._txn.do_request(request, *args, **kwargs)
+
+	def commit(self, *args, **kwargs):
+		self._counter.count()
+		return self._txn.commit(*args, **kwargs)
+
+
+class CountingClient(object):
+	"""
+	Wraps a dgraph client, counting the requests sent and the bytes of query,
+	variable and N-Quad text in them. Commits are counted as requests; a discard
+	after a commit sends nothing, so is not.
+	"""
+
+	def __init__(self, client):
+		self._client = client
+		self._lock = threading.Lock()
+		self.round_trips = 0
+		self.bytes_sent = 0
+
+	def count(self, *parts):
+		"""
+		Count one request
+		:param parts: The text sent, as strings, bytes, lists or dicts
+		"""
+		size = sum(len(json.dumps(part) if isinstance(part, (dict, list)) else part) for part in parts if part)
+		with self._lock:
+			self.round_trips += 1
+			self.bytes_sent += size
+
+	def get_counts(self):
+		"""
+		:return: dict of the requests and bytes counted so far
+		"""
+		with self._lock:
+			return {'round_trips': self.round_trips, 'bytes_sent': self.bytes_sent}
+
+	def query(self, query, variables=None, *args, **kwargs):
+		self.count(query, variables)
+		return self._client.query(query, variables, *args, **kwargs)
+
+	def alter(self, operation, *args, **kwargs):
+		self.count(operation.schema)
+		return self._client.alter(operation, *args, **kwargs)
+
+	def txn(self, *args, **kwargs):
+		return CountingTxn(self, self._client.txn(*args, **kwargs))
+
+	def close(self):
+		self._client.close()
+
+
+def get_peak_rss():
+	"""
+	:return: Peak resident set size of this process in kilobytes
+	"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_synthetic_fasta(directory, genomes):
+	"""
+	Write synthetic genomes to fasta files, one per genome
+	:param directory: Directory to write to
+	:param genomes: iterable of (genome name, [(contig id, sequence)]) as from get_synthetic_genomes()
+	:return: list of the file paths
+	"""
+	filepaths = []
+	for name, contigs in genomes:
+		filepath = os.path.join(directory, name + ".fasta")
+		with open(filepath, "w") as f:
+			for contig, sequence in contigs:
+				f.write(">{0}\n".format(contig))
+				for i in range(0, len(sequence), 80):
+					f.write(sequence[i:i + 80] + "\n")
+		filepaths.append(filepath)
+	return filepaths
+
+
+def benchmark_hot_paths(client, genome_count=10, length=100000, contigs=1, similarity=0.99, kmer_size=11):
+	"""
+	Time each stage of ingestion and querying on its own, then create_graph() end to end.
+	The stages are run the way get_kmers_contig() runs them, on the chunks of every genome:
+	kmer extraction, the lookup of the chunk's kmers, the insert of those not found,
+	and the edges. Round trips and bytes are counted when client is a dgraph client.
+	:param client: dgraph client, or a backend.Backend
+	:param genome_count: Number of synthetic genomes
+	:param length: Length in bases of each genome
+	:param contigs: Number of contigs in each genome
+	:param similarity: Fraction of bases each genome keeps from their common ancestor
+	:param kmer_size: Size of kmer
+	:return: list of result dicts
+	"""
+	if not isinstance(client, backend.Backend):
+		client = CountingClient(client)
+	config = {'benchmark': 'hot_path', 'genomes': genome_count, 'genome_length': length,
+			  'contigs': contigs, 'similarity': similarity, 'kmer_size': kmer_size}
+	results = []
+	totals = {}
+
+	@contextlib.contextmanager
+	def measure(stage, get_kmers):
+		counts = client.get_counts() if isinstance(client, CountingClient) else None
+		start = time.perf_counter()
+		yield
+		seconds = time.perf_counter() - start
+		total = totals.setdefault(stage, {'seconds': 0.0, 'kmers': 0, 'round_trips': 0, 'bytes_sent': 0})
+		total['seconds'] += seconds
+		total['kmers'] += get_kmers()
+		if counts:
+			for key, value in client.get_counts().items():
+				total[key] += value - counts[key]
+
+	with tempfile.TemporaryDirectory() as directory:
+		genomes = list(get_synthetic_genomes(genome_count, length, similarity, contigs))
+		filepaths = write_synthetic_fasta(directory, genomes)
+
+		dgraph.drop_all(client)
+		dgraph.add_schema(client)
+		for (genome, genome_contigs), filepath in zip(genomes, filepaths):
+			kmer_lists = None
+			with measure('get_kmers_files', lambda: sum(len(k) for k in kmer_lists.values())):
+				kmer_lists = dgraph.get_kmers_files(filepath, kmer_size)
+			chunks = None
+			with measure('get_kmers_chunks', lambda: sum(len(chunk) for contig, chunk in chunks)):
+				chunks = list(dgraph.get_kmers_chunks(filepath, kmer_size))
+
+			dgraph.add_genome_to_schema(client, genome)
+			for contig, chunk in chunks:
+				unique_kmers = np.unique(chunk)
+				found = None
+				with measure('query_kmers_dgraph', lambda: len(unique_kmers)):
+					found = dgraph.query_kmers_dgraph(client, unique_kmers, kmer_size)
+				kmer_uid_dict = dgraph.add_kmers_dict({}, found)
+				missing = dgraph.get_kmers_missing(unique_kmers, kmer_uid_dict)
+				if len(missing):
+					with measure('add_kmers_batch_dgraph', lambda: len(missing)):
+						added = dgraph.add_kmers_batch_dgraph(client, missing, kmer_size)
+					kmer_uid_dict = dgraph.add_kmers_dict(kmer_uid_dict, added)
+				with measure('add_edges_kmers', lambda: len(chunk)):
+					dgraph.add_edges_kmers(client, chunk, kmer_uid_dict, genome, kmer_size)
+
+		for genome, genome_contigs in genomes:
+			with measure('path_query', lambda: sum(len(s) - kmer_size + 1 for c, s in genome_contigs)):
+				dgraph.path_query(client, genome)
+
+		dgraph.drop_all(client)
+		dgraph.add_schema(client)
+		for (genome, genome_contigs), filepath in zip(genomes, filepaths):
+			with measure('create_graph', lambda: sum(len(s) - kmer_size + 1 for c, s in genome_contigs)):
+				with open(filepath, 'rb') as file:
+					dgraph.create_graph(client, file, filepath, kmer_size=kmer_size)
+
+	for stage, total in totals.items():
+		result = dict(config, stage=stage, seconds=total['seconds'], kmers=total['kmers'],
+					  kmers_per_sec=total['kmers'] / total['seconds'] if total['seconds'] else None,
+					  round_trips=total['round_trips'] if isinstance(client, CountingClient) else None,
+					  bytes_sent=total['bytes_sent'] if isinstance(client, CountingClient) else None,
+					  peak_rss_kb=get_peak_rss())
+		results.append(result)
+		print(json.dumps(result), flush=True)
+	return results
+
+
+def benchmark_edge_models(client, genome_counts=EDGE_MODEL_GENOME_COUNTS, length=5000, kmer_size=11,
+						  queries=10):
+	"""
+	Compare insert and path query throughput of the EDGE_GENOME and EDGE_NEXT models.
+	Each model starts from an empty graph, and is measured as it grows through each
+	of genome_counts.
+	:param client: dgraph client
+	:param genome_counts: Increasing numbers of genomes to measure at
+	:param length: Length in bases of each genome
+	:param kmer_size: Size of kmer
+	:param queries: Number of genome paths retrieved at each count
+	:return: list of result dicts
+	"""
+	results = []
+	edge_model = dgraph.EDGE_MODEL
+	try:
+		for model in (dgraph.EDGE_GENOME, dgraph.EDGE_NEXT):
+			dgraph.EDGE_MODEL = model
+			dgraph.GENOME_INDEXES.clear()
+			dgraph.drop_all(client)
+			dgraph.add_schema(client)
+
+			genomes = get_synthetic_genomes(max(genome_counts), length)
+			inserted = []
+			for count in genome_counts:
+				added = count - len(inserted)
+				start = time.perf_counter()
+				while len(inserted) < count:
+					genome, contigs = next(genomes)
+					add_genome_synthetic(client, genome, contigs, kmer_size)
+					inserted.append(genome)
+				insert_seconds = time.perf_counter() - start
+
+				start = time.perf_counter()
+				for genome in inserted[-queries:]:
+					for path in dgraph.get_genome_paths(client, genome):
+						pass
+				query_seconds = time.perf_counter() - start
+
+				result = {
+					'benchmark': 'edge_model',
+					'edge_model': model,
+					'genomes': count,
+					'genome_length': length,
+					'insert_genomes_per_sec': added / insert_seconds,
+					'query_genomes_per_sec': min(queries, count) / query_seconds,
+				}
+				results.append(result)
+				print(json.dumps(result), flush=True)
+	finally:
+		dgraph.EDGE_MODEL = edge_model
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark pans_labyrinth against a running dgraph")
+	parser.add_argument("-a", "--alpha", action = 'append', help = "Address of a dgraph Alpha in the form host:port")
+	parser.add_argument("--backend", choices = ["dgraph", "memory"], default = "dgraph", help = "Benchmark against dgraph, or the memory backend")
+	parser.add_argument("--edge-models", action = 'store_true', help = "Compare the genome predicate and next edge models")
+	parser.add_argument("--hot-paths", action = 'store_true', help = "Time each stage of ingestion and querying, and create_graph end to end")
+	parser.add_argument("--genome-counts", type = int, nargs = '+', default = list(EDGE_MODEL_GENOME_COUNTS), help = "Numbers of genomes to measure at")
+	parser.add_argument("--genomes", type = int, default = 10, help = "Number of synthetic genomes for --hot-paths")
+	parser.add_argument("--length", type = int, default = 5000, help = "Length in bases of each synthetic genome")
+	parser.add_argument("--contigs", type = int, default = 1, help = "Number of contigs in each synthetic genome")
+	parser.add_argument("--similarity", type = float, default = 0.99, help = "Fraction of bases each synthetic genome keeps from their common ancestor")
+	parser.add_argument("-k", "--kmer-size", type = int, default = 11, help = "Size of kmer")
+	opt = parser.parse_args()
+	if opt.edge_models and opt.backend == "memory":
+		# The next edge model writes through dgraph transactions, which the memory backend does not have
+		parser.error("--edge-models is only supported with the dgraph backend")
+
+	if opt.backend == "memory":
+		client = backend.MemoryBackend()
+	else:
+		client = dgraph.create_client_pool(opt.alpha)
+	try:
+		if opt.edge_models:
+			benchmark_edge_models(client, opt.genome_counts, opt.length, opt.kmer_size)
+		if opt.hot_paths:
+			benchmark_hot_paths(client, opt.genomes, opt.length, opt.contigs, opt.similarity, opt.kmer_size)
+	finally:
+		client.close()
+
+
+if __name__ == '__main__':
+	main()
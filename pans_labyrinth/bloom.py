@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+Bloom filter of the kmers in the graph, held in this process and saved to disk.
+A kmer the filter does not hold is certainly not in the graph, so it can be
+inserted without first asking dgraph whether it exists. A kmer the filter holds is
+only probably in the graph, and is looked up as usual.
+
+The filter is only sound while it holds every kmer of the graph: it is started
+empty with a fresh graph, every kmer is added to it before it is inserted, and it
+is saved along with the graph when the load is done. Kmers of deleted genomes stay
+in it, which only costs a lookup. The file holds a stamp that is also recorded in
+the graph, which every load clears when it starts, so a filter is only loaded
+back into the graph it was saved with, with no load since.
+"""
+
+import logging
+import math
+import os
+import threading
+import numpy as np
+
+LOG = logging.getLogger('pans_labyrinth')
+
+# Default number of kmers the filter is sized for
+KMER_FILTER_CAPACITY = 100000000
+
+# Default share of absent kmers reported as present once the filter holds its capacity
+FALSE_POSITIVE_RATE = 0.01
+
+# Odd multipliers of the two hashes combined into the probe positions of each kmer
+HASH_MULTIPLIERS = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F))
+
+# Number of bits set in each byte value
+BYTE_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Number of words counted at a time by get_fill()
+FILL_WORDS = 1 << 20
+
+
+class BloomFilter(object):
+	"""
+	A bit array of a power of two size, with each packed kmer setting hashes bits
+	picked by double hashing.
+	"""
+
+	def __init__(self, capacity=KMER_FILTER_CAPACITY, false_positive_rate=FALSE_POSITIVE_RATE, bits=None,
+				 hashes=None):
+		"""
+		:param capacity: Number of kmers the filter is sized for
+		:param false_positive_rate: False positive rate wanted at capacity
+		:param bits: log2 of the number of bits, overriding the size worked out from the capacity
+		:param hashes: Number of bits set per kmer, overriding the number worked out from the capacity
+		"""
+		wanted = -max(capacity, 1) * math.log(false_positive_rate) / math.log(2) ** 2
+		self.bits = bits or max(6, int(math.ceil(math.log2(wanted))))
+		self.hashes = hashes or max(1, int(round(wanted / max(capacity, 1) * math.log(2))))
+		self.count = 0
+		self.stamp = None
+		self._words = np.zeros(1 << (self.bits - 6), dtype=np.uint64)
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		"""
+		:return: Number of kmers added, counting repeats
+		"""
+		return self.count
+
+	def get_positions(self, kmer_array):
+		"""
+		:param kmer_array: numpy array of packed kmers
+		:return: numpy uint64 array of shape (hashes, kmers) of the bit of each probe
+		"""
+		kmer_array = np.asarray(kmer_array, dtype=np.uint64)
+		first = kmer_array * HASH_MULTIPLIERS[0]
+		second = ((kmer_array ^ (kmer_array >> np.uint64(29))) * HASH_MULTIPLIERS[1]) | np.uint64(1)
+		probes = np.arange(self.hashes, dtype=np.uint64)[:, None]
+		return (first + probes * second) >> np.uint64(64 - self.bits)
+
+	def add(self, kmer_array):
+		"""
+		:param kmer_array: numpy array of packed kmers
+		:return: None
+		"""
+		positions = self.get_positions(kmer_array).ravel()
+		masks = np.left_shift(np.uint64(1), positions & np.uint64(63))
+		with self._lock:
+			np.bitwise_or.at(self._words, (positions >> np.uint64(6)).astype(np.int64), masks)
+			self.count += len(kmer_array)
+
+	def contains(self, kmer_array):
+		"""
+		:param kmer_array: numpy array of packed kmers
+		:return: numpy bool array, False for the kmers certainly never added
+		"""
+		positions = self.get_positions(kmer_array)
+		words = self._words[(positions >> np.uint64(6)).astype(np.int64)]
+		return ((words >> (positions & np.uint64(63))) & np.uint64(1)).astype(bool).all(axis=0)
+
+	def get_fill(self):
+		"""
+		:return: Share of the bits set
+		"""
+		set_bits = 0
+		for start in range(0, len(self._words), FILL_WORDS):
+			set_bits += int(BYTE_BITS[self._words[start:start + FILL_WORDS].view(np.uint8)].sum(dtype=np.int64))
+		return set_bits / float(1 << self.bits)
+
+	def clear(self):
+		"""
+		Forget every kmer, as when the graph is dropped
+		:return: None
+		"""
+		with self._lock:
+			self._words[:] = 0
+			self.count = 0
+
+	def save(self, filename, stamp):
+		"""
+		Write the filter to a file, replacing any previous one only once it is complete
+		:param filename: Path of the filter file
+		:param stamp: String recorded in the graph along with the file
+		:return: None
+		"""
+		self.stamp = stamp
+		partial_filename = filename + ".tmp"
+		with self._lock, open(partial_filename, "wb") as f:
+			np.savez(f, words=self._words, hashes=self.hashes, count=self.count, stamp=stamp)
+		os.replace(partial_filename, filename)
+		LOG.info("Saved the kmer filter of {0} kmers to {1}".format(self.count, filename))
+
+	@classmethod
+	def load(cls, filename):
+		"""
+		:param filename: Path of a file written by save()
+		:return: BloomFilter
+		"""
+		with np.load(filename) as saved:
+			words = saved['words']
+			bloom_filter = cls(bits=int(words.size).bit_length() + 5, hashes=int(saved['hashes']))
+			bloom_filter._words = words
+			bloom_filter.count = int(saved['count'])
+			bloom_filter.stamp = str(saved['stamp']) if 'stamp' in saved else None
+		LOG.info("Loaded the kmer filter of {0} kmers from {1}".format(bloom_filter.count, filename))
+		return bloom_filter
+
+
+def load_kmer_filter(filename, stamp):
+	"""
+	Load the filter saved with the graph, if the graph still records its stamp
+	:param filename: Path of a file written by BloomFilter.save()
+	:param stamp: The stamp recorded in the graph, or None
+	:return: BloomFilter, or None if there is no file or it does not match the graph
+	"""
+	if not os.path.exists(filename):
+		LOG.warning("No kmer filter was saved with the graph, so every kmer is looked up")
+		return None
+	bloom_filter = BloomFilter.load(filename)
+	if stamp is None or bloom_filter.stamp != stamp:
+		LOG.warning("The kmer filter {0} was not saved with the graph as it is now, so every kmer is "
+					"looked up".format(filename))
+		return None
+	return bloom_filter
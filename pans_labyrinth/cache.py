@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+Process wide kmer:uid cache.
+Kmers resolved for one contig or genome are kept, so that later contigs only
+need to ask dgraph about kmers that have not been seen before.
+"""
+
+from collections import OrderedDict
+import threading
+
+# Default maximum number of kmer:uid entries held before the least recently used are evicted
+KMER_CACHE_SIZE = 2000000
+
+
+class KmerCache(object):
+	"""
+	A bounded kmer:uid dictionary with least recently used eviction.
+	Keys are packed kmers, values are dgraph uids.
+	"""
+
+	def __init__(self, max_size=KMER_CACHE_SIZE):
+		"""
+		:param max_size: Maximum number of entries kept
+		"""
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get_uids(self, kmer_list):
+		"""
+		Look up a list of kmers, marking those found as recently used.
+		:param kmer_list: [packed kmers]
+		:return: dict{kmer:uid} of the kmers present in the cache
+		"""
+		found = {}
+		with self._lock:
+			for kmer in kmer_list:
+				uid = self._entries.get(kmer)
+				if uid is not None:
+					self._entries.move_to_end(kmer)
+					found[kmer] = uid
+			self.hits += len(found)
+			self.misses += len(kmer_list) - len(found)
+		return found
+
+	def add_kmers(self, kmers):
+		"""
+		Add kmers to the cache, evicting the least recently used past max_size.
+		Requires the list to be in the form of [{kmer:uid}], as is returned from
+		query_kmers_dgraph() and add_kmers_batch_dgraph()
+		:param kmers: [{kmer:uid}]
+		:return: None
+		"""
+		if not kmers:
+			return
+		with self._lock:
+			for ku in kmers:
+				self._entries[ku['kmer']] = ku['uid']
+				self._entries.move_to_end(ku['kmer'])
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+
+	def discard(self, kmer_list):
+		"""
+		Remove kmers whose nodes have been deleted from the graph.
+		:param kmer_list: [packed kmers]
+		:return: None
+		"""
+		with self._lock:
+			for kmer in kmer_list:
+				self._entries.pop(kmer, None)
+
+	def clear(self):
+		"""
+		Empty the cache, for when the graph has been dropped.
+		:return: None
+		"""
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self):
+		"""
+		:return: dict of the hit and miss counts, hit rate and current size
+		"""
+		lookups = self.hits + self.misses
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': self.hits / lookups if lookups else 0.0,
+			'size': len(self._entries),
+		}
@@ -1,8 +1,9 @@
 #!/user/bin/env python
-from pans_labyrinth import files, dgraph, commandline
+from pans_labyrinth import files, dgraph, commandline, bloom
 import argparse
 import sys
 import hashlib
+import os
 
 """
 Arg-parser goes here
@@ -30,7 +31,7 @@ def compute_hash(filename):
 	return hash
 
 
-def arg_parser(client):
+def arg_parser(client=None):
 	"""
 	Function to create the commandline arguments and assign them a value based on which flag was given.
 	Can either be single vales or a list of values. 
@@ -40,7 +41,37 @@ def arg_parser(client):
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-i", "--insert", action = 'append', help = "Insert a new genome into the graph using a fasta file",)
 	parser.add_argument("-q", "--query", action = 'append', help = "Find genome path in the graph based on the fasta file hash")
-	parser.add_argument("-d", "--delete", action = 'append', help = "Remove a genome grom the graph by using a the fasta file hash")
+	parser.add_argument("-d", "--delete", action = 'append', help = "Remove a genome from the graph, and the kmers no other genome holds, by its fasta file or hash")
+	parser.add_argument("--membership", metavar = "FASTA", action = 'append', help = "Report the share of the kmers of each sequence in a fasta file held by each genome in the graph")
+	parser.add_argument("--sequence", action = 'append', help = "A sequence to report the membership of, can be given more than once")
+	parser.add_argument("--membership-output", metavar = "FILE", help = "TSV file the membership is written to, instead of standard output")
+	parser.add_argument("--export-matrix", metavar = "FILE", help = "Write the genome by node presence/absence matrix of the graph to an NPZ file, reading --workers genomes at once")
+	parser.add_argument("-p", "--path", default = os.path.abspath("data/genomes/test/"), help = "Directory of fasta files to build the graph from")
+	parser.add_argument("-k", "--kmer-size", type = int, default = 11, help = "Size of kmer, at most 32; a graph holds kmers of one size only")
+	parser.add_argument("--export-rdf", metavar = "DIRECTORY", help = "Write the genomes as gzipped RDF and a schema for the dgraph bulk loader, instead of inserting them")
+	parser.add_argument("-m", "--manifest", help = "Journal file recording the genomes and contig chunks added to the graph")
+	parser.add_argument("-r", "--resume", action = 'store_true', help = "Keep the existing graph and skip the work recorded in the manifest")
+	parser.add_argument("--incremental", action = 'store_true', help = "Keep the existing graph and only insert genomes that are not already in it")
+	parser.add_argument("-w", "--workers", type = int, default = 1, help = "Number of genomes to extract and insert in parallel")
+	parser.add_argument("--pipeline", action = 'store_true', help = "Insert through staged threads joined by bounded queues, with the lookup and edge stages using the workers as threads")
+	parser.add_argument("--queue-size", type = int, default = 4, help = "Maximum chunks of kmers held between each stage of the pipeline")
+	parser.add_argument("--backend", choices = ["dgraph", "memory"], default = "dgraph", help = "Build the graph in dgraph, or in memory in this process")
+	parser.add_argument("--backend-path", help = "Directory the memory backend is loaded from when resuming or incremental, and saved to when done")
+	parser.add_argument("-a", "--alpha", action = 'append', help = "Address of a dgraph Alpha in the form host:port, can be given more than once")
+	parser.add_argument("--stubs", type = int, help = "Number of client stubs opened to each Alpha, defaults to the number of workers")
+	parser.add_argument("--balance", choices = ["round_robin", "least_outstanding"], default = "round_robin", help = "How requests are spread over the client stubs")
+	parser.add_argument("--upsert", action = 'store_true', help = "Write kmers and edges in one upsert per batch instead of looking kmers up first")
+	parser.add_argument("--edge-model", choices = ["genome", "next"], default = "genome", help = "Store genome paths as one predicate per genome, or as shared next edges with genome bitmask facets")
+	parser.add_argument("--canonical", action = 'store_true', help = "Store each kmer and its reverse complement as one node, with the strand on each genome edge")
+	parser.add_argument("--unitigs", action = 'store_true', help = "Compact all the genomes together into unitigs, the runs of kmers without a branch, and store the genome paths over them; every genome is held in memory at once, and the graph cannot be resumed or extended")
+	parser.add_argument("--migrate-edges", action = 'store_true', help = "Copy every genome predicate in the graph onto next edges, then drop the predicates")
+	parser.add_argument("--kmer-filter", metavar = "FILE", help = "Bloom filter of the kmers in the graph, saved with it, so kmers certainly not in the graph are inserted without a lookup")
+	parser.add_argument("--kmer-filter-capacity", type = int, default = bloom.KMER_FILTER_CAPACITY, help = "Number of kmers a new kmer filter is sized for, at 1.2 to 2.4 bytes each as its size is rounded up to a power of two")
+	parser.add_argument("--metrics", metavar = "FILE", help = "Write counters and stage latencies of the load to a file in the Prometheus text format")
+	parser.add_argument("--progress-interval", type = float, default = 10.0, help = "Seconds between progress lines and metrics file updates")
+	parser.add_argument("--batch-size", type = int, default = dgraph.BATCH_SIZE, help = "Maximum number of kmers or quads sent to dgraph per request")
+	parser.add_argument("--batch-bytes", type = int, default = dgraph.BATCH_BYTES, help = "Maximum size in bytes of a request sent to dgraph")
+	parser.add_argument("--unitig-max-bytes", type = int, default = dgraph.UNITIG_MAX_BYTES, help = "Maximum size in bytes of the fasta files compacted into unitigs in one run, counting a compressed file at four times its size")
 
 	opt = parser.parse_args()
 	return opt
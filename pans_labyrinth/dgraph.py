@@ -16,30 +16,136 @@ One additional verb for kmer construction:
 """
 
 import pydgraph
+import heapq
 import json
-from Bio import SeqIO
-from functools import partial
-from concurrent.futures import ThreadPoolExecutor
-from pans_labyrinth import files, dgraph, commandline, logging_functions
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pans_labyrinth import files, dgraph, commandline, logging_functions, kmers, cache, pool, unitig, backend, metrics
 import sys
 import logging
 import os
+import time
 
 output_directory = os.path.abspath("data/logger")
 LOG = logging_functions.create_logger()
 fh = logging.FileHandler(os.path.join(output_directory, 'pans_labyrinth.log'), 'w', 'utf-8')
 
+# Base schema of the graph. @upsert makes two transactions inserting the same kmer
+# conflict, rather than both creating a node for it
+SCHEMA = """
+kmer: string @index(exact, term) @upsert .
+genome_hash: string @index(exact) .
+filename: string .
+kmer_size: int .
+contigs: [uid] .
+contig_index: int .
+contig_id: string .
+contig_length: int .
+first_kmer: uid @reverse .
+last_kmer: uid @reverse .
+genome_index: int @index(int) @upsert .
+canonical: bool .
+unitig: string @index(hash) @upsert .
+next: [uid] @reverse .
+kmer_filter_stamp: string .
+"""
+
+# Predicates of the genome metadata nodes that are not genome edges
+METADATA_PREDICATES = ("genome_hash", "genome_index")
+
+# Default address of the dgraph Alpha
+DGRAPH_ADDRESS = 'localhost:9080'
+
+# Maximum number of kmers held in memory per contig chunk
+KMER_CHUNK_SIZE = 100000
+
+# kmer:uid pairs already resolved in this process, shared by all contigs and genomes
+KMER_CACHE = cache.KmerCache()
+
+# bloom.BloomFilter of every kmer in the graph, letting lookups skip kmers certainly not in it.
+# None when not used, as it is only sound if every kmer of the graph went through it
+KMER_FILTER = None
+
+# Counters and stage latencies of the load running in this process
+METRICS = metrics.Metrics()
+
+# Finds the nodes of a space separated list of kmers
+KMERS_QUERY = """
+query find_all($klist: string){
+find_all(func: anyofterms(kmer, $klist))
+{
+uid
+kmer
+}
+}
+"""
+
+# Maximum number of kmers or quads sent to dgraph in one query or mutation
+BATCH_SIZE = 10000
+
+# Maximum size in bytes of one query or mutation, well under the gRPC message limit
+BATCH_BYTES = 1024 * 1024
+
+# How kmers are written: WRITE_QUERY looks kmers up, inserts the missing ones and then
+# adds the edges, WRITE_UPSERT writes kmers and edges together in one upsert per batch
+WRITE_QUERY = "query"
+WRITE_UPSERT = "upsert"
+WRITE_MODE = WRITE_QUERY
+
+# How genome paths are stored: EDGE_GENOME adds a genome_<hash> predicate for every
+# genome, EDGE_NEXT shares one next edge between kmers and records the genomes using
+# it as bitmask facets g0, g1, ... on the edge, keyed by the genome_index of each genome
+EDGE_GENOME = "genome"
+EDGE_NEXT = "next"
+EDGE_MODEL = EDGE_GENOME
+
+# Genomes per bitmask facet on a next edge, 63 keeps the int64 facet positive
+GENOMES_PER_FACET = 63
+
+# genome:genome_index pairs already resolved in this process
+GENOME_INDEXES = {}
+
+# Store each kmer as the lesser of itself and its reverse complement, recording on
+# each genome edge the strand of its two kmers in an orientation facet, one of
+# "++", "+-", "-+" or "--"
+CANONICAL = False
 
-def create_client_stub():
+# Compact all the genomes of a load together into unitigs before insertion, storing a
+# node for each unitig, and the genome paths and contig first_kmer and last_kmer over
+# them. Unitigs are not split by later genomes, so a unitig graph is built in one load
+UNITIGS = False
+
+# Most bytes of fasta files compacted into unitigs in one load, as the kmers of every
+# genome are held at once, at about eight bytes for each base. A compressed file is
+# counted at four times its size
+UNITIG_MAX_BYTES = 1 << 30
+
+# Number of times a transaction aborted by a conflicting writer is retried, and the
+# initial delay in seconds between attempts, which doubles on every retry
+MAX_RETRIES = 8
+RETRY_DELAY = 0.05
+
+# Most steps taken to walk the contigs of a genome, for each of its segments, before giving up
+MAX_WALK_STEPS = 10
+
+
+class PathError(Exception):
+	"""
+	Raised when the paths of a genome cannot be rebuilt from its edges.
+	"""
+
+
+def create_client_stub(address=DGRAPH_ADDRESS):
 	"""
 	This allows us to create as many stubs as we want easily
 	without having to specify the address every time.
 	This allows a single source to be easily changed.
+	:param address: The dgraph Alpha address in the form host:port
 	:return: A client stub
 	"""
 	try:
 		LOG.info("Creating client stub")
-		return pydgraph.DgraphClientStub('localhost:9080')
+		return pydgraph.DgraphClientStub(address)
 	except:
 		LOG.critical("Failed to create the client stub")
 
@@ -58,6 +164,22 @@ def create_client(client_stub):
 		LOG.critical("Failed to create client")
 
 
+def create_client_pool(addresses=None, stubs_per_alpha=1, strategy=pool.ROUND_ROBIN):
+	"""
+	Create a pool of stubs over one or more dgraph Alphas, which is used in place of a
+	single client so that requests are spread over many connections.
+	:param addresses: list of Alpha addresses, defaults to DGRAPH_ADDRESS
+	:param stubs_per_alpha: Number of stubs opened to each Alpha
+	:param strategy: pool.ROUND_ROBIN or pool.LEAST_OUTSTANDING
+	:return: A pool.ClientPool, closed with its close() method
+	"""
+	try:
+		LOG.info("Creating client pool")
+		return pool.ClientPool(addresses or [DGRAPH_ADDRESS], stubs_per_alpha, strategy)
+	except:
+		LOG.critical("Failed to create the client pool")
+
+
 def drop_all(client):
 	"""
 	Wipe the database for a fresh start
@@ -66,6 +188,11 @@ def drop_all(client):
 	"""
 	try:
 		LOG.info("Dropping existing graph")
+		KMER_CACHE.clear()
+		if KMER_FILTER is not None:
+			KMER_FILTER.clear()
+		if isinstance(client, backend.Backend):
+			return client.drop_all()
 		return client.alter(pydgraph.Operation(drop_all=True))
 	except:
 		LOG.critical("Failed to drop previous graph")
@@ -78,40 +205,49 @@ def add_schema(client):
 	:param client: dgraph client
 	:return: The client altered via the schema set out here
 	"""
-	schema = """
-	kmer: string @index(exact, term) .
-	"""
 	try:
 		LOG.info("Add schema to graph with client")
-		return client.alter(pydgraph.Operation(schema=schema))
+		if isinstance(client, backend.Backend):
+			return client.add_schema()
+		return client.alter(pydgraph.Operation(schema=SCHEMA))
 	except:
 		LOG.critical("Failed to add schema to graph")
 
 
-def query_kmers_dgraph(client, kmer_list):
+def query_kmers_dgraph(client, kmer_array, kmer_size):
 	"""
 	Bulk query a list of kmers and return a dictionary of kmer:uid.
 	:param client: dgraph client
-	:param kmer_list: List of kmers to query dgraph for
-	:return: [dict{kmer:uid}]
-	"""
-	query = """
-	query find_all($klist: string){
-	find_all(func: anyofterms(kmer, $klist))
-	{
-	uid
-	kmer
-	}
-	}
+	:param kmer_array: numpy array of packed kmers to query dgraph for
+	:param kmer_size: Size of kmer
+	:return: [dict{kmer:uid}] with the kmers packed
 	"""
-	variables = {'$klist': ' '.join(kmer_list)}
-	res = client.query(query, variables=variables)
-	json_res = json.loads(res.json)
+	if isinstance(client, backend.Backend):
+		return client.query_kmers(kmer_array, kmer_size)
 
-	if json_res['find_all']:
-		return json_res['find_all']
-	else:
-		return None
+	# Each kmer costs its length plus a separating space
+	step = max(1, min(BATCH_SIZE, BATCH_BYTES // (kmer_size + 1)))
+	found = []
+	for start in range(0, len(kmer_array), step):
+		found.extend(query_kmers_txn(client, kmer_array[start:start + step], kmer_size))
+	return found or None
+
+
+def query_kmers_txn(txn, kmer_array, kmer_size):
+	"""
+	Look up one batch of kmers, in a transaction or through the client
+	:param txn: dgraph transaction, or client for a read of its own
+	:param kmer_array: numpy array of packed kmers
+	:param kmer_size: Size of kmer
+	:return: [dict{kmer:uid}] of the kmers found, with the kmers packed
+	"""
+	variables = {'$klist': ' '.join(kmers.decode_kmers(kmer_array, kmer_size))}
+	METRICS.add("requests")
+	METRICS.add("bytes_sent", len(KMERS_QUERY) + len(variables['$klist']))
+	res = txn.query(KMERS_QUERY, variables=variables)
+	found = json.loads(res.json)['find_all']
+	packed = kmers.encode_kmers([ku['kmer'] for ku in found]).tolist() if found else []
+	return [{'kmer': k, 'uid': ku['uid']} for k, ku in zip(packed, found)]
 
 
 def example_query(client, genome):
@@ -167,77 +303,579 @@ def path_query(client, genome):
 	genome name to traverse the edges.
 	:param client: the dgraph client
 	:param genome: the genome in name in the form genome_hash
-	:return: A dictionary converted from a JSON object which is the query returned by dgraph
+	:return: dict{"path": [{uid, kmer}]} with the kmers of every contig in path order
+	"""
+	path = []
+	for contig_path in get_genome_paths(client, genome):
+		path.extend(contig_path)
+	return {"path": path}
+
+
+def query_genome_edges(client, genome, page_size=None):
+	"""
+	Page through every edge of a genome, in uid order of the source kmer, or with
+	next edges in the order they are walked from the genome's first kmers.
+	:param client: the dgraph client
+	:param genome: the genome in name in the form genome_hash
+	:param page_size: Number of source kmers per page, defaults to BATCH_SIZE
+	:return: Generator of pages, each a list of {uid, kmer, genome: [{uid, kmer}]}
 	"""
+	if isinstance(client, backend.Backend):
+		return client.query_genome_edges(genome, page_size or BATCH_SIZE)
+	if EDGE_MODEL == EDGE_NEXT:
+		return query_genome_next_edges(client, genome, page_size)
+	return query_genome_predicate_edges(client, genome, page_size)
+
+
+def query_genome_predicate_edges(client, genome, page_size=None):
+	"""
+	Page through the genome_<hash> edges of a genome, in uid order of the source kmer.
+	:param client: the dgraph client
+	:param genome: the genome in name in the form genome_hash
+	:param page_size: Number of source kmers per page, defaults to BATCH_SIZE
+	:return: Generator of pages, each a list of {uid, kmer, genome: [{uid, kmer}]}
+	"""
+	page_size = page_size or BATCH_SIZE
+	after = ""
+	while True:
+		query = """
+		{{
+		  page(func: has({0}), first: {1}{2}){{
+			uid
+			kmer
+			unitig
+			{0} @facets(orientation){{
+			  uid
+			  kmer
+			  unitig
+			}}
+		  }}
+		}}
+		""".format(genome, page_size, after)
+
+		res = client.query(query)
+		page = json.loads(res.json)["page"]
+		if not page:
+			return
+		yield page
+		if len(page) < page_size:
+			return
+		after = ", after: {0}".format(page[-1]["uid"])
 
+
+def get_genome_paths(client, genome, page_size=None):
+	"""
+	Rebuild the order of a genome's kmers from its edges.
+	The edges are read a page at a time into a successor list. Each contig recorded in
+	the genome metadata is walked in contig order from its first kmer to its last,
+	covering exactly its length, so a kmer shared with another contig does not lead
+	the walk into that contig's edges. A contig that cannot be walked, or edges that no
+	contig walks, mean the paths cannot be rebuilt, and raise a PathError.
+	Without metadata the edges are walked once (Hierholzer's algorithm), each walk
+	starting at a kmer with more edges out than in; a contig that is a closed cycle is
+	walked from any of its kmers. In a canonical graph each kmer is turned back to the
+	strand it was read from, using the orientation facets of the edges walked.
+	:param client: the dgraph client
+	:param genome: the genome in name in the form genome_hash
+	:param page_size: Number of source kmers per page, defaults to BATCH_SIZE
+	:return: Generator of contig paths, each a list of {uid, kmer}, or of {uid, unitig}
+	in a unitig graph
+	"""
+	metadata = query_metadata_dgraph(client, genome)
+	contigs = [contig for contig in (metadata.get('contigs', []) if metadata else [])
+			   if 'first_kmer' in contig and 'last_kmer' in contig]
+
+	node_by_uid = {}
+	successors = {}
+	balance = {}
+	orientations = {}
+	for page in query_genome_edges(client, genome, page_size):
+		for node in page:
+			node_by_uid[node["uid"]] = get_path_node(node)
+			targets = successors.setdefault(node["uid"], [])
+			for target in node.get(genome, []):
+				node_by_uid[target["uid"]] = get_path_node(target)
+				targets.append(target["uid"])
+				if genome + "|orientation" in target:
+					orientations[(node["uid"], target["uid"])] = target[genome + "|orientation"]
+				balance[node["uid"]] = balance.get(node["uid"], 0) + 1
+				balance[target["uid"]] = balance.get(target["uid"], 0) - 1
+
+	if contigs:
+		for contig in contigs:
+			for end in ('first_kmer', 'last_kmer'):
+				node_by_uid.setdefault(contig[end]['uid'], get_path_node(contig[end]))
+		for walk in get_contig_walks(genome, successors, node_by_uid, contigs, metadata['kmer_size']):
+			yield get_path_oriented(walk, node_by_uid, orientations)
+		return
+
+	for targets in successors.values():
+		targets.reverse()
+
+	# Without metadata, walk from the contig starts in uid order, then whatever cycles remain
+	starts = sorted((uid for uid in balance if balance[uid] > 0), key=lambda uid: int(uid, 16))
+	for start in starts + list(successors):
+		while successors.get(start):
+			yield get_path_oriented(get_path_walk(successors, start), node_by_uid, orientations)
+
+
+def get_contig_walks(genome, successors, node_by_uid, contigs, kmer_size):
+	"""
+	Walk each recorded contig of a genome over its edges, raising a PathError if any
+	contig cannot be walked, or if an edge is left that no contig walks.
+	:param genome: the genome in name in the form genome_hash
+	:param successors: dict{uid:[uids]} of the edges out of each node
+	:param node_by_uid: dict{uid:{uid, kmer}} or dict{uid:{uid, unitig}} of every node
+	:param contigs: contigs of the genome metadata, in order
+	:param kmer_size: Size of kmer
+	:return: list of the walk of each contig, as a list of uids
+	"""
+	def get_weight(uid):
+		node = node_by_uid[uid]
+		return len(node["unitig"]) - kmer_size + 1 if "unitig" in node else 1
+
+	ends = set(contig[end]['uid'] for contig in contigs for end in ('first_kmer', 'last_kmer'))
+	segments, segments_out, segments_in = get_path_segments(successors, get_weight, ends)
+	used = [0] * len(segments)
+	steps = MAX_WALK_STEPS * (len(segments) + len(contigs))
+	walks = []
+	for contig in contigs:
+		first, last = contig['first_kmer']['uid'], contig['last_kmer']['uid']
+		length = contig['contig_length'] - kmer_size + 1 - get_weight(first)
+		walk, steps = get_contig_walk(segments, segments_out, segments_in, first, last, length, used, steps)
+		if walk is None:
+			raise PathError("Could not rebuild contig {0} of {1} from its edges".format(contig['contig_id'], genome))
+		walks.append([first] + [uid for number in walk for uid in segments[number][1]])
+
+	unwalked = sum(len(targets) for targets in successors.values())
+	unwalked -= sum(len(segment[1]) for segment, times in zip(segments, used) if times)
+	if unwalked:
+		raise PathError("{0} edges of {1} are on none of its contigs".format(unwalked, genome))
+	return walks
+
+
+def get_path_segments(successors, get_weight, ends):
+	"""
+	Split the edges of a genome into segments, the runs of nodes between branches, so
+	a walk over them only has to choose where the genome branches
+	:param successors: dict{uid:[uids]} of the edges out of each node
+	:param get_weight: function of a uid giving the bases its node adds to a walk
+	:param ends: set of uids a segment always stops at, such as the contig ends
+	:return: list of segments, each (start uid, [uids after it], bases added), and
+	dict{uid:[segment numbers]} of the segments out of and into each node
+	"""
+	in_degrees = {}
+	for targets in successors.values():
+		for target in targets:
+			in_degrees[target] = in_degrees.get(target, 0) + 1
+
+	def is_branch(uid):
+		return uid in ends or in_degrees.get(uid, 0) != 1 or len(successors.get(uid, ())) != 1
+
+	segments = []
+	segments_out = {}
+	segments_in = {}
+	for start, targets in successors.items():
+		if not is_branch(start):
+			continue
+		for target in targets:
+			nodes = [target]
+			while not is_branch(nodes[-1]):
+				nodes.append(successors[nodes[-1]][0])
+			segments_out.setdefault(start, []).append(len(segments))
+			segments_in.setdefault(nodes[-1], []).append(len(segments))
+			segments.append((start, nodes, sum(get_weight(uid) for uid in nodes)))
+	return segments, segments_out, segments_in
+
+
+def get_walk_distances(segments, segments_in, last, limit, steps):
+	"""
+	Find the fewest bases a walk adds from each node on its way to the last node of a
+	contig, going back over the segments into each node
+	:param segments: list of segments as from get_path_segments()
+	:param segments_in: dict{uid:[segment numbers]} of the segments into each node
+	:param last: uid walked to
+	:param limit: Largest distance of interest
+	:param steps: Most nodes to visit
+	:return: dict{uid:distance} of the nodes within limit of last, or None if out of
+	steps, and the steps left
+	"""
+	distances = {last: 0}
+	heap = [(0, last)]
+	while heap:
+		steps -= 1
+		if steps < 0:
+			return None, steps
+		distance, uid = heapq.heappop(heap)
+		if distance > distances[uid]:
+			continue
+		for number in segments_in.get(uid, ()):
+			start, nodes, weight = segments[number]
+			if distance + weight < distances.get(start, limit + 1):
+				distances[start] = distance + weight
+				heapq.heappush(heap, (distance + weight, start))
+	return distances, steps
+
+
+def get_contig_walk(segments, segments_out, segments_in, first, last, length, used, steps):
+	"""
+	Find a walk over the segments from the first node of a contig to its last adding
+	exactly length bases, searching depth first. A segment is only taken if the last
+	node can still be reached within the bases left, and segments walked fewer times
+	by the genome's contigs are tried first. A segment may be walked again, as a
+	repeat is stored once.
+	:param segments: list of segments as from get_path_segments()
+	:param segments_out: dict{uid:[segment numbers]} of the segments out of each node
+	:param segments_in: dict{uid:[segment numbers]} of the segments into each node
+	:param first: uid of the first node
+	:param last: uid of the last node
+	:param length: Bases the walk adds after the first node
+	:param used: list of the times each segment has been walked, updated with the walk
+	:param steps: Most segments to visit, shared by the contigs of a genome
+	:return: list of segment numbers in walk order, or None if there is no such walk
+	or it was not found within steps, and the steps left
+	"""
+	distances, steps = get_walk_distances(segments, segments_in, last, length, steps)
+	if distances is None or distances.get(first, length + 1) > length:
+		return None, steps
+
+	def get_branches(uid, left):
+		fits = [number for number in segments_out.get(uid, ())
+				if segments[number][2] + distances.get(segments[number][1][-1], left + 1) <= left]
+		# Popped from the end, so the least walked segment is tried first
+		return sorted(fits, key=lambda number: used[number], reverse=True)
+
+	walk = []
+	nodes = [first]
+	lefts = [length]
+	branches = [get_branches(first, length)]
+	# Nodes and bases left from which the last node cannot be reached
+	dead_ends = set()
+	while nodes:
+		if lefts[-1] == 0 and nodes[-1] == last:
+			return walk, steps
+		steps -= 1
+		if steps < 0:
+			return None, steps
+		if branches[-1]:
+			number = branches[-1].pop()
+			target = segments[number][1][-1]
+			left = lefts[-1] - segments[number][2]
+			if (target, left) in dead_ends:
+				continue
+			used[number] += 1
+			walk.append(number)
+			nodes.append(target)
+			lefts.append(left)
+			branches.append(get_branches(target, left))
+		else:
+			dead_ends.add((nodes.pop(), lefts.pop()))
+			branches.pop()
+			if walk:
+				used[walk.pop()] -= 1
+	return None, steps
+
+
+def get_path_node(node):
+	"""
+	:param node: A kmer or unitig node as returned by a query
+	:return: dict of its uid and its kmer or unitig
+	"""
+	if "unitig" in node:
+		return {"uid": node["uid"], "unitig": node["unitig"]}
+	return {"uid": node["uid"], "kmer": node.get("kmer")}
+
+
+def get_path_oriented(walk, node_by_uid, orientations):
+	"""
+	Give each kmer of a walk as read from the genome. Without orientation facets the
+	kmers are returned as stored.
+	:param walk: list of uids in walk order
+	:param node_by_uid: dict{uid:{uid, kmer}}
+	:param orientations: dict{(uid, uid):orientation facet} of the genome edges
+	:return: list of {uid, kmer}
+	"""
+	path = [dict(node_by_uid[uid]) for uid in walk]
+	if not orientations or len(walk) < 2:
+		return path
+
+	# The strand of each kmer is on the edge out of it, or for the last kmer, into it
+	strands = [orientations.get((walk[i], walk[i + 1]), "++")[0] for i in range(len(walk) - 1)]
+	strands.append(orientations.get((walk[-2], walk[-1]), "++")[1])
+	reverse = [i for i, strand in enumerate(strands) if strand == "-"]
+	if reverse:
+		kmer_size = len(path[0]["kmer"])
+		packed = kmers.encode_kmers([path[i]["kmer"] for i in reverse])
+		for i, kmer in zip(reverse, kmers.decode_kmers(kmers.get_reverse_complement(packed, kmer_size), kmer_size)):
+			path[i]["kmer"] = kmer
+	return path
+
+
+def get_path_walk(successors, start):
+	"""
+	Walk every edge reachable from start exactly once, removing the edges walked.
+	:param successors: dict{uid:[uids]} of the edges out of each kmer
+	:param start: uid to start from
+	:return: list of uids in walk order
+	"""
+	stack = [start]
+	walk = []
+	while stack:
+		targets = successors.get(stack[-1])
+		if targets:
+			stack.append(targets.pop())
+		else:
+			walk.append(stack.pop())
+	walk.reverse()
+	return walk
+
+
+def get_genome_sequence(client, genome, page_size=None):
+	"""
+	Assemble the sequence of each contig of a genome from the kmers or unitigs of its
+	path, each overlapping the one before it by all but one base of a kmer.
+	:param client: the dgraph client
+	:param genome: the genome in name in the form genome_hash
+	:param page_size: Number of source kmers per page, defaults to BATCH_SIZE
+	:return: Generator of contig sequences
+	"""
+	metadata = query_metadata_dgraph(client, genome)
+	for contig_path in get_genome_paths(client, genome, page_size):
+		sequences = [node.get("kmer") or node["unitig"] for node in contig_path]
+		kmer_size = metadata['kmer_size'] if metadata else len(sequences[0])
+		yield sequences[0] + ''.join(sequence[kmer_size - 1:] for sequence in sequences[1:])
+
+
+def query_genomes_dgraph(client):
+	"""
+	Find the genomes that have an edge in the schema.
+	The edge is added to the schema before a genome's kmers are inserted, so a genome
+	found here may have been only partly inserted.
+	:param client: dgraph client
+	:return: set of genome names in the form genome_hash
+	"""
+	if isinstance(client, backend.Backend):
+		return client.query_genomes()
+
+	res = client.query("schema {}")
+	json_res = json.loads(res.json)
+
+	genomes = set()
+	for predicate in json_res.get('schema', []):
+		if predicate['predicate'].startswith("genome_") and predicate['predicate'] not in METADATA_PREDICATES:
+			genomes.add(predicate['predicate'])
+	return genomes
+
+
+def query_metadata_genomes_dgraph(client):
+	"""
+	Find the genomes with a metadata node. It is written once all the edges of a genome
+	are in the graph, so unlike query_genomes_dgraph() only finished genomes are found.
+	:param client: dgraph client
+	:return: set of genome names in the form genome_hash
+	"""
+	if isinstance(client, backend.Backend):
+		return client.query_metadata_genomes()
+
+	# A genome given a genome_index has a node without a filename until it is finished
 	query = """
-	{{
-	  genome(func: has({0})){{
-		uid
-		kmer
-		{0}{{
-		  uid
-		  kmer
+	{
+	genomes(func: has(filename)){
+		genome_hash
+	}
+	}
+	"""
+	res = client.query(query)
+	json_res = json.loads(res.json)
+	return set("genome_" + node['genome_hash'] for node in json_res['genomes'])
+
+
+def query_genome_indexes_dgraph(client):
+	"""
+	Find the genomes given a genome_index for the next edges, that have not been deleted
+	:param client: dgraph client
+	:return: dict{genome name:genome_index}
+	"""
+	# A deleted genome keeps its index, but not the rest of its metadata
+	query = """
+	{
+	indexed(func: has(genome_index)) @filter(has(filename)){
+		genome_hash
+		genome_index
+	}
+	}
+	"""
+	res = client.query(query)
+	json_res = json.loads(res.json)
+	return {"genome_" + node['genome_hash']: node['genome_index'] for node in json_res['indexed']}
+
+
+def query_kmer_genomes_dgraph(client, uids, genomes):
+	"""
+	Find the genomes each of a list of kmer nodes is in, asking about a batch of nodes
+	and every genome in each query. A kmer is in a genome when the genome has an edge
+	out of it, or an edge into it from one of the kmers asked about.
+	:param client: dgraph client
+	:param uids: list of kmer node uids
+	:param genomes: list of genome names in the form genome_hash
+	:return: numpy bool array with a row for each uid and a column for each genome
+	"""
+	if isinstance(client, backend.Backend):
+		return client.query_kmer_genomes(uids, genomes)
+
+	present = np.zeros((len(uids), len(genomes)), dtype=bool)
+	row_by_uid = {uid: i for i, uid in enumerate(uids)}
+	if EDGE_MODEL == EDGE_NEXT:
+		genome_indexes = query_genome_indexes_dgraph(client)
+		facet_columns = [(get_genome_facet(genome_indexes[genome]), j)
+						 for j, genome in enumerate(genomes) if genome in genome_indexes]
+		edges = "next @facets { uid }"
+	else:
+		edges = "\n".join("{0} {{ uid }}".format(genome) for genome in genomes)
+
+	# Rough bytes per uid in the query
+	step = max(1, min(BATCH_SIZE, BATCH_BYTES // 20))
+	for start in range(0, len(uids), step):
+		query = """
+		{{
+		nodes(func: uid({0})){{
+			uid
+			{1}
 		}}
-	  }}
-	}}
-	""".format(genome)
+		}}
+		""".format(', '.join(uids[start:start + step]), edges)
+		METRICS.add("requests")
+		res = client.query(query)
+		for node in json.loads(res.json)['nodes']:
+			row = row_by_uid[node['uid']]
+			if EDGE_MODEL == EDGE_NEXT:
+				targets = [(target, j) for target in node.get('next', []) for (facet, bit), j in facet_columns
+						   if target.get('next|' + facet, 0) & bit]
+			else:
+				targets = [(target, j) for j, genome in enumerate(genomes) for target in node.get(genome, [])]
+			for target, j in targets:
+				present[row, j] = True
+				if target['uid'] in row_by_uid:
+					present[row_by_uid[target['uid']], j] = True
+	return present
+
+
+def query_kmer_size_dgraph(client):
+	"""
+	Find the kmer size a graph was built with, from the genome metadata, or for a
+	graph without metadata, from the length of a kmer.
+	:param client: dgraph client
+	:return: kmer size, or None for an empty graph
+	"""
+	if isinstance(client, backend.Backend):
+		return client.query_kmer_size()
 
+	query = """
+	{
+	meta(func: has(kmer_size), first: 1){
+		kmer_size
+	}
+	kmer(func: has(kmer), first: 1){
+		kmer
+	}
+	}
+	"""
 	res = client.query(query)
-	p_res = json.loads(res.json)
-
-	path_list = p_res["genome"]
-	uid_dict = {}
-	uid_list = []
-	start_stop_list = []
-
-	for x, i in enumerate(path_list):
-		first_uid = path_list[x]["uid"]
-		second_uid = path_list[x][genome][0]["uid"]
-		uid_list.append(first_uid)
-		uid_list.append(second_uid)
-
-	for key in uid_list:
-		if key in uid_dict:
-			uid_dict[key] += 1
+	json_res = json.loads(res.json)
+
+	if json_res.get('meta'):
+		return json_res['meta'][0]['kmer_size']
+	elif json_res.get('kmer'):
+		return len(json_res['kmer'][0]['kmer'])
+	else:
+		return None
+
+
+def query_canonical_dgraph(client):
+	"""
+	Find whether a graph was built with canonical kmers, from the genome metadata
+	:param client: dgraph client
+	:return: True or False, or None for a graph without metadata
+	"""
+	if isinstance(client, backend.Backend):
+		return client.query_canonical()
+
+	query = """
+	{
+	meta(func: has(canonical), first: 1){
+		canonical
+	}
+	}
+	"""
+	res = client.query(query)
+	json_res = json.loads(res.json)
+	return json_res['meta'][0]['canonical'] if json_res.get('meta') else None
+
+
+def query_kmer_filter_stamp_dgraph(client):
+	"""
+	Get the stamp of the kmer filter saved with the graph
+	:param client: dgraph client
+	:return: stamp string, or None if no saved filter is known to hold every kmer of the graph
+	"""
+	if isinstance(client, backend.Backend):
+		return client.query_kmer_filter_stamp()
+
+	res = client.query("{ stamp(func: has(kmer_filter_stamp)) { kmer_filter_stamp } }")
+	json_res = json.loads(res.json)
+	return json_res['stamp'][0]['kmer_filter_stamp'] if json_res['stamp'] else None
+
+
+def set_kmer_filter_stamp_dgraph(client, stamp):
+	"""
+	Record the stamp of the kmer filter saved with the graph, on a node of its own
+	:param client: dgraph client
+	:param stamp: stamp string, or None when kmers are about to be inserted
+	:return: None
+	"""
+	if isinstance(client, backend.Backend):
+		return client.set_kmer_filter_stamp(stamp)
+
+	txn = client.txn()
+	try:
+		if stamp is None:
+			mutation = txn.create_mutation(del_nquads='uid(s) <kmer_filter_stamp> * .\n')
 		else:
-			uid_dict[key] = 1
-
-	for key in uid_dict.keys():
-		if uid_dict[key] == 1:
-			start_stop_list.append(key)
-	first = start_stop_list[0]
-	second = start_stop_list[1]
-
-	for x, i in enumerate(path_list):
-		first_uid = path_list[x]["uid"]
-		if first_uid == first:
-			start = first
-			stop = second
-		if first_uid == second:
-			start = second
-			stop = first
-
-	query1 = """
-	{{
-	 path as shortest(from: {0}, to: {1}){{
-	   {2}
-	 }}
-	   path(func: uid(path)){{
-	     kmer
-	   }}
-	}}
-	""".format(start, stop, genome)
+			mutation = txn.create_mutation(set_nquads='uid(s) <kmer_filter_stamp> "{0}" .\n'.format(stamp))
+		request = txn.create_request(query='{ s as var(func: has(kmer_filter_stamp)) }',
+									 mutations=[mutation], commit_now=True)
+		txn.do_request(request)
+	finally:
+		txn.discard()
+
+
+def check_kmer_size_dgraph(client, kmer_size):
+	"""
+	Exit if the graph already holds kmers of another size, as kmers of different
+	sizes can never share nodes or edges.
+	:param client: dgraph client
+	:param kmer_size: Size of kmer about to be added
+	:return: None
+	"""
+	graph_kmer_size = query_kmer_size_dgraph(client)
+	if graph_kmer_size is not None and graph_kmer_size != kmer_size:
+		LOG.critical("The graph was built with kmer size {0}, not {1}".format(graph_kmer_size, kmer_size))
+		sys.exit()
 
-	res1 = client.query(query1)
-	path_res1 = json.loads(res1.json)
 
-	kmer_list1 = []
-	for i, x in enumerate(path_res1["path"]):
-		kmer = path_res1["path"][i]["kmer"]
-		kmer_list1.append(kmer)
+def check_canonical_dgraph(client, canonical):
+	"""
+	Exit if the graph already holds kmers stored the other way, canonical or not, as
+	the nodes of a kmer and of its reverse complement would not be found.
+	:param client: dgraph client
+	:param canonical: Whether the kmers about to be added are canonical
+	:return: None
+	"""
+	graph_canonical = query_canonical_dgraph(client)
+	if graph_canonical is not None and graph_canonical != canonical:
+		LOG.critical("The graph was built {0} canonical kmers".format("with" if graph_canonical else "without"))
+		sys.exit()
 
-	return path_res1
 
 def add_genome_to_schema(client, genome):
 	"""
@@ -247,13 +885,291 @@ def add_genome_to_schema(client, genome):
 	if it exists, nothing happens, but new names are added to the schema.
 	:param client: dgraph client
 	:param genome: genomeName
-	:return: Altered dgraph
+	:return: Altered dgraph, or None when genomes share the next edge
 	"""
-	schema = """
-	{0}: uid .
-	""".format(genome)
+	if isinstance(client, backend.Backend):
+		return client.add_genome(genome)
+	if EDGE_MODEL == EDGE_NEXT:
+		get_genome_index(client, genome)
+		return None
+	return client.alter(pydgraph.Operation(schema=get_genome_schema(genome)))
+
+
+def get_genome_index(client, genome):
+	"""
+	Get the genome_index of a genome, giving it the next free index if it has none.
+	The index is stored on the genome's metadata node, which is created here if it does
+	not exist yet. Two genomes taking the same index at once conflict on the @upsert
+	index, and the loser retries with the next index.
+	:param client: dgraph client
+	:param genome: The genome name in the form genome_hash
+	:return: genome_index
+	"""
+	if genome in GENOME_INDEXES:
+		return GENOME_INDEXES[genome]
+
+	query = """
+	query index($hash: string){
+	genome(func: eq(genome_hash, $hash)){
+		uid
+		genome_index
+	}
+	indexed(func: has(genome_index)){
+		count(uid)
+	}
+	}
+	"""
+	variables = {'$hash': genome[len("genome_"):]}
+	for attempt in range(MAX_RETRIES + 1):
+		txn = client.txn()
+		try:
+			json_res = json.loads(txn.query(query, variables=variables).json)
+			existing = json_res['genome'][0] if json_res['genome'] else {}
+			if 'genome_index' in existing:
+				index = existing['genome_index']
+				break
+			index = json_res['indexed'][0]['count'] if json_res['indexed'] else 0
+			subject = '<{0}>'.format(existing['uid']) if existing else '_:genome'
+			txn.mutate(set_nquads=''.join([
+				'{0} <genome_hash> "{1}" .\n'.format(subject, variables['$hash']),
+				'{0} <genome_index> "{1}" .\n'.format(subject, index),
+			]))
+			txn.commit()
+			break
+		except pydgraph.AbortedError:
+			METRICS.add("aborts")
+			if attempt == MAX_RETRIES:
+				raise
+			time.sleep(RETRY_DELAY * 2 ** attempt)
+		finally:
+			txn.discard()
+
+	GENOME_INDEXES[genome] = index
+	return index
 
-	return client.alter(pydgraph.Operation(schema=schema))
+
+def get_genome_facet(genome_index):
+	"""
+	:param genome_index: genome_index of a genome
+	:return: name of the facet holding the genome's bit, and the bit
+	"""
+	return "g{0}".format(genome_index // GENOMES_PER_FACET), 1 << (genome_index % GENOMES_PER_FACET)
+
+
+def add_edges_next_dgraph(client, uid_pairs, genome_index, remove=False, node_quads=None):
+	"""
+	Add a genome to the next edges between pairs of kmers.
+	Each batch reads the facets already on its edges, sets the genome's bit and writes
+	them back in the same transaction, as a mutation replaces all facets of an edge.
+	A batch that conflicts with another genome writing the same edge is retried.
+	:param client: dgraph client
+	:param uid_pairs: list of (source uid, target uid)
+	:param genome_index: genome_index of the genome
+	:param remove: Clear the genome's bit instead, deleting edges left with no genome
+	:param node_quads: dict{uid:N-Quad} from get_node_quads(), written along with each
+	batch for the nodes its edges link
+	:return: None
+	"""
+	facet, bit = get_genome_facet(genome_index)
+	uid_pairs = sorted(set(uid_pairs))
+	# Rough bytes per edge with a few facets, and the kmers of its nodes
+	step = max(1, min(BATCH_SIZE, BATCH_BYTES // (200 if node_quads else 100)))
+	for start in range(0, len(uid_pairs), step):
+		batch = uid_pairs[start:start + step]
+		query = """
+		{{
+		edges(func: uid({0})){{
+			uid
+			next @facets{{
+				uid
+			}}
+		}}
+		}}
+		""".format(', '.join(sorted(set(source for source, target in batch))))
+
+		for attempt in range(MAX_RETRIES + 1):
+			txn = client.txn()
+			try:
+				facets = {}
+				for node in json.loads(txn.query(query).json)['edges']:
+					for target in node.get('next', []):
+						facets[(node['uid'], target['uid'])] = dict(
+							(key[len('next|'):], value) for key, value in target.items() if key.startswith('next|'))
+
+				nquads = []
+				del_nquads = []
+				for source, target in batch:
+					edge_facets = facets.get((source, target), {})
+					if remove:
+						if (source, target) not in facets:
+							continue
+						edge_facets[facet] = edge_facets.get(facet, 0) & ~bit
+						if not any(edge_facets.values()):
+							del_nquads.append('<{0}> <next> <{1}> .\n'.format(source, target))
+							continue
+					else:
+						edge_facets[facet] = edge_facets.get(facet, 0) | bit
+					nquads.append('<{0}> <next> <{1}> ({2}) .\n'.format(source, target, ', '.join(
+						'{0}={1}'.format(key, value) for key, value in sorted(edge_facets.items()))))
+				if node_quads and nquads:
+					nquads.extend(node_quads[uid] for uid in sorted(set(uid for pair in batch for uid in pair)))
+				if nquads or del_nquads:
+					txn.mutate(set_nquads=''.join(nquads) or None, del_nquads=''.join(del_nquads) or None)
+				txn.commit()
+				break
+			except pydgraph.AbortedError:
+				METRICS.add("aborts")
+				if attempt == MAX_RETRIES:
+					raise
+				LOG.debug("Next edge update aborted, retrying")
+				time.sleep(RETRY_DELAY * 2 ** attempt)
+			finally:
+				txn.discard()
+
+
+def query_genome_next_edges(client, genome, page_size=None, first_kmers=None):
+	"""
+	Page through the next edges carrying a genome, in the same form as query_genome_edges().
+	The edges are walked out from the first kmer of each contig of the genome, a page of
+	the kmers reached at a time, so only the genome's own kmers are read. A genome whose
+	metadata does not record its first kmers, such as one whose load did not finish, is
+	found by paging through every kmer with a next edge instead.
+	Only edges with a facet for the genome's group are returned by dgraph, the bit for
+	the genome itself is checked here.
+	:param client: the dgraph client
+	:param genome: the genome in name in the form genome_hash
+	:param page_size: Number of source kmers per page, defaults to BATCH_SIZE
+	:param first_kmers: uids to walk from, defaults to those in the genome metadata
+	:return: Generator of pages, each a list of {uid, kmer, genome: [{uid, kmer}]}
+	"""
+	facet, bit = get_genome_facet(get_genome_index(client, genome))
+	page_size = page_size or BATCH_SIZE
+	if first_kmers is None:
+		first_kmers = get_first_kmers(query_metadata_dgraph(client, genome))
+	if first_kmers is None:
+		for page in query_next_pages(client, facet, page_size):
+			yield get_genome_next_page(page, genome, facet, bit)
+		return
+
+	walked = set(first_kmers)
+	sources = sorted(walked)
+	while sources:
+		query = """
+		{{
+		  page(func: uid({0})){{
+			uid
+			kmer
+			next @facets(gt({1}, 0)) @facets({1}){{
+			  uid
+			  kmer
+			}}
+		  }}
+		}}
+		""".format(', '.join(sources[:page_size]), facet)
+		sources = sources[page_size:]
+
+		genome_page = get_genome_next_page(json.loads(client.query(query).json)["page"], genome, facet, bit)
+		for node in genome_page:
+			for target in node[genome]:
+				if target['uid'] not in walked:
+					walked.add(target['uid'])
+					sources.append(target['uid'])
+		yield genome_page
+
+
+def query_next_pages(client, facet, page_size):
+	"""
+	Page through every kmer with a next edge, in uid order.
+	:param client: the dgraph client
+	:param facet: name of the facet whose next edges are returned
+	:param page_size: Number of source kmers per page
+	:return: Generator of pages, each a list of {uid, kmer, next: [{uid, kmer, next|facet}]}
+	"""
+	after = ""
+	while True:
+		query = """
+		{{
+		  page(func: has(next), first: {0}{1}){{
+			uid
+			kmer
+			next @facets(gt({2}, 0)) @facets({2}){{
+			  uid
+			  kmer
+			}}
+		  }}
+		}}
+		""".format(page_size, after, facet)
+
+		res = client.query(query)
+		page = json.loads(res.json)["page"]
+		if not page:
+			return
+		yield page
+
+		if len(page) < page_size:
+			return
+		after = ", after: {0}".format(page[-1]["uid"])
+
+
+def get_genome_next_page(page, genome, facet, bit):
+	"""
+	:param page: list of {uid, kmer, next: [{uid, kmer, next|facet}]}
+	:param genome: the genome in name in the form genome_hash
+	:param facet: name of the facet holding the genome's bit
+	:param bit: the genome's bit
+	:return: list of {uid, kmer, genome: [{uid, kmer}]} of the nodes with a next edge of the genome
+	"""
+	genome_page = []
+	for node in page:
+		targets = [{'uid': t['uid'], 'kmer': t.get('kmer')} for t in node.get('next', [])
+				   if t.get('next|' + facet, 0) & bit]
+		if targets:
+			genome_page.append({'uid': node['uid'], 'kmer': node.get('kmer'), genome: targets})
+	return genome_page
+
+
+def get_first_kmers(metadata):
+	"""
+	:param metadata: genome metadata from query_metadata_dgraph(), or None
+	:return: uids of the first kmer of each contig, or None if the metadata does not record them
+	"""
+	contigs = metadata.get('contigs', []) if metadata else []
+	if not contigs or not all('first_kmer' in contig for contig in contigs):
+		return None
+	return [contig['first_kmer']['uid'] for contig in contigs]
+
+
+def migrate_genome_edges(client, genome, drop_predicate=False):
+	"""
+	Copy a genome stored with its own genome_<hash> predicate onto the shared next
+	edges, so a graph built with EDGE_GENOME can be moved to EDGE_NEXT.
+	:param client: the dgraph client
+	:param genome: the genome in name in the form genome_hash
+	:param drop_predicate: Remove the genome_<hash> predicate once copied
+	:return: Number of edges copied
+	"""
+	genome_index = get_genome_index(client, genome)
+	uid_pairs = []
+	for page in query_genome_predicate_edges(client, genome):
+		for node in page:
+			for target in node.get(genome, []):
+				uid_pairs.append((node['uid'], target['uid']))
+	add_edges_next_dgraph(client, uid_pairs, genome_index)
+
+	if drop_predicate:
+		client.alter(pydgraph.Operation(drop_attr=genome))
+	LOG.info("Migrated {0} edges of {1}".format(len(uid_pairs), genome))
+	return len(uid_pairs)
+
+
+def get_genome_schema(genome):
+	"""
+	The schema line for a genome edge, shared by add_genome_to_schema() and the
+	offline RDF export.
+	:param genome: genomeName
+	:return: schema string
+	"""
+	return "{0}: [uid] .\n".format(genome)
 
 
 def get_kmers_files(filename, kmer_size):
@@ -264,19 +1180,40 @@ def get_kmers_files(filename, kmer_size):
 	:return: Dict of lists of all kmers dict{contig:[kmers]}
 	"""
 	LOG = logging_functions.create_logger()
-	if not filename.endswith(".fasta"):
+	if not files.is_fasta(filename):
 		LOG.critical("Non fasta file detected")
 		sys.exit()
 
 	all_kmers = {}
-	with open(filename, "r") as f:
-		for record in SeqIO.parse(f, "fasta"):
-			all_kmers[record.id] = []
-			for i in range(0, len(record.seq) - kmer_size + 1, 1):
-				all_kmers[record.id].append(str(record.seq[0 + i:kmer_size + i]))
+	for contig, sequence in files.FastaReader(filename):
+		all_kmers[contig] = []
+		for i in range(0, len(sequence) - kmer_size + 1, 1):
+			all_kmers[contig].append(sequence[0 + i:kmer_size + i])
 	return all_kmers
 
 
+def get_kmers_chunks(filename, kmer_size, chunk_size=KMER_CHUNK_SIZE, reader=None):
+	"""
+	Read in a fasta file and yield the packed kmers of each contig in chunks of at most
+	chunk_size kmers, so a whole genome is never held in memory as kmers.
+	Consecutive chunks of a contig share one kmer, allowing the edges to be linked
+	across chunk boundaries.
+	:param filename: Fasta file to process, plain or gzip compressed
+	:param kmer_size: Size of kmer
+	:param chunk_size: Maximum number of kmers in a chunk
+	:param reader: files.FastaReader of the file, whose hash can be taken once the
+	chunks are consumed
+	:return: Generator of (contig, numpy uint64 array of packed kmers)
+	"""
+	if not files.is_fasta(filename):
+		LOG.critical("Non fasta file detected")
+		sys.exit()
+
+	for contig, sequence in METRICS.iterate(reader or files.FastaReader(filename), "parse"):
+		for chunk in METRICS.iterate(kmers.get_kmers_sequence(sequence, kmer_size, chunk_size), "extract"):
+			yield contig, chunk
+
+
 def add_kmers_dict(kmer_dict, kmers):
 	"""
 	Updates a dictionary of kmer:uid.
@@ -292,112 +1229,722 @@ def add_kmers_dict(kmer_dict, kmers):
 	return kmer_dict
 
 
-def add_kmers_dgraph(client, all_kmers, genome):
+def add_kmers_dgraph(client, all_kmers, genome, kmer_size=None, progress=None):
 	"""
 	Add all kmers from a given genome to the graph
 	:param client: dgraph client
-	:param all_kmers: dict of lists of all kmers in genome dict[contig:[kmers]]
+	:param all_kmers: dict of lists of all kmers in genome dict[contig:[kmers]],
+	or an iterable of (contig, packed kmers) chunks as from get_kmers_chunks()
 	:param genome: name of genome to add
+	:param kmer_size: Size of kmer, required when the kmers are packed
+	:param progress: manifest.Manifest recording each chunk added, chunks it already
+	lists are skipped
+	:return: list of contig segments, each a dict of contig_id, contig_length and
+	the first and last packed kmer; a contig split by ambiguous bases has one segment
+	for each unbroken run
+	"""
+	if isinstance(all_kmers, dict):
+		all_kmers = all_kmers.items()
+
+	chunk_counts = {}
+	segments = {}
+	contigs = []
+	for contig, kmer_list in all_kmers:
+		if not isinstance(kmer_list, np.ndarray):
+			kmer_size = len(kmer_list[0])
+			kmer_list = kmers.encode_kmers(kmer_list)
+
+		add_contig_segment(segments, contigs, contig, kmer_list, kmer_size)
+		chunk = chunk_counts.get(contig, 0)
+		chunk_counts[contig] = chunk + 1
+		if progress and progress.is_chunk_done(genome, contig, chunk):
+			continue
+		get_kmers_contig(kmer_list, client, genome, kmer_size)
+		if progress:
+			progress.add_chunk(genome, contig, chunk)
+
+	return contigs
+
+
+def add_contig_segment(segments, contigs, contig, kmer_array, kmer_size):
+	"""
+	Extend the contig segments of a genome with its next chunk of kmers.
+	Chunks of one run share a kmer, a chunk that does not starts a new segment.
+	:param segments: dict{contig:its current segment}, updated
+	:param contigs: list of contig segments, appended to
+	:param contig: contig id of the chunk
+	:param kmer_array: numpy array of the packed kmers of the chunk
+	:param kmer_size: Size of kmer
 	:return: None
 	"""
+	segment = segments.get(contig)
+	if segment is None or segment['last'] != int(kmer_array[0]):
+		segment = {'contig_id': contig, 'contig_length': kmer_size - 1, 'first': int(kmer_array[0])}
+		segments[contig] = segment
+		contigs.append(segment)
+		segment['contig_length'] += len(kmer_array)
+	else:
+		segment['contig_length'] += len(kmer_array) - 1
+	segment['last'] = int(kmer_array[-1])
 
-	dict_values = all_kmers.values()
-	kmers = list(dict_values)
-	for x, i in enumerate(kmers):
-		kmer_list = kmers[x]
-		get_kmers_contig(kmer_list, client, genome)
 
-def get_kmers_contig(ckmers, client, genome):
+def add_metadata_dgraph(client, genome, filename, kmer_size, contigs, end_uids=None, node_quads=None):
+	"""
+	Add a metadata node for a genome, holding its hash, source file, kmer size and a
+	node for each contig with its id, length and the uids of its first and last kmers.
+	:param client: dgraph client
+	:param genome: The genome name in the form genome_hash
+	:param filename: The fasta file the genome was read from
+	:param kmer_size: Size of kmer
+	:param contigs: contig segments as returned by add_kmers_dgraph()
+	:param end_uids: uids of the first and last node of each contig in turn, looked up
+	from the first and last kmers of the segments when not given
+	:param node_quads: dict{uid:N-Quad} from get_node_quads() of the end_uids, required
+	with them
+	:return: uid of the metadata node
+	"""
+	if end_uids is None:
+		# Resolve the uids of the first and last kmers of each contig
+		ends = np.array([c[end] for c in contigs for end in ('first', 'last')], dtype=np.uint64)
+		nodes = kmers.get_canonical_kmers(ends, kmer_size)[0] if CANONICAL else ends
+		unique_nodes = np.unique(nodes)
+		kmer_uid_dict = KMER_CACHE.get_uids(unique_nodes.tolist())
+		missing = get_kmers_missing(unique_nodes, kmer_uid_dict)
+		if len(missing):
+			kmer_uid_dict = add_kmers_dict(kmer_uid_dict, query_kmers_dgraph(client, missing, kmer_size))
+		end_uids = [kmer_uid_dict[node] for node in nodes.tolist()]
+		node_quads = get_node_quads(end_uids, kmers.decode_kmers(nodes, kmer_size))
+
+	if isinstance(client, backend.Backend):
+		return client.add_metadata(genome, filename, kmer_size, CANONICAL, contigs, end_uids)
+
+	# The node may already exist, holding the genome_index for the next edges, or the
+	# contigs of an earlier load of the genome, which are deleted with the same transaction
+	metadata = query_metadata_dgraph(client, genome)
+	subject = '<{0}>'.format(metadata['uid']) if metadata else '_:genome'
+	genome_quads = get_metadata_quads(subject, genome, filename, kmer_size, CANONICAL)
+	del_quads = ''.join('{0} <contigs> <{1}> .\n<{1}> * * .\n'.format(subject, contig['uid'])
+						for contig in (metadata or {}).get('contigs', []))
+	txn = client.txn()
+	try:
+		METRICS.add("requests", 2)
+		METRICS.add("bytes_sent", len(genome_quads) + len(del_quads))
+		uids = txn.mutate(set_nquads=genome_quads, del_nquads=del_quads or None).uids
+		with METRICS.time("commit"):
+			txn.commit()
+	finally:
+		txn.discard()
+	genome_uid = metadata['uid'] if metadata else uids['genome']
+
+	# Each contig's quads are kept together, so its blank node is never split across batches
+	contig_quads = []
+	for i, contig in enumerate(contigs):
+		contig_quads.append((get_contig_quads('<{0}>'.format(genome_uid), '_:c{0}'.format(i), i, contig,
+											  '<{0}>'.format(end_uids[2 * i]), '<{0}>'.format(end_uids[2 * i + 1])),
+							 end_uids[2 * i], end_uids[2 * i + 1]))
+	add_quads_dgraph(client, contig_quads, node_quads=node_quads)
+	return genome_uid
+
+
+def get_metadata_quads(subject, genome, filename, kmer_size, canonical):
+	"""
+	Create the N-Quads of a genome's metadata node, shared by add_metadata_dgraph() and
+	the offline RDF export
+	:param subject: The metadata node, as a uid or blank node
+	:param genome: The genome name in the form genome_hash
+	:param filename: The fasta file the genome was read from
+	:param kmer_size: Size of kmer
+	:param canonical: Whether the kmers are canonical
+	:return: N-Quads string
+	"""
+	return ''.join([
+		'{0} <genome_hash> "{1}" .\n'.format(subject, genome[len("genome_"):]),
+		'{0} <filename> {1} .\n'.format(subject, json.dumps(filename)),
+		'{0} <kmer_size> "{1}" .\n'.format(subject, kmer_size),
+		'{0} <canonical> "{1}" .\n'.format(subject, str(canonical).lower()),
+	])
+
+
+def get_contig_quads(genome_subject, subject, index, contig, first, last):
+	"""
+	Create the N-Quads of a contig node of a genome's metadata
+	:param genome_subject: The metadata node, as a uid or blank node
+	:param subject: The contig node, as a blank node
+	:param index: Position of the contig in the genome
+	:param contig: contig segment holding its contig_id and contig_length
+	:param first: The node of the contig's first kmer, as a uid or blank node
+	:param last: The node of the contig's last kmer, as a uid or blank node
+	:return: N-Quads string
+	"""
+	return ''.join([
+		'{0} <contigs> {1} .\n'.format(genome_subject, subject),
+		'{0} <contig_index> "{1}" .\n'.format(subject, index),
+		'{0} <contig_id> {1} .\n'.format(subject, json.dumps(contig['contig_id'])),
+		'{0} <contig_length> "{1}" .\n'.format(subject, contig['contig_length']),
+		'{0} <first_kmer> {1} .\n'.format(subject, first),
+		'{0} <last_kmer> {1} .\n'.format(subject, last),
+	])
+
+
+def query_metadata_dgraph(client, genome):
+	"""
+	Get the metadata node of a genome
+	:param client: dgraph client
+	:param genome: The genome name in the form genome_hash
+	:return: dict of the genome metadata with its contigs in order, or None
+	"""
+	if isinstance(client, backend.Backend):
+		return client.query_metadata(genome)
+
+	query = """
+	query meta($hash: string){
+	meta(func: eq(genome_hash, $hash)){
+		uid
+		genome_hash
+		filename
+		kmer_size
+		contigs(orderasc: contig_index){
+			uid
+			contig_id
+			contig_length
+			first_kmer{
+				uid
+				kmer
+				unitig
+			}
+			last_kmer{
+				uid
+				kmer
+				unitig
+			}
+		}
+	}
+	}
+	"""
+	variables = {'$hash': genome[len("genome_"):]}
+	res = client.query(query, variables=variables)
+	json_res = json.loads(res.json)
+
+	if json_res['meta']:
+		return json_res['meta'][0]
+	else:
+		return None
+
+def get_kmers_contig(ckmers, client, genome, kmer_size=None):
 	"""
 	Process a single contig into kmers, adding nodes and edges for each
-	:param ckmers: The list of kmers for the contig
+	:param ckmers: The packed kmers for the contig, or a list of kmer strings
 	:param client: dgraph client
 	:param genome: indexed edge genome name
+	:param kmer_size: Size of kmer, required when the kmers are packed
 	:return: success
 	"""
-	# Query for all existing kmers
-	kmer_uid_dict = {}
-	kmer_uid_dict = add_kmers_dict(kmer_uid_dict, query_kmers_dgraph(client, ckmers))
-
-	# Create list of kmers that need to be batch inserted into graph
-	kmers_to_insert = []
-	for kmer in ckmers:
-		if kmer not in kmer_uid_dict:
-			kmers_to_insert.append(kmer)
-	#print(kmers_to_insert)
-	if kmers_to_insert:
+	if not isinstance(ckmers, np.ndarray):
+		kmer_size = len(ckmers[0])
+		ckmers = kmers.encode_kmers(ckmers)
+	METRICS.add("kmers", len(ckmers))
+
+	forward = None
+	if CANONICAL:
+		ckmers, forward = kmers.get_canonical_kmers(ckmers, kmer_size)
+
+	if WRITE_MODE == WRITE_UPSERT:
+		print('.', end='')
+		return add_kmers_upsert_dgraph(client, ckmers, genome, kmer_size, forward)
+
+	kmer_uid_dict, kmers_to_insert = get_kmers_uids(client, ckmers, kmer_size)
+	if len(kmers_to_insert):
 		# Bulk insert the kmers
-		txn_result_dict = add_kmers_batch_dgraph(client, kmers_to_insert)
-		# Update the dict of kmer:uid
-		kmer_uid_dict = add_kmers_dict(kmer_uid_dict, txn_result_dict)
+		add_kmers_uids(client, kmers_to_insert, kmer_size, kmer_uid_dict)
 
 	# Batch the connections between the kmers
 	# Creates a list of quads that need to be added later
 	print('.', end='')
-	return(add_edges_kmers(client, ckmers, kmer_uid_dict, genome))
+	with METRICS.time("edge_insert"):
+		return(add_edges_kmers(client, ckmers, kmer_uid_dict, genome, kmer_size, forward))
+
+
+def get_kmers_uids(client, kmer_array, kmer_size):
+	"""
+	Resolve what we can from the cache, and only query dgraph for the rest.
+	Kmers the kmer filter has never seen are not in the graph, so are not queried.
+	:param client: dgraph client
+	:param kmer_array: numpy array of packed kmers
+	:param kmer_size: Size of kmer
+	:return: dict{kmer:uid} of the kmers in the graph, and a numpy array of the
+	distinct kmers that are not
+	"""
+	unique_kmers = np.unique(kmer_array)
+	kmer_uid_dict = KMER_CACHE.get_uids(unique_kmers.tolist())
+	kmers_to_query = get_kmers_missing(unique_kmers, kmer_uid_dict)
+	kmers_absent = kmers_to_query[:0]
+	if KMER_FILTER is not None and len(kmers_to_query):
+		maybe_present = KMER_FILTER.contains(kmers_to_query)
+		kmers_absent = kmers_to_query[~maybe_present]
+		kmers_to_query = kmers_to_query[maybe_present]
+		METRICS.add("filter_skips", len(kmers_absent))
+	if len(kmers_to_query):
+		with METRICS.time("lookup"):
+			query_result = query_kmers_dgraph(client, kmers_to_query, kmer_size)
+		KMER_CACHE.add_kmers(query_result)
+		kmer_uid_dict = add_kmers_dict(kmer_uid_dict, query_result)
+	return kmer_uid_dict, np.concatenate((kmers_absent, get_kmers_missing(kmers_to_query, kmer_uid_dict)))
+
+
+def add_kmers_uids(client, kmer_array, kmer_size, kmer_uid_dict):
+	"""
+	Insert new kmer nodes, caching their uids and adding them to a kmer:uid dict
+	:param client: dgraph client
+	:param kmer_array: numpy array of distinct packed kmers not in the graph
+	:param kmer_size: Size of kmer
+	:param kmer_uid_dict: {kmer:uid}, updated
+	:return: List of {'kmer':kmer, 'uid':uid} of the new nodes
+	"""
+	with METRICS.time("node_insert"):
+		txn_result_dict = add_kmers_batch_dgraph(client, kmer_array, kmer_size)
+	KMER_CACHE.add_kmers(txn_result_dict)
+	add_kmers_dict(kmer_uid_dict, txn_result_dict)
+	return txn_result_dict
+
+
+def add_kmers_upsert_dgraph(client, kmer_array, genome, kmer_size, forward=None):
+	"""
+	Add a contig's kmers and the edges between them in one upsert per batch.
+	Each kmer node is found by its kmer value in the upsert query and is created only
+	if it does not exist, so no separate lookup is needed. The upsert is idempotent,
+	and concurrent writers of the same kmer conflict on the @upsert index and are retried.
+	:param client: dgraph client
+	:param kmer_array: numpy array of linked packed kmers
+	:param genome: the indexed edge name to connect the kmer nodes
+	:param kmer_size: Size of kmer
+	:param forward: numpy bool array of the strand of each canonical kmer, if canonical
+	:return: None
+	"""
+	if KMER_FILTER is not None:
+		KMER_FILTER.add(kmer_array)
+	# Rough bytes per kmer for the query variable, the kmer quad and the edge quad
+	step = max(2, min(BATCH_SIZE, BATCH_BYTES // (150 + 2 * kmer_size)))
+	for start in range(0, max(len(kmer_array) - 1, 1), step - 1):
+		batch = kmer_array[start:start + step]
+		batch_forward = forward[start:start + step] if forward is not None else None
+		query, nquads = get_upsert_dgraph(batch, genome, kmer_size, batch_forward)
+		for attempt in range(MAX_RETRIES + 1):
+			txn = client.txn()
+			try:
+				mutation = txn.create_mutation(set_nquads=nquads)
+				request = txn.create_request(query=query, mutations=[mutation], commit_now=True)
+				METRICS.add("requests")
+				METRICS.add("bytes_sent", len(query) + len(nquads))
+				with METRICS.time("edge_insert"):
+					txn.do_request(request)
+				break
+			except pydgraph.AbortedError:
+				METRICS.add("aborts")
+				if attempt == MAX_RETRIES:
+					raise
+				LOG.debug("Upsert aborted, retrying")
+				time.sleep(RETRY_DELAY * 2 ** attempt)
+			finally:
+				txn.discard()
+
+
+def get_upsert_dgraph(kmer_array, genome, kmer_size, forward=None):
+	"""
+	Create the upsert block for add_kmers_upsert_dgraph().
+	Every distinct kmer gets a query variable holding its node, if it exists.
+	:param kmer_array: numpy array of linked packed kmers
+	:param genome: the indexed edge name to connect the kmer nodes
+	:param kmer_size: Size of kmer
+	:param forward: numpy bool array of the strand of each canonical kmer, if canonical
+	:return: query string, N-Quads string
+	"""
+	facets = get_orientation_facets(forward, len(kmer_array))
+	unique_kmers, index = np.unique(kmer_array, return_inverse=True)
+	kmer_list = kmers.decode_kmers(unique_kmers, kmer_size)
+
+	query = ['{\n']
+	nquads = []
+	for i, kmer in enumerate(kmer_list):
+		query.append('k{0} as var(func: eq(kmer, "{1}"))\n'.format(i, kmer))
+		nquads.append('uid(k{0}) <kmer> "{1}" .\n'.format(i, kmer))
+	query.append('}')
+
+	index = index.ravel().tolist()
+	for i in range(0, len(index) - 1):
+		nquads.append('uid(k{0}) <{1}> uid(k{2}){3} .\n'.format(index[i], genome, index[i + 1], facets[i]))
+
+	return ''.join(query), ''.join(nquads)
+
+
+def get_orientation_facets(forward, length):
+	"""
+	Create the orientation facet for each edge between consecutive kmers
+	:param forward: numpy bool array of the strand of each canonical kmer, or None
+	:param length: Number of kmers
+	:return: list of facet strings, empty when not canonical
+	"""
+	if forward is None:
+		return [''] * length
+	strands = ['+' if f else '-' for f in forward.tolist()]
+	return [' (orientation="{0}{1}")'.format(strands[i], strands[i + 1]) for i in range(len(strands) - 1)] + ['']
+
+
+def get_kmers_missing(kmer_array, kmer_uid_dict):
+	"""
+	Find the kmers that do not yet have a uid
+	:param kmer_array: numpy array of packed kmers
+	:param kmer_uid_dict: {kmer:uid}
+	:return: numpy array of the packed kmers not in kmer_uid_dict
+	"""
+	found = np.fromiter(kmer_uid_dict.keys(), dtype=np.uint64, count=len(kmer_uid_dict))
+	return kmer_array[~np.isin(kmer_array, found)]
 
 
-def add_edges_kmers(client, kmers, kmer_uid_dict, genome):
+def add_edges_kmers(client, kmer_array, kmer_uid_dict, genome, kmer_size, forward=None):
 	"""
 	Given a list of previously inserted kmers, and the corresponding dictionary of the uids
 	create edges between all kmers, sequentially.
 	:param client: the dgraph client
-	:param kmers: list of linked kmers
+	:param kmer_array: numpy array of linked packed kmers
 	:param kmer_uid_dict: {kmer:uid}
 	:param genome: the indexed edge name to connect the kmer nodes
+	:param kmer_size: Size of kmer
+	:param forward: numpy bool array of the strand of each canonical kmer, if canonical
 	:return: None
 	"""
 
+	uids = [kmer_uid_dict[kmer] for kmer in kmer_array.tolist()]
+	if isinstance(client, backend.Backend):
+		if EDGE_MODEL == EDGE_NEXT:
+			return add_edges_next_dgraph(client, list(zip(uids, uids[1:])), get_genome_index(client, genome))
+		orientations = [f[-4:-2] for f in get_orientation_facets(forward, len(uids))[:-1]] if forward is not None else None
+		return client.add_edges(genome, uids, orientations)
+
+	unique_kmers = np.unique(kmer_array)
+	node_quads = get_node_quads([kmer_uid_dict[kmer] for kmer in unique_kmers.tolist()],
+								kmers.decode_kmers(unique_kmers, kmer_size))
+	if EDGE_MODEL == EDGE_NEXT:
+		return add_edges_next_dgraph(client, list(zip(uids, uids[1:])), get_genome_index(client, genome),
+									 node_quads=node_quads)
+
+	facets = get_orientation_facets(forward, len(uids))
 	bulk_quads = []
-	# We are adding sequential kmers, so we need only start at index len(kmer)-2 to
-	# ensure that all kmers are linked
-	for i in range(0, len(kmers) - 2):
-		bulk_quads.append('<{0}> <{1}> <{2}> .{3}'.format(kmer_uid_dict[kmers[i]],
-														  genome,
-														  kmer_uid_dict[kmers[i + 1]],
-														  "\n"
-													  ))
-
-
-	#print(bulk_quads)
-	# Start the transaction
-	txn = client.txn()
+	# Link each kmer to the one following it
+	for i in range(0, len(uids) - 1):
+		bulk_quads.append(('<{0}> <{1}> <{2}>{3} .{4}'.format(uids[i], genome, uids[i + 1], facets[i], "\n"),
+						   uids[i], uids[i + 1]))
 
-	try:
-		m = txn.mutate(set_nquads=''.join(bulk_quads))
-		txn.commit()
+	add_quads_dgraph(client, bulk_quads, node_quads=node_quads)
 
-	finally:
-		txn.discard()
 
+def get_node_quads(uids, values, predicate="kmer"):
+	"""
+	Create the N-Quads setting again the kmer, or unitig, of nodes already in the graph.
+	A transaction adding edges to nodes that were looked up before it started writes
+	these along with them. A concurrent delete of one of the nodes then writes the same
+	@upsert index key, so one of the two is aborted, and a node deleted before the
+	transaction started gets its value back with the edge, rather than being left an
+	edge target with no kmer.
+	:param uids: list of node uids
+	:param values: list of the kmer or unitig of each node
+	:param predicate: "kmer" or "unitig"
+	:return: dict{uid:N-Quad}
+	"""
+	return dict((uid, '<{0}> <{1}> "{2}" .\n'.format(uid, predicate, value)) for uid, value in zip(uids, values))
 
-def add_kmers_batch_dgraph(client, kmer_list):
+
+def add_kmers_batch_dgraph(client, kmer_array, kmer_size):
 	"""
 	Add all the kmers in the list to the graph.
 	Return the results from the transaction in the requires list of dict format.
 	:param client: dgraph client
-	:param kmer_list: list of kmers that need to be added to new nodes
-	:return: List of {'kmer':kmer, 'uid':uid}
+	:param kmer_array: numpy array of packed kmers that need to be added to new nodes
+	:param kmer_size: Size of kmer
+	:return: List of {'kmer':kmer, 'uid':uid} with the kmers packed
+	"""
+	# Added before the insert, so no other thread can find the filter missing a kmer in the graph
+	if KMER_FILTER is not None:
+		KMER_FILTER.add(kmer_array)
+	if isinstance(client, backend.Backend):
+		return client.add_kmers(kmer_array, kmer_size)
+
+	bulk_quads = get_kmers_quads(kmer_array, kmer_size)
+
+	# Create the output in the form that the program is expecting
+	kmer_dict_list = []
+	start = 0
+	for batch in get_batches(bulk_quads):
+		batch_kmers = kmer_array[start:start + len(batch)]
+		start += len(batch)
+		for attempt in range(MAX_RETRIES + 1):
+			try:
+				kmer_dict_list.extend(add_kmers_txn_dgraph(client, batch_kmers, batch, kmer_size))
+				break
+			except pydgraph.AbortedError:
+				METRICS.add("aborts")
+				if attempt == MAX_RETRIES:
+					raise
+				# A concurrent writer inserted some of these kmers first; the retry finds its nodes
+				LOG.debug("Kmer insert aborted, retrying")
+				time.sleep(RETRY_DELAY * 2 ** attempt)
+	return kmer_dict_list
+
+
+def add_kmers_txn_dgraph(client, kmer_array, quads, kmer_size):
+	"""
+	Add the kmers of a batch not yet in the graph, looking them up in the same
+	transaction as the insert. A concurrent writer of one of the kmers has either
+	committed before the transaction started, so its node is found, or commits while
+	it runs, so both write the kmer's @upsert index key and one of them is aborted.
+	:param client: dgraph client
+	:param kmer_array: numpy array of packed kmers
+	:param quads: N-Quad of each kmer, from get_kmers_quads()
+	:param kmer_size: Size of kmer
+	:return: List of {'kmer':kmer, 'uid':uid} for every kmer of the batch
+	"""
+	txn = client.txn()
+	try:
+		found = query_kmers_txn(txn, kmer_array, kmer_size)
+		found_kmers = set(ku['kmer'] for ku in found)
+		nquads = ''.join(quad for quad, packed in zip(quads, kmer_array.tolist()) if packed not in found_kmers)
+		uids = {}
+		if nquads:
+			METRICS.add("requests", 2)
+			METRICS.add("bytes_sent", len(nquads))
+			uids = txn.mutate(set_nquads=nquads).uids
+			with METRICS.time("commit"):
+				txn.commit()
+	finally:
+		txn.discard()
+	return found + [{'kmer': int(uid[1:]), 'uid': uids[uid]} for uid in uids]
+
+
+def get_kmers_quads(kmer_array, kmer_size):
+	"""
+	Create the N-Quads for new kmer nodes.
+	The blank node is named for the packed kmer, so the same kmer always has the same
+	blank node, within a mutation or across the files of an offline bulk load.
+	:param kmer_array: numpy array of packed kmers
+	:param kmer_size: Size of kmer
+	:return: list of N-Quad strings
 	"""
-	# Data to be inserted
 	bulk_quads = []
-	for kmer in kmer_list:
-		bulk_quads.append('_:{0} <kmer> "{0}" .{1}'.format(kmer, "\n"))
-	#print(bulk_quads)
+	for packed, kmer in zip(kmer_array.tolist(), kmers.decode_kmers(kmer_array, kmer_size)):
+		bulk_quads.append('_:k{0} <kmer> "{1}" .{2}'.format(packed, kmer, "\n"))
+	return bulk_quads
+
 
+def get_batches(quads, batch_size=None, batch_bytes=None):
+	"""
+	Split a list of quads into batches bounded by both count and size
+	:param quads: list of N-Quad strings
+	:param batch_size: maximum quads per batch, defaults to BATCH_SIZE
+	:param batch_bytes: maximum bytes per batch, defaults to BATCH_BYTES
+	:return: Generator of lists of quads
+	"""
+	batch_size = batch_size or BATCH_SIZE
+	batch_bytes = batch_bytes or BATCH_BYTES
+
+	batch = []
+	size = 0
+	for quad in quads:
+		if batch and (len(batch) >= batch_size or size + len(quad) > batch_bytes):
+			yield batch
+			batch = []
+			size = 0
+		batch.append(quad)
+		size += len(quad)
+	if batch:
+		yield batch
+
+
+def get_linked_batches(quads, node_quads, batch_size=None, batch_bytes=None):
+	"""
+	Split a list of edge quads into batches as get_batches() does, adding to each batch
+	the N-Quads of the nodes its edges link, once per batch
+	:param quads: list of (N-Quad string, source uid, target uid)
+	:param node_quads: dict{uid:N-Quad} from get_node_quads()
+	:param batch_size: maximum quads per batch, defaults to BATCH_SIZE
+	:param batch_bytes: maximum bytes per batch, defaults to BATCH_BYTES
+	:return: Generator of lists of quads
+	"""
+	batch_size = batch_size or BATCH_SIZE
+	batch_bytes = batch_bytes or BATCH_BYTES
+
+	batch = []
+	nodes = set()
+	size = 0
+	for quad, source, target in quads:
+		# The edge adds at most three quads, with its nodes
+		largest = len(quad) + len(node_quads[source]) + len(node_quads[target])
+		if batch and (len(batch) + 3 > batch_size or size + largest > batch_bytes):
+			yield batch
+			batch = []
+			nodes = set()
+			size = 0
+		batch.append(quad)
+		size += len(quad)
+		for uid in (source, target):
+			if uid not in nodes:
+				nodes.add(uid)
+				batch.append(node_quads[uid])
+				size += len(node_quads[uid])
+	if batch:
+		yield batch
+
+
+def add_nquads_dgraph(client, nquads, delete=False):
+	"""
+	Add N-Quads to the graph in a single transaction
+	:param client: dgraph client
+	:param nquads: N-Quads as a single string
+	:param delete: Delete the N-Quads from the graph instead
+	:return: dict{blank node:uid}
+	"""
 	# start the transaction
 	txn = client.txn()
 
 	try:
-		m = txn.mutate(set_nquads=''.join(bulk_quads))
-		txn.commit()
-		# Create the output in the form that the program is expecting
-		kmer_dict_list = []
-		for uid in m.uids:
-			kmer_dict_list.append({'kmer': uid, 'uid': m.uids[uid]})
+		METRICS.add("requests", 2)
+		METRICS.add("bytes_sent", len(nquads))
+		if delete:
+			m = txn.mutate(del_nquads=nquads)
+		else:
+			m = txn.mutate(set_nquads=nquads)
+		with METRICS.time("commit"):
+			txn.commit()
 	finally:
 		txn.discard()
-	return kmer_dict_list
+	return m.uids
+
+
+def add_quads_dgraph(client, quads, delete=False, node_quads=None):
+	"""
+	Add N-Quads to the graph, committing each batch from get_batches() in its own
+	transaction so that no single request or transaction grows with the contig.
+	A batch aborted by a conflicting writer is retried, so the quads must be safe
+	to apply twice.
+	:param client: dgraph client
+	:param quads: list of N-Quad strings, or of (N-Quad string, source uid, target uid)
+	with node_quads
+	:param delete: Delete the N-Quads from the graph instead
+	:param node_quads: dict{uid:N-Quad} from get_node_quads(), written along with each
+	batch for the nodes its quads link, see get_linked_batches()
+	:return: dict{blank node:uid} over all batches
+	"""
+	uids = {}
+	for batch in (get_batches(quads) if node_quads is None else get_linked_batches(quads, node_quads)):
+		for attempt in range(MAX_RETRIES + 1):
+			try:
+				uids.update(add_nquads_dgraph(client, ''.join(batch), delete))
+				break
+			except pydgraph.AbortedError:
+				METRICS.add("aborts")
+				if attempt == MAX_RETRIES:
+					raise
+				LOG.debug("Mutation aborted, retrying")
+				time.sleep(RETRY_DELAY * 2 ** attempt)
+	return uids
+
+def query_unitigs_dgraph(client, sequences):
+	"""
+	Find the nodes of unitigs already in the graph
+	:param client: dgraph client
+	:param sequences: list of unitig sequences
+	:return: dict{sequence:uid} of the unitigs found
+	"""
+	query = """
+	{{
+	find_all(func: eq(unitig, {0}))
+	{{
+	uid
+	unitig
+	}}
+	}}
+	""".format(json.dumps(sequences))
+	res = client.query(query)
+	return {node['unitig']: node['uid'] for node in json.loads(res.json)['find_all']}
+
+
+def add_unitigs_dgraph(client, sequences):
+	"""
+	Add a node for each unitig not yet in the graph. A unitig already stored, by this
+	batch or an earlier one, is reused.
+	:param client: dgraph client
+	:param sequences: list of distinct unitig sequences
+	:return: dict{sequence:uid} for every sequence
+	"""
+	unitig_uid_dict = {}
+	for batch in get_batches(sequences):
+		for attempt in range(MAX_RETRIES + 1):
+			unitig_uid_dict.update(query_unitigs_dgraph(client, batch))
+			batch = [sequence for sequence in batch if sequence not in unitig_uid_dict]
+			if not batch:
+				break
+			quads = ''.join('_:u{0} <unitig> "{1}" .\n'.format(i, sequence) for i, sequence in enumerate(batch))
+			try:
+				uids = add_nquads_dgraph(client, quads)
+				unitig_uid_dict.update((sequence, uids['u{0}'.format(i)]) for i, sequence in enumerate(batch))
+				break
+			except pydgraph.AbortedError:
+				METRICS.add("aborts")
+				if attempt == MAX_RETRIES:
+					raise
+				# A concurrent writer inserted some of these unitigs first
+				LOG.debug("Unitig insert aborted, retrying")
+				time.sleep(RETRY_DELAY * 2 ** attempt)
+	return unitig_uid_dict
+
+
+def add_genome_unitig_dgraph(client, genome, filepath, contig_paths, unitig_uid_dict, kmer_size, progress=None):
+	"""
+	Add the edges of a genome's path over unitigs already in the graph, and its metadata
+	:param client: dgraph client
+	:param genome: The genome name in the form genome_hash
+	:param filepath: The absolute path to the fasta file
+	:param contig_paths: [(contig, [unitig sequences])] as from unitig.get_genomes_unitigs()
+	:param unitig_uid_dict: dict{sequence:uid} from add_unitigs_dgraph()
+	:param kmer_size: Size of kmer
+	:param progress: manifest.Manifest to record the genome in
+	:return: genome name
+	"""
+	add_genome_to_schema(client, genome)
+	quads = []
+	contigs = []
+	end_uids = []
+	node_quads = {}
+	for contig, path in contig_paths:
+		uids = [unitig_uid_dict[sequence] for sequence in path]
+		node_quads.update(get_node_quads(uids, path, "unitig"))
+		for i in range(0, len(uids) - 1):
+			quads.append(('<{0}> <{1}> <{2}> .\n'.format(uids[i], genome, uids[i + 1]), uids[i], uids[i + 1]))
+		length = sum(len(sequence) for sequence in path) - (len(path) - 1) * (kmer_size - 1)
+		contigs.append({'contig_id': contig, 'contig_length': length})
+		end_uids.extend((uids[0], uids[-1]))
+
+	add_quads_dgraph(client, quads, node_quads=node_quads)
+	add_metadata_dgraph(client, genome, filepath, kmer_size, contigs, end_uids, node_quads)
+	METRICS.add("genomes")
+	if progress:
+		progress.add_genome(genome, filepath)
+	return genome
+
+
+def add_genomes_unitig_dgraph(client, genomes, kmer_size, progress=None):
+	"""
+	Compact a batch of genomes into unitigs, and add the unitigs and genome paths
+	:param client: dgraph client
+	:param genomes: list of (genome, filepath, [(contig, packed kmers)])
+	:param kmer_size: Size of kmer
+	:param progress: manifest.Manifest to record each genome in
+	:return: None
+	"""
+	paths, sequences = unitig.get_genomes_unitigs({genome: all_kmers for genome, filepath, all_kmers in genomes}, kmer_size)
+	LOG.info("Compacted {0} genomes into {1} unitigs".format(len(genomes), len(sequences)))
+	unitig_uid_dict = add_unitigs_dgraph(client, sequences)
+	for genome, filepath, all_kmers in genomes:
+		add_genome_unitig_dgraph(client, genome, filepath, paths[genome], unitig_uid_dict, kmer_size, progress)
+
 
 def add_kmer_to_graph(client, ki, kn, genome):
 	"""
@@ -497,87 +2044,416 @@ def execute_args(client, opt):
 	:param return: none
 	'''
 	if opt.insert:
-		dgraph.insert_genome(client, opt.insert)
+		dgraph.insert_genome(client, opt.insert, opt.kmer_size)
 	if opt.query:
 		dgraph.query_for_genome(client, opt.query)
 	if opt.delete:
 		dgraph.delete_genome(client, opt.delete)
 
-def insert_genome(client, genomes):
+def insert_genome(client, genomes, kmer_size=11):
 	"""
 	Function which inserts genome(s) into the graph based on a commandline argument.
 	A list of genomes can be given as well
 	:param client: The dgraph client
 	:param genomes: Either a single genome or a list of genomes to be inserted
+	:param kmer_size: Size of kmer
 	:param return: none
 	"""
+	check_kmer_size_dgraph(client, kmer_size)
+	unitig_genomes = []
 	for genome in genomes:
 		filename = os.path.abspath("data/genomes/insert/{}".format(genome))
-		genome = "genome_" + compute_hash(filename)
-		add_genome_to_schema(client, genome)
-		all_kmers = kmer_from_file(filename, 11)
-		add_all_kmers_to_graph(client, all_kmers, genome)
+		genome = "genome_" + commandline.compute_hash(filename)
+		all_kmers = get_kmers_chunks(filename, kmer_size)
+		if UNITIGS:
+			unitig_genomes.append((genome, filename, list(all_kmers)))
+		else:
+			add_genome_dgraph(client, genome, filename, all_kmers, kmer_size)
+	if unitig_genomes:
+		add_genomes_unitig_dgraph(client, unitig_genomes, kmer_size)
 	print("inserted genome(s)")
 
 
 def query_for_genome(client, genomes):
 	"""
-	Function which deletes genome(s) into the graph based on a commandline argument.
+	Function which queries genome(s) in the graph based on a commandline argument.
 	A list of genomes can be given as well
 	:param client: The dgraph client
-	:param genomes: Either a single genome or a list of genomes to be deleted
-	:param return: none
+	:param genomes: Either a single genome or a list of genomes to be queried
+	:param return: list of the example_query() result of each genome
 	"""
+	results = []
 	for genome in genomes:
 		filename = os.path.abspath("data/genomes/insert/{}".format(genome)) # TODO change pathing and figure out metadata querying
-		genome = "genome_" + compute_hash(filename)
-		sg1 = example_query(client, genome)
-		print(sg1)
+		genome = "genome_" + commandline.compute_hash(filename)
+		results.append(example_query(client, genome))
+	return results
 
 def delete_genome(client, genomes):
 	"""
-	Function which queries for genome(s) in the graph based on a commandline argument.
+	Function which deletes genome(s) from the graph based on a commandline argument.
 	A list of genomes can be given as well
 	:param client: The dgraph client
-	:param genomes: Either a single genome or a list of genomes to be queried for
+	:param genomes: list of genomes, each a fasta file, a genome hash or a genome name
 	:param return: none
 	"""
 	for genome in genomes:
-		genome = "genome_" + compute_hash(filename)
+		delete_genome_dgraph(client, get_genome_name(genome))
+	print("deleted genome(s)")
+
+
+def get_genome_name(genome):
+	"""
+	:param genome: The path of a fasta file, a genome hash, or a genome name
+	:return: The genome name in the form genome_hash
+	"""
+	if os.path.isfile(genome):
+		return "genome_" + commandline.compute_hash(genome)
+	if genome.startswith("genome_"):
+		return genome
+	return "genome_" + genome
+
+
+def delete_genome_dgraph(client, genome, page_size=None):
+	"""
+	Remove a genome from the graph, along with the kmer nodes no other genome holds.
+	The genome's contigs are deleted first, so their first and last kmers are no
+	longer held by it. Its edges are then deleted a page at a time, and after each
+	page the kmers on it that are left without an edge out of them in any genome, or
+	a contig starting or ending at them, are deleted and evicted from the kmer cache.
+	Next edges have the genome's bit cleared, and are deleted once no genome is left
+	on them; the genome keeps its genome_index so the bit is not given to another.
+	With genome edges, a graph holding another genome with no metadata is refused.
+	:param client: dgraph client
+	:param genome: The genome name in the form genome_hash
+	:param page_size: Number of source kmers per page, defaults to BATCH_SIZE
+	:return: Number of kmer nodes deleted
+	"""
+	if isinstance(client, backend.Backend):
+		orphans = client.delete_genome(genome)
+		KMER_CACHE.discard(orphans.tolist())
+		LOG.info("Deleted {0} and {1} kmers held by no other genome".format(genome, len(orphans)))
+		return len(orphans)
+
+	if EDGE_MODEL == EDGE_NEXT:
+		genome_index = get_genome_index(client, genome)
+		genomes = []
+		# Walk the edges from the contigs' first kmers, read before the contigs are deleted
+		pages = query_genome_next_edges(client, genome, page_size,
+										get_first_kmers(query_metadata_dgraph(client, genome)))
+	else:
+		genomes = sorted(query_genomes_dgraph(client) - {genome})
+		# The last kmer of a contig has no edge out of it, and is only kept by the contig
+		unfinished = set(genomes) - query_metadata_genomes_dgraph(client)
+		if unfinished:
+			LOG.critical("Cannot delete {0}: {1} genomes, such as {2}, have no metadata to keep the kmers their "
+						 "contigs end at. Finish loading them, or bulk load the graph again from a new RDF "
+						 "export".format(genome, len(unfinished), min(unfinished)))
+			sys.exit()
+		pages = query_genome_predicate_edges(client, genome, page_size)
+	delete_metadata_dgraph(client, genome, keep_index=EDGE_MODEL == EDGE_NEXT)
+
+	deleted = 0
+	for page in pages:
+		uids = set()
+		quads = []
+		uid_pairs = []
+		for node in page:
+			uids.add(node['uid'])
+			quads.append('<{0}> <{1}> * .\n'.format(node['uid'], genome))
+			for target in node.get(genome, []):
+				uids.add(target['uid'])
+				uid_pairs.append((node['uid'], target['uid']))
+		if EDGE_MODEL == EDGE_NEXT:
+			add_edges_next_dgraph(client, uid_pairs, genome_index, remove=True)
+		else:
+			add_quads_dgraph(client, quads, delete=True)
+		deleted += delete_orphan_kmers_dgraph(client, sorted(uids), genomes)
+
+	if EDGE_MODEL == EDGE_NEXT:
+		GENOME_INDEXES.pop(genome, None)
+	else:
+		client.alter(pydgraph.Operation(drop_attr=genome))
+	LOG.info("Deleted {0} and {1} kmers held by no other genome".format(genome, deleted))
+	return deleted
+
+
+def delete_metadata_dgraph(client, genome, keep_index=False):
+	"""
+	Delete the metadata node of a genome and its contig nodes
+	:param client: dgraph client
+	:param genome: The genome name in the form genome_hash
+	:param keep_index: Keep the genome_hash and genome_index of the node
+	:return: None
+	"""
+	query = """
+	query meta($hash: string){
+	meta(func: eq(genome_hash, $hash)){
+		uid
+		contigs{
+			uid
+		}
+	}
+	}
+	"""
+	res = client.query(query, variables={'$hash': genome[len("genome_"):]})
+	quads = []
+	for metadata in json.loads(res.json)['meta']:
+		for contig in metadata.get('contigs', []):
+			quads.append('<{0}> * * .\n'.format(contig['uid']))
+		if keep_index:
+			quads.extend('<{0}> <{1}> * .\n'.format(metadata['uid'], predicate)
+						 for predicate in ('contigs', 'filename', 'kmer_size', 'canonical'))
+		else:
+			quads.append('<{0}> * * .\n'.format(metadata['uid']))
+	add_quads_dgraph(client, quads, delete=True)
+
+
+def delete_orphan_kmers_dgraph(client, uids, genomes):
+	"""
+	Delete the kmer or unitig nodes that no genome holds any more: with no genome edge
+	or next edge out of them, no next edge into them, and no contig starting or
+	ending at them.
+	Each batch is checked and deleted in one transaction. Deleting a node's kmer
+	writes the @upsert kmer index, so a batch conflicts with, and is retried after,
+	a concurrent insert of the same kmer. A concurrent load that found the node before
+	it was deleted sets its kmer again along with its edges, see get_node_quads(), so
+	it either conflicts with the delete or restores the node.
+	:param client: dgraph client
+	:param uids: list of candidate node uids
+	:param genomes: genome names whose edges still hold nodes
+	:return: Number of nodes deleted
+	"""
+	if EDGE_MODEL == EDGE_NEXT:
+		counts = "next_out: count(next)\nnext_in: count(~next)"
+	else:
+		counts = "\n".join("g{0}: count({1})".format(i, genome) for i, genome in enumerate(genomes))
+
+	deleted = 0
+	step = max(1, min(BATCH_SIZE, BATCH_BYTES // 20))
+	for start in range(0, len(uids), step):
+		query = """
+		{{
+		nodes(func: uid({0})) @filter(has(kmer) OR has(unitig)){{
+			uid
+			kmer
+			unitig
+			first: count(~first_kmer)
+			last: count(~last_kmer)
+			{1}
+		}}
+		}}
+		""".format(', '.join(uids[start:start + step]), counts)
+
+		for attempt in range(MAX_RETRIES + 1):
+			txn = client.txn()
+			try:
+				orphans = [node for node in json.loads(txn.query(query).json)['nodes']
+						   if not any(value for key, value in node.items() if key not in ('uid', 'kmer', 'unitig'))]
+				if orphans:
+					txn.mutate(del_nquads=''.join('<{0}> * * .\n'.format(node['uid']) for node in orphans))
+					txn.commit()
+				break
+			except pydgraph.AbortedError:
+				METRICS.add("aborts")
+				if attempt == MAX_RETRIES:
+					raise
+				LOG.debug("Kmer delete aborted, retrying")
+				time.sleep(RETRY_DELAY * 2 ** attempt)
+			finally:
+				txn.discard()
+
+		orphan_kmers = [node['kmer'] for node in orphans if 'kmer' in node]
+		if orphan_kmers:
+			KMER_CACHE.discard(kmers.encode_kmers(orphan_kmers).tolist())
+		deleted += len(orphans)
+	return deleted
+
+def get_metrics_gauges():
+	"""
+	:return: dict{gauge name:value} of the kmer cache and filter, for metrics.MetricsReporter
+	"""
+	stats = KMER_CACHE.stats()
+	gauges = {'kmer_cache_hit_rate': stats['hit_rate'], 'kmer_cache_size': stats['size']}
+	if KMER_FILTER is not None:
+		gauges['kmer_filter_fill'] = KMER_FILTER.get_fill()
+	return gauges
+
+
+def get_genomes_loaded(client, progress=None):
+	"""
+	Find the genomes that an incremental build can skip.
+	Only finished genomes are returned, so a genome interrupted part way is resumed
+	rather than skipped: those the manifest records, or without one those with a
+	metadata node, which every edge model writes last.
+	:param client: The dgraph client
+	:param progress: manifest.Manifest of the earlier builds
+	:return: set of genome names in the form genome_hash
+	"""
+	if progress:
+		return set(progress.genomes)
+	return query_metadata_genomes_dgraph(client)
 
-def create_graph(client, file, filepath):
+
+def create_graph(client, file, filepath, progress=None, skip_genomes=(), kmer_size=11):
 	"""
 	This function builds the graph by being repeatedly called by the main function.
 	A path to a fasta file to be inserted is given and the function breaks the file up into its
 	kmers and then adds those kmers to the graph with the genome name as an edge.
+	The genome name is the hash of the file, taken before its kmers are read, so the
+	kmers stream into the graph a chunk at a time rather than being held.
 	:param client: The dgraph client
 	:param file: The opened fasta file
 	:param filepath: The absolute path to the fasta file which is being inserted
+	:param progress: manifest.Manifest to resume from and record progress in
+	:param skip_genomes: genome names already in the graph, which are not inserted again
+	:param kmer_size: Size of kmer
 	"""
 	try:
 		LOG.info("Starting to create graph")
-		x = 0
 		filename = file.name
 		genome = "genome_" + commandline.compute_hash(filepath)
-		dgraph.add_genome_to_schema(client, genome)
-		all_kmers = dgraph.get_kmers_files(filename, 11)
-
-		dgraph.add_kmers_dgraph(client, all_kmers, genome)
+		if genome in skip_genomes or (progress and progress.is_genome_done(genome)):
+			LOG.info("Skipping {0}, already in the graph".format(filename))
+			METRICS.add("genomes_skipped")
+			return
+		all_kmers = dgraph.get_kmers_chunks(filename, kmer_size)
+		if UNITIGS:
+			dgraph.add_genomes_unitig_dgraph(client, [(genome, filepath, all_kmers)], kmer_size, progress)
+		else:
+			dgraph.add_genome_to_schema(client, genome)
+			contigs = dgraph.add_kmers_dgraph(client, all_kmers, genome, kmer_size, progress)
+			dgraph.add_metadata_dgraph(client, genome, filepath, kmer_size, contigs)
+			METRICS.add("genomes")
+			if progress:
+				progress.add_genome(genome, filepath)
 		LOG.info("Finished creating the graph")
-		sg1 = dgraph.example_query(client, genome)
-		kmer_list = []
-		for x in sg1:
-			if x == sg1[-1]:
-				dict = sg1[-1]
-				value = list(dict.values())
-				kmer = value[0]
-				last_kmer = kmer[0]
-				kmer_list.append(last_kmer["kmer"])
-			else:
-				kmer = x["kmer"]
-				kmer_list.append(kmer)
-		sg1 = path_query(client, genome)
-		print(sg1)
+		LOG.info("Kmer cache: {hits} hits, {misses} misses, {size} entries".format(**KMER_CACHE.stats()))
 	except Exception as e:
 		LOG.critical("Failed to create graph at file - {}".format(filename) + str(e))
 		sys.exit()
+
+
+def get_kmers_genome(filepath, kmer_size, skip_genomes=()):
+	"""
+	Hash a fasta file and extract all of its kmers.
+	Run in a worker process by create_graph_parallel(), as extraction is CPU bound.
+	Unless genomes are skipped, the file is hashed in the same pass as the kmers
+	are extracted.
+	:param filepath: The absolute path to the fasta file
+	:param kmer_size: Size of kmer
+	:param skip_genomes: genome names whose kmers are not extracted
+	:return: genome name, [(contig, packed kmers)] or None if skipped
+	"""
+	if skip_genomes:
+		genome = "genome_" + commandline.compute_hash(filepath)
+		if genome in skip_genomes:
+			return genome, None
+	reader = files.FastaReader(filepath)
+	all_kmers = list(get_kmers_chunks(filepath, kmer_size, reader=reader))
+	return "genome_" + reader.hexdigest(), all_kmers
+
+
+def add_genome_dgraph(client, genome, filepath, all_kmers, kmer_size, progress=None):
+	"""
+	Add the genome edge to the schema and insert its kmers.
+	Run in a worker thread by create_graph_parallel().
+	:param client: The dgraph client
+	:param genome: The genome name in the form genome_hash
+	:param filepath: The absolute path to the fasta file
+	:param all_kmers: [(contig, packed kmers)]
+	:param kmer_size: Size of kmer
+	:param progress: manifest.Manifest to resume from and record progress in
+	:return: genome name
+	"""
+	add_genome_to_schema(client, genome)
+	contigs = add_kmers_dgraph(client, all_kmers, genome, kmer_size, progress)
+	add_metadata_dgraph(client, genome, filepath, kmer_size, contigs)
+	METRICS.add("genomes")
+	if progress:
+		progress.add_genome(genome, filepath)
+	return genome
+
+
+def check_unitig_bytes(filepaths):
+	"""
+	Exit if the fasta files are too large to compact into unitigs in one load, as the
+	kmers of every genome are held in memory at once.
+	:param filepaths: The absolute paths to the fasta files to insert
+	:return: None
+	"""
+	size = sum(os.path.getsize(filepath) * (4 if filepath.endswith(files.COMPRESSED_EXTENSIONS) else 1)
+			   for filepath in filepaths)
+	if size > UNITIG_MAX_BYTES:
+		LOG.critical("Cannot compact {0} bytes of fasta files into unitigs, as every genome is held in memory "
+					 "at once. Load at most {1} bytes, or raise --unitig-max-bytes".format(size, UNITIG_MAX_BYTES))
+		sys.exit()
+
+
+def create_graph_parallel(clients, filepaths, workers, kmer_size=11, progress=None, skip_genomes=()):
+	"""
+	Build the graph from many fasta files at once.
+	Kmers are extracted in a pool of processes, and the genomes are inserted by a pool
+	of threads spread over the given clients. While one group of genomes is inserted
+	the next group is extracted, and at most two groups are held in memory.
+	With UNITIGS there is a single group of every genome, compacted into unitigs
+	together, so all of them are held in memory at once, and more than UNITIG_MAX_BYTES
+	of files are refused.
+	:param clients: list of dgraph clients
+	:param filepaths: The absolute paths to the fasta files to insert
+	:param workers: Number of extraction processes and insertion threads
+	:param kmer_size: Size of kmer
+	:param progress: manifest.Manifest to resume from and record progress in
+	:param skip_genomes: genome names already in the graph, which are not inserted again
+	:return: None
+	"""
+	filepaths = list(filepaths)
+	skip_genomes = set(skip_genomes)
+	if progress:
+		skip_genomes.update(progress.genomes)
+	LOG.info("Creating graph from {0} files with {1} workers".format(len(filepaths), workers))
+	if UNITIGS:
+		check_unitig_bytes(filepaths)
+
+	# A unitig only ends at the branches within its group
+	group_size = max(1, len(filepaths)) if UNITIGS else workers
+	with ProcessPoolExecutor(workers) as extract_pool, ThreadPoolExecutor(workers) as insert_pool:
+		inserting = []
+		for start in range(0, len(filepaths), group_size):
+			group = filepaths[start:start + group_size]
+			extracted = extract_pool.map(get_kmers_genome, group, [kmer_size] * len(group),
+										 [skip_genomes] * len(group))
+
+			# The previous group must finish before this one is queued for insertion
+			for future in inserting:
+				LOG.info("Finished inserting {0}".format(future.result()))
+			inserting = []
+
+			extracted = list(extracted)
+			for i, (genome, all_kmers) in enumerate(extracted):
+				if all_kmers is None:
+					LOG.info("Skipping {0}, already in the graph".format(group[i]))
+					METRICS.add("genomes_skipped")
+
+			if UNITIGS:
+				# The group is compacted together, and its unitigs added before any genome path
+				genomes = {genome: all_kmers for genome, all_kmers in extracted if all_kmers is not None}
+				paths, sequences = unitig.get_genomes_unitigs(genomes, kmer_size)
+				LOG.info("Compacted {0} genomes into {1} unitigs".format(len(genomes), len(sequences)))
+				unitig_uid_dict = add_unitigs_dgraph(clients[start % len(clients)], sequences)
+
+			for i, (genome, all_kmers) in enumerate(extracted):
+				if all_kmers is None:
+					continue
+				client = clients[(start + i) % len(clients)]
+				if UNITIGS:
+					inserting.append(insert_pool.submit(add_genome_unitig_dgraph, client, genome, group[i],
+														paths[genome], unitig_uid_dict, kmer_size, progress))
+				else:
+					inserting.append(insert_pool.submit(add_genome_dgraph, client, genome, group[i],
+														all_kmers, kmer_size, progress))
+
+		for future in inserting:
+			LOG.info("Finished inserting {0}".format(future.result()))
+
+	LOG.info("Kmer cache: {hits} hits, {misses} misses, {size} entries".format(**KMER_CACHE.stats()))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Offline export of genomes as gzipped RDF N-Quads for the dgraph bulk loader.
+Every kmer is written with the blank node used for it by the live insertion,
+named for the packed kmer, so the bulk loader collapses the same kmer from every
+genome into one node. No running dgraph is needed. Each genome's metadata node and
+contig nodes are written too, with blank nodes named for the genome.
+
+The files are loaded with:
+	dgraph bulk -f <output_directory> -s <output_directory>/pans_labyrinth.schema
+"""
+
+import gzip
+import logging
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pans_labyrinth import dgraph, commandline, kmers
+
+LOG = logging.getLogger('pans_labyrinth')
+
+SCHEMA_FILENAME = "pans_labyrinth.schema"
+
+
+def export_genome_rdf(filepath, output_directory, kmer_size, canonical=False):
+	"""
+	Write the kmer nodes, genome edges and metadata of one fasta file to <genome>.rdf.gz
+	:param filepath: The absolute path to the fasta file
+	:param output_directory: Directory the RDF file is written to
+	:param kmer_size: Size of kmer
+	:param canonical: Write canonical kmers, with orientation facets on the edges
+	:return: The genome name in the form genome_hash
+	"""
+	genome = "genome_" + commandline.compute_hash(filepath)
+	rdf_filename = os.path.join(output_directory, genome + ".rdf.gz")
+
+	segments = {}
+	contigs = []
+	with gzip.open(rdf_filename, "wt") as f:
+		for contig, kmer_array in dgraph.get_kmers_chunks(filepath, kmer_size):
+			dgraph.add_contig_segment(segments, contigs, contig, kmer_array, kmer_size)
+			forward = None
+			if canonical:
+				kmer_array, forward = kmers.get_canonical_kmers(kmer_array, kmer_size)
+			# The loader merges repeated kmer quads, so only dedup within the chunk
+			f.writelines(dgraph.get_kmers_quads(np.unique(kmer_array), kmer_size))
+
+			blank_nodes = ["_:k{0}".format(packed) for packed in kmer_array.tolist()]
+			facets = dgraph.get_orientation_facets(forward, len(blank_nodes))
+			for i in range(0, len(blank_nodes) - 1):
+				f.write('{0} <{1}> {2}{3} .\n'.format(blank_nodes[i], genome, blank_nodes[i + 1], facets[i]))
+
+		ends = np.array([c[end] for c in contigs for end in ('first', 'last')], dtype=np.uint64)
+		if canonical and len(ends):
+			ends = kmers.get_canonical_kmers(ends, kmer_size)[0]
+		end_nodes = ["_:k{0}".format(packed) for packed in ends.tolist()]
+		subject = "_:{0}".format(genome)
+		f.write(dgraph.get_metadata_quads(subject, genome, filepath, kmer_size, canonical))
+		for i, contig in enumerate(contigs):
+			f.write(dgraph.get_contig_quads(subject, "_:{0}_c{1}".format(genome, i), i, contig,
+											end_nodes[2 * i], end_nodes[2 * i + 1]))
+
+	LOG.info("Exported {0} to {1}".format(filepath, rdf_filename))
+	return genome
+
+
+def export_rdf(filepaths, output_directory, kmer_size=11, workers=1, canonical=False):
+	"""
+	Export many fasta files for the bulk loader, one RDF file per genome, along with a
+	schema file holding the base schema and the edge of every genome.
+	:param filepaths: The absolute paths to the fasta files to export
+	:param output_directory: Directory the RDF and schema files are written to
+	:param kmer_size: Size of kmer
+	:param workers: Number of genomes exported in parallel
+	:param canonical: Write canonical kmers, with orientation facets on the edges
+	:return: list of the exported genome names
+	"""
+	filepaths = list(filepaths)
+	os.makedirs(output_directory, exist_ok=True)
+	LOG.info("Exporting {0} files to {1}".format(len(filepaths), output_directory))
+
+	with ProcessPoolExecutor(workers) as export_pool:
+		genomes = list(export_pool.map(export_genome_rdf, filepaths,
+									   [output_directory] * len(filepaths),
+									   [kmer_size] * len(filepaths),
+									   [canonical] * len(filepaths)))
+
+	with open(os.path.join(output_directory, SCHEMA_FILENAME), "w") as f:
+		f.write(dgraph.SCHEMA.lstrip())
+		for genome in sorted(set(genomes)):
+			f.write(dgraph.get_genome_schema(genome))
+
+	return genomes
@@ -1,5 +1,8 @@
 #!/user/bin/env python
 
+import gzip
+import hashlib
+import mmap
 import os.path
 import os
 import sys
@@ -50,3 +53,141 @@ def walkdir(folder):
 	for dirpath, dirs, files in os.walk(folder):
 		for filename in files:
 			yield os.path.abspath(os.path.join(dirpath, filename))
+
+
+# Extensions of the fasta files read, each of which may also end in a compressed extension
+FASTA_EXTENSIONS = (".fasta", ".fa", ".fna")
+COMPRESSED_EXTENSIONS = (".gz", ".bgz")
+
+# Bytes read from a fasta file at a time
+READ_SIZE = 1 << 22
+
+# Bytes that are dropped from sequence lines
+SEQUENCE_WHITESPACE = b"\r\n\t "
+
+
+def is_fasta(filename):
+	"""
+	:param filename: Path of a file
+	:return: True if the file name ends in a fasta extension, optionally compressed
+	"""
+	name = filename.lower()
+	for extension in COMPRESSED_EXTENSIONS:
+		if name.endswith(extension):
+			name = name[:-len(extension)]
+			break
+	return name.endswith(FASTA_EXTENSIONS)
+
+
+class HashingReader(object):
+	"""
+	A file wrapper that hashes every byte read through it.
+	"""
+
+	def __init__(self, file, sha1):
+		self._file = file
+		self._sha1 = sha1
+
+	def read(self, size=-1):
+		data = self._file.read(size)
+		self._sha1.update(data)
+		return data
+
+
+class FastaReader(object):
+	"""
+	Single pass fasta reader.
+	Plain files are memory mapped, and .gz and .bgz files are decompressed as they
+	are streamed. The sha1 of the raw file bytes is taken in the same pass, and
+	matches commandline.compute_hash() once every record has been read.
+	"""
+
+	def __init__(self, filename):
+		"""
+		:param filename: Path of the fasta file
+		"""
+		self.filename = filename
+		self._sha1 = hashlib.sha1()
+		self._done = False
+
+	def get_blocks(self):
+		"""
+		:return: Generator of the decompressed file contents in blocks of bytes
+		"""
+		with open(self.filename, "rb") as f:
+			if self.filename.lower().endswith(COMPRESSED_EXTENSIONS):
+				raw = HashingReader(f, self._sha1)
+				with gzip.GzipFile(fileobj=raw) as gz:
+					for block in iter(lambda: gz.read(READ_SIZE), b""):
+						yield block
+				# Hash any bytes past the end of the compressed stream
+				for block in iter(lambda: raw.read(READ_SIZE), b""):
+					pass
+			elif os.fstat(f.fileno()).st_size:
+				with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+					for start in range(0, len(mapped), READ_SIZE):
+						block = mapped[start:start + READ_SIZE]
+						self._sha1.update(block)
+						yield block
+		self._done = True
+
+	def __iter__(self):
+		"""
+		Yield each record, the contig id being the header up to the first whitespace
+		as in Bio.SeqIO
+		:return: Generator of (contig id, sequence)
+		"""
+		header = None
+		parts = []
+		rest = b""
+		for block in self.get_blocks():
+			data = rest + block
+			rest = b""
+			start = 0
+			while True:
+				if header is None:
+					start = data.find(b">", start)
+					if start == -1:
+						break
+					end = data.find(b"\n", start)
+					if end == -1:
+						rest = data[start:]
+						break
+					header = data[start + 1:end]
+					start = end + 1
+
+				# A record ends at the next line starting with >
+				end = data.find(b"\n>", max(start - 1, 0))
+				if end == -1:
+					# Keep the last newline, as the next block may start a record
+					end = data.rfind(b"\n", max(start - 1, 0))
+					parts.append(data[start:end].translate(None, SEQUENCE_WHITESPACE))
+					rest = data[end:]
+					break
+				parts.append(data[start:end].translate(None, SEQUENCE_WHITESPACE))
+				yield self.get_record(header, parts)
+				header = None
+				parts = []
+				start = end + 1
+
+		if header is None and rest.startswith(b">"):
+			header, rest = rest[1:], b""
+		if header is not None:
+			parts.append(rest.translate(None, SEQUENCE_WHITESPACE))
+			yield self.get_record(header, parts)
+
+	@staticmethod
+	def get_record(header, parts):
+		words = header.split()
+		contig = words[0].decode() if words else ""
+		return contig, b"".join(parts).decode("ascii")
+
+	def hexdigest(self):
+		"""
+		:return: sha1 of the raw file bytes, once every record has been read
+		"""
+		if not self._done:
+			self._sha1 = hashlib.sha1()
+			for block in self.get_blocks():
+				pass
+		return self._sha1.hexdigest()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Packed kmer representation.
+Each base is stored in 2 bits (A=0, C=1, G=2, T=3), so a kmer of up to 32 bases
+fits in a single uint64. Kmers are extracted from a sequence as numpy arrays and
+only decoded back into strings where they are handed to dgraph.
+"""
+
+import numpy as np
+import sys
+from pans_labyrinth import logging_functions
+
+# Largest kmer that fits in a uint64
+MAX_KMER_SIZE = 32
+
+# Maps an ascii byte to its 2 bit code, 255 marks a base that can not be encoded
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b"ACGT"):
+	BASE_CODES[base] = code
+	BASE_CODES[ord(chr(base).lower())] = code
+
+CODE_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def check_kmer_size(kmer_size):
+	"""
+	Exit if a kmer of the given size can not be packed into a uint64
+	:param kmer_size: Size of kmer
+	:return: None
+	"""
+	if not 1 <= kmer_size <= MAX_KMER_SIZE:
+		LOG = logging_functions.create_logger()
+		LOG.critical("Kmer size must be between 1 and {0}".format(MAX_KMER_SIZE))
+		sys.exit()
+
+
+def check_chunk_size(chunk_size):
+	"""
+	Exit if chunks of the given size can not share a kmer with the chunk after them
+	:param chunk_size: Maximum number of kmers in a chunk
+	:return: None
+	"""
+	if chunk_size < 2:
+		LOG = logging_functions.create_logger()
+		LOG.critical("Chunk size must be at least 2")
+		sys.exit()
+
+
+def pack_codes(codes, kmer_size):
+	"""
+	Build every kmer of a run of 2 bit base codes.
+	The kmers are built with one shift and or per base across the whole run,
+	rather than slicing a string for each position.
+	:param codes: numpy array of base codes
+	:param kmer_size: Size of kmer
+	:return: numpy uint64 array of packed kmers
+	"""
+	total = len(codes) - kmer_size + 1
+	if total < 1:
+		return np.zeros(0, dtype=np.uint64)
+
+	codes = codes.astype(np.uint64)
+	kmers = np.zeros(total, dtype=np.uint64)
+	for i in range(kmer_size):
+		kmers <<= np.uint64(2)
+		kmers |= codes[i:i + total]
+	return kmers
+
+
+def encode_kmers(kmer_list):
+	"""
+	Pack a list of equal length kmer strings.
+	:param kmer_list: [kmers]
+	:return: numpy uint64 array of packed kmers
+	"""
+	if len(kmer_list) == 0:
+		return np.zeros(0, dtype=np.uint64)
+
+	kmer_size = len(kmer_list[0])
+	check_kmer_size(kmer_size)
+	codes = BASE_CODES[np.frombuffer("".join(kmer_list).encode("ascii"), dtype=np.uint8)]
+	if (codes == 255).any():
+		LOG = logging_functions.create_logger()
+		LOG.critical("Kmer contains a base other than A, C, G or T")
+		sys.exit()
+
+	codes = codes.reshape(-1, kmer_size).astype(np.uint64)
+	kmers = np.zeros(len(codes), dtype=np.uint64)
+	for i in range(kmer_size):
+		kmers <<= np.uint64(2)
+		kmers |= codes[:, i]
+	return kmers
+
+
+def decode_kmers(kmer_array, kmer_size):
+	"""
+	Unpack kmers back into strings.
+	:param kmer_array: numpy uint64 array of packed kmers
+	:param kmer_size: Size of kmer
+	:return: [kmers]
+	"""
+	kmer_array = np.asarray(kmer_array, dtype=np.uint64)
+	if len(kmer_array) == 0:
+		return []
+
+	shifts = np.arange(2 * (kmer_size - 1), -1, -2, dtype=np.uint64)
+	codes = (kmer_array[:, None] >> shifts) & np.uint64(3)
+	letters = np.ascontiguousarray(CODE_BASES[codes])
+	return letters.view("S{0}".format(kmer_size))[:, 0].astype(str).tolist()
+
+
+def get_kmers_sequence(sequence, kmer_size, chunk_size):
+	"""
+	Yield the packed kmers of a sequence in chunks of at most chunk_size kmers.
+	Consecutive chunks share one kmer so the edges can be linked across them.
+	Kmers are never built across a base other than A, C, G or T; the sequence is
+	split there and each side is yielded as its own run of chunks.
+	:param sequence: The contig sequence as a string
+	:param kmer_size: Size of kmer
+	:param chunk_size: Maximum number of kmers in a chunk
+	:return: Generator of numpy uint64 arrays
+	"""
+	check_kmer_size(kmer_size)
+	check_chunk_size(chunk_size)
+	codes = BASE_CODES[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+
+	# Boundaries of the runs of valid bases
+	bad = np.flatnonzero(codes == 255)
+	lefts = np.concatenate(([0], bad + 1))
+	rights = np.concatenate((bad, [len(codes)]))
+
+	for left, right in zip(lefts.tolist(), rights.tolist()):
+		total = right - left - kmer_size + 1
+		if total < 1:
+			continue
+		for start in range(left, left + max(total - 1, 1), chunk_size - 1):
+			stop = min(start + chunk_size, left + total)
+			yield pack_codes(codes[start:stop + kmer_size - 1], kmer_size)
+
+
+def get_reverse_complement(kmer_array, kmer_size):
+	"""
+	Reverse complement packed kmers, a base at a time across the whole array.
+	With A=0, C=1, G=2, T=3 the complement of a base is its bits inverted.
+	:param kmer_array: numpy uint64 array of packed kmers
+	:param kmer_size: Size of kmer
+	:return: numpy uint64 array of the packed reverse complements
+	"""
+	mask = np.uint64((1 << (2 * kmer_size)) - 1)
+	complement = ~np.asarray(kmer_array, dtype=np.uint64) & mask
+	reverse = np.zeros(len(complement), dtype=np.uint64)
+	for i in range(kmer_size):
+		reverse <<= np.uint64(2)
+		reverse |= complement & np.uint64(3)
+		complement >>= np.uint64(2)
+	return reverse
+
+
+def get_canonical_kmers(kmer_array, kmer_size):
+	"""
+	Find the canonical form of each kmer, the lesser of the kmer and its reverse
+	complement, so a sequence and its reverse complement share the same kmers.
+	:param kmer_array: numpy uint64 array of packed kmers
+	:param kmer_size: Size of kmer
+	:return: numpy uint64 array of canonical kmers, numpy bool array that is True
+	where the kmer was already canonical
+	"""
+	reverse = get_reverse_complement(kmer_array, kmer_size)
+	forward = kmer_array <= reverse
+	return np.where(forward, kmer_array, reverse), forward
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
-from pans_labyrinth import files, dgraph, commandline, logging_functions
+from pans_labyrinth import files, dgraph, commandline, logging_functions, export, manifest, kmers, backend, metrics, pipeline, membership, matrix, bloom
 import os
+import sys
+import uuid
 import logging
 
 def main():
@@ -9,31 +11,172 @@ def main():
     The program - The work horse
     :return: success
     """
-    path = os.path.abspath("data/genomes/test/")
     output_directory = os.path.abspath("data/logger")
-    print(path)
     # setup the application logging
     LOG = logging_functions.create_logger()
 
     fh = logging.FileHandler(os.path.join(output_directory, 'pans_labyrinth.log'), 'w', 'utf-8')
     LOG.addHandler(fh)
 
-    #options = commandline.arg_parser(client)
+    options = commandline.arg_parser()
     #dgraph.execute_args(client, options)
 
-    #LOG.debug(options)
+    LOG.debug(options)
+    path = os.path.abspath(options.path)
+    print(path)
+    kmers.check_kmer_size(options.kmer_size)
+    dgraph.BATCH_SIZE = options.batch_size
+    dgraph.BATCH_BYTES = options.batch_bytes
+    if options.upsert:
+        dgraph.WRITE_MODE = dgraph.WRITE_UPSERT
+    dgraph.EDGE_MODEL = options.edge_model
+    if options.upsert and dgraph.EDGE_MODEL == dgraph.EDGE_NEXT:
+        LOG.critical("The upsert write path only supports the genome edge model")
+        sys.exit()
+    dgraph.CANONICAL = options.canonical
+    if dgraph.CANONICAL and dgraph.EDGE_MODEL == dgraph.EDGE_NEXT:
+        LOG.critical("Canonical kmers are only supported with the genome edge model")
+        sys.exit()
+    if options.export_rdf and dgraph.EDGE_MODEL == dgraph.EDGE_NEXT:
+        LOG.critical("The RDF export only writes the genome edge model")
+        sys.exit()
+    dgraph.UNITIGS = options.unitigs
+    dgraph.UNITIG_MAX_BYTES = options.unitig_max_bytes
+    if dgraph.UNITIGS and (options.upsert or options.canonical or options.export_rdf
+                           or dgraph.EDGE_MODEL == dgraph.EDGE_NEXT):
+        LOG.critical("Unitigs are only supported by the live query write path with the genome edge model")
+        sys.exit()
+    if dgraph.UNITIGS and (options.resume or options.incremental):
+        LOG.critical("Unitigs are compacted over all the genomes at once, so a unitig graph is built in one run")
+        sys.exit()
+    if dgraph.UNITIGS:
+        dgraph.check_unitig_bytes(list(files.walkdir(path)))
+    if options.pipeline and (options.upsert or options.unitigs):
+        LOG.critical("The pipeline only supports the query write path without unitigs")
+        sys.exit()
+    if options.kmer_filter and options.unitigs:
+        LOG.critical("The kmer filter is only supported on a kmer graph")
+        sys.exit()
+    if options.backend == "memory" and (options.upsert or options.unitigs or options.migrate_edges
+                                        or dgraph.EDGE_MODEL == dgraph.EDGE_NEXT):
+        LOG.critical("The memory backend only supports the query write path with the genome edge model")
+        sys.exit()
+
     LOG.info("Starting pans_labyrinth")
-    stub = dgraph.create_client_stub()
-    client = dgraph.create_client(stub)
-    dgraph.drop_all(client)
+    if options.export_rdf:
+        export.export_rdf(files.walkdir(path), os.path.abspath(options.export_rdf), options.kmer_size,
+                          options.workers, options.canonical)
+        LOG.info("ALL DONE")
+        return
+
+    if options.resume and not options.manifest:
+        LOG.critical("Resuming requires a manifest")
+        sys.exit()
+    progress = None
+    if options.manifest:
+        # An incremental run reads the genomes already loaded from the manifest, so keeps it too
+        progress = manifest.Manifest(os.path.abspath(options.manifest), options.resume or options.incremental)
+
+    querying = options.membership or options.sequence or options.export_matrix
+    if (options.membership or options.sequence) and options.unitigs:
+        LOG.critical("Membership queries are only supported on a kmer graph")
+        sys.exit()
+
+    if options.backend == "memory":
+        backend_path = options.backend_path and os.path.abspath(options.backend_path)
+        if (backend_path and (options.resume or options.incremental or querying or options.delete)
+                and os.path.exists(backend_path)):
+            client = backend.MemoryBackend.load(backend_path)
+        else:
+            client = backend.MemoryBackend(backend_path)
+    else:
+        client = dgraph.create_client_pool(options.alpha, options.stubs or options.workers, options.balance)
+    if options.migrate_edges:
+        dgraph.add_schema(client)
+        for genome in sorted(dgraph.query_genomes_dgraph(client)):
+            dgraph.migrate_genome_edges(client, genome, drop_predicate=True)
+        client.close()
+        LOG.info("ALL DONE")
+        return
+
+    if options.delete:
+        dgraph.delete_genome(client, options.delete)
+        client.close()
+        LOG.info("ALL DONE")
+        return
+
+    kmer_filter = options.kmer_filter and os.path.abspath(options.kmer_filter)
+    if querying and kmer_filter:
+        dgraph.KMER_FILTER = bloom.load_kmer_filter(kmer_filter, dgraph.query_kmer_filter_stamp_dgraph(client))
+
+    if options.export_matrix:
+        matrix.export_matrix([client], os.path.abspath(options.export_matrix), options.workers)
+    if options.membership or options.sequence:
+        kmer_size = dgraph.query_kmer_size_dgraph(client) or options.kmer_size
+        canonical = dgraph.query_canonical_dgraph(client)
+        if canonical is not None:
+            dgraph.CANONICAL = canonical
+        sequences = membership.get_sequences([os.path.abspath(f) for f in options.membership or []],
+                                             options.sequence or [])
+        if options.membership_output:
+            with open(os.path.abspath(options.membership_output), "w") as output:
+                membership.write_membership_tsv(client, sequences, kmer_size, output)
+        else:
+            membership.write_membership_tsv(client, sequences, kmer_size, sys.stdout)
+    if querying:
+        if options.backend != "memory":
+            # Closing the memory backend would save the unchanged graph again
+            client.close()
+        LOG.info("ALL DONE")
+        return
+
+    if not (options.resume or options.incremental):
+        dgraph.drop_all(client)
     dgraph.add_schema(client)
+    dgraph.check_kmer_size_dgraph(client, options.kmer_size)
+    dgraph.check_canonical_dgraph(client, dgraph.CANONICAL)
+
+    # Until this run saves a kmer filter, any saved before would be missing the kmers it inserts
+    kmer_filter_stamp = dgraph.query_kmer_filter_stamp_dgraph(client)
+    dgraph.set_kmer_filter_stamp_dgraph(client, None)
+    if kmer_filter:
+        if options.resume or options.incremental:
+            dgraph.KMER_FILTER = bloom.load_kmer_filter(kmer_filter, kmer_filter_stamp)
+        else:
+            dgraph.KMER_FILTER = bloom.BloomFilter(options.kmer_filter_capacity)
+        if os.path.exists(kmer_filter):
+            os.remove(kmer_filter)
+
+    skip_genomes = set()
+    if options.incremental:
+        skip_genomes = dgraph.get_genomes_loaded(client, progress)
+        LOG.info("Found {0} genomes already in the graph, which are skipped".format(len(skip_genomes)))
 
     LOG.info("Starting to create graph")
-    for filepath in files.walkdir(path):
-        with open(filepath, 'rb') as file:
-            dgraph.create_graph(client, file, filepath)
+    filepaths = list(files.walkdir(path))
+    reporter = metrics.MetricsReporter(dgraph.METRICS, len(filepaths),
+                                       options.metrics and os.path.abspath(options.metrics),
+                                       options.progress_interval, dgraph.get_metrics_gauges)
+    reporter.start()
+    if options.pipeline:
+        pipeline.create_graph_pipeline(client, filepaths, options.workers, options.kmer_size, progress,
+                                       skip_genomes, options.queue_size)
+    elif options.workers > 1 or dgraph.UNITIGS:
+        dgraph.create_graph_parallel([client], filepaths, options.workers, options.kmer_size,
+                                     progress, skip_genomes)
+    else:
+        for filepath in filepaths:
+            with open(filepath, 'rb') as file:
+                dgraph.create_graph(client, file, filepath, progress, skip_genomes, options.kmer_size)
+    reporter.stop()
 
-    stub.close()
+    if dgraph.KMER_FILTER is not None:
+        kmer_filter_stamp = uuid.uuid4().hex
+        dgraph.KMER_FILTER.save(kmer_filter, kmer_filter_stamp)
+        dgraph.set_kmer_filter_stamp_dgraph(client, kmer_filter_stamp)
+    client.close()
+    if progress:
+        progress.close()
     LOG.info("ALL DONE")
 
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Journal of ingestion progress, so an interrupted load can be resumed.
+Progress is appended to a JSON lines file as each contig chunk and each genome is
+committed to the graph. On restart the journal is read back, and the genomes and
+chunks it lists are skipped.
+"""
+
+import json
+import logging
+import os
+import threading
+
+LOG = logging.getLogger('pans_labyrinth')
+
+
+class Manifest(object):
+	"""
+	A JSON lines journal of finished genomes and contig chunks.
+	Chunks are identified by genome, contig and the index of the chunk within the
+	contig, so a resumed load must use the same chunk size.
+	"""
+
+	def __init__(self, filename, resume=True):
+		"""
+		:param filename: Path of the journal
+		:param resume: Keep the progress already in the journal, otherwise start afresh
+		"""
+		self.filename = filename
+		self.genomes = {}
+		self.chunks = set()
+		self._lock = threading.Lock()
+
+		ended = True
+		if resume and os.path.exists(filename):
+			ended = self.read_manifest()
+		self._file = open(filename, "a" if resume else "w")
+		if not ended:
+			# Keep new entries off the end of a line cut short by a crash
+			self._file.write("\n")
+
+	def read_manifest(self):
+		"""
+		Load the progress recorded in the journal.
+		A line cut short by a crash is ignored, as its work was never recorded as done.
+		:return: False if the journal ends part way through a line
+		"""
+		line = "\n"
+		with open(self.filename) as f:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					LOG.warning("Skipping incomplete manifest entry")
+					continue
+				if 'chunk' in entry:
+					self.chunks.add((entry['genome'], entry['contig'], entry['chunk']))
+				else:
+					self.genomes[entry['genome']] = entry['filename']
+		LOG.info("Manifest has {0} genomes and {1} chunks done".format(len(self.genomes), len(self.chunks)))
+		return line.endswith("\n")
+
+	def write_entry(self, entry):
+		"""
+		Append an entry to the journal, flushed so it survives the process dying
+		:param entry: dict to record
+		"""
+		self._file.write(json.dumps(entry) + "\n")
+		self._file.flush()
+
+	def is_genome_done(self, genome):
+		return genome in self.genomes
+
+	def is_chunk_done(self, genome, contig, chunk):
+		return (genome, contig, chunk) in self.chunks
+
+	def add_genome(self, genome, filename):
+		"""
+		Record that every chunk of a genome is in the graph
+		:param genome: The genome name in the form genome_hash
+		:param filename: The fasta file the genome was read from
+		"""
+		with self._lock:
+			self.write_entry({'genome': genome, 'filename': filename})
+			self.genomes[genome] = filename
+
+	def add_chunk(self, genome, contig, chunk):
+		"""
+		Record that the nodes and edges of a contig chunk are in the graph
+		:param genome: The genome name in the form genome_hash
+		:param contig: The contig id
+		:param chunk: Index of the chunk within the contig
+		"""
+		with self._lock:
+			self.write_entry({'genome': genome, 'contig': contig, 'chunk': chunk})
+			self.chunks.add((genome, contig, chunk))
+
+	def close(self):
+		self._file.close()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+Export of the pangenome presence/absence matrix, a row for each genome and a column
+for each kmer or unitig node of the graph.
+The nodes of each genome are paged out of the graph by a pool of threads, one genome
+at a time each, and spilled to a work directory. The columns are then the union of
+the genomes' nodes, and the rows are streamed one genome at a time into an NPZ file
+holding the matrix in compressed sparse row form, so no more than one genome's
+nodes and the column labels are held in memory at once.
+
+The NPZ has the format, shape, data, indices and indptr arrays read by
+scipy.sparse.load_npz(), along with:
+	genomes: the genome name of each row
+	uids: the uid of the node of each column
+	kmers: the packed kmer of each column, or unitigs: the sequence of each column
+	genome_counts: the number of genomes holding each column
+	core: True for the columns held by every genome
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pans_labyrinth import dgraph, kmers, membership
+
+LOG = logging.getLogger('pans_labyrinth')
+
+# Number of rows written to the NPZ at a time when streaming an array
+WRITE_ROWS = 1 << 20
+
+
+def get_genome_nodes(client, genome, page_size=None):
+	"""
+	Page through the edges of a genome, collecting every node on them along with the
+	first and last node of each contig
+	:param client: dgraph client
+	:param genome: The genome name in the form genome_hash
+	:param page_size: Number of source nodes per page, defaults to dgraph.BATCH_SIZE
+	:return: numpy int64 array of the sorted distinct node uids, and a numpy array of
+	their packed kmers, or of their unitig sequences in a unitig graph
+	"""
+	nodes = []
+	for page in dgraph.query_genome_edges(client, genome, page_size):
+		for node in page:
+			nodes.append(node)
+			nodes.extend(node.get(genome, []))
+	metadata = dgraph.query_metadata_dgraph(client, genome)
+	for contig in metadata.get('contigs', []) if metadata else []:
+		nodes.extend((contig['first_kmer'], contig['last_kmer']))
+
+	labels = {node['uid']: dgraph.get_path_node(node) for node in nodes}
+	uids = np.array([int(uid, 16) for uid in labels], dtype=np.int64)
+	order = np.argsort(uids)
+	if any('unitig' in node for node in labels.values()):
+		label_array = np.array([node['unitig'] for node in labels.values()], dtype=str)
+	else:
+		label_array = kmers.encode_kmers([node['kmer'] for node in labels.values()])
+	return uids[order], label_array[order]
+
+
+def spill_genome_nodes(client, genome, filename):
+	"""
+	Write the nodes of a genome to a work file.
+	Run in a worker thread by export_matrix().
+	:return: The work file name
+	"""
+	uids, labels = get_genome_nodes(client, genome)
+	np.savez(filename, uids=uids, labels=labels)
+	LOG.info("Read {0} nodes of {1}".format(len(uids), genome))
+	return filename
+
+
+def merge_columns(columns, labels, uids, uid_labels):
+	"""
+	Add the nodes of a genome to the sorted columns of the matrix
+	:param columns: numpy int64 array of the sorted column uids so far
+	:param labels: numpy array of the label of each column
+	:param uids: numpy int64 array of the sorted uids of the genome
+	:param uid_labels: numpy array of the label of each of the genome's uids
+	:return: The merged columns and labels
+	"""
+	new = ~np.isin(uids, columns)
+	if not new.any():
+		return columns, labels
+	merged = np.concatenate((columns, uids[new]))
+	merged_labels = np.concatenate((labels, uid_labels[new]))
+	order = np.argsort(merged, kind='stable')
+	return merged[order], merged_labels[order]
+
+
+def write_npz_array(npz, name, array):
+	"""
+	:param npz: zipfile.ZipFile being written
+	:param name: Name of the array
+	:param array: numpy array
+	"""
+	with npz.open(name + ".npy", "w", force_zip64=True) as f:
+		np.lib.format.write_array(f, np.asanyarray(array))
+
+
+def write_npz_chunks(npz, name, dtype, length, chunks):
+	"""
+	Write an array to an NPZ a chunk at a time
+	:param npz: zipfile.ZipFile being written
+	:param name: Name of the array
+	:param dtype: numpy dtype of the array
+	:param length: Total length of the chunks
+	:param chunks: iterable of numpy arrays making up the array in order
+	"""
+	header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (length,)}
+	with npz.open(name + ".npy", "w", force_zip64=True) as f:
+		np.lib.format.write_array_header_1_0(f, header)
+		for chunk in chunks:
+			f.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+
+
+def export_matrix(clients, filename, workers=1):
+	"""
+	Write the presence/absence matrix of every genome in the graph to an NPZ file
+	:param clients: list of dgraph clients, spread over the worker threads
+	:param filename: Path of the NPZ file
+	:param workers: Number of genomes read from the graph at once
+	:return: Shape of the matrix, (genomes, columns)
+	"""
+	genomes = membership.get_query_genomes(clients[0])
+	LOG.info("Exporting the matrix of {0} genomes to {1}".format(len(genomes), filename))
+	work_directory = tempfile.mkdtemp(prefix="matrix_", dir=os.path.dirname(filename))
+	try:
+		work_files = [os.path.join(work_directory, "{0}.npz".format(i)) for i in range(len(genomes))]
+		columns = np.zeros(0, dtype=np.int64)
+		labels = None
+		lengths = []
+		with ThreadPoolExecutor(workers) as read_pool:
+			spilled = read_pool.map(spill_genome_nodes, [clients[i % len(clients)] for i in range(len(genomes))],
+									genomes, work_files)
+			for work_file in spilled:
+				with np.load(work_file) as genome_nodes:
+					uids, uid_labels = genome_nodes['uids'], genome_nodes['labels']
+				if labels is None or not len(labels):
+					labels = uid_labels[:0]
+				columns, labels = merge_columns(columns, labels, uids, uid_labels)
+				lengths.append(len(uids))
+
+		index_dtype = np.int32 if len(columns) < 2 ** 31 else np.int64
+		indptr = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+		genome_counts = np.zeros(len(columns), dtype=np.int32)
+
+		def get_indices():
+			for work_file in work_files:
+				with np.load(work_file) as genome_nodes:
+					indices = np.searchsorted(columns, genome_nodes['uids'])
+				genome_counts[indices] += 1
+				yield indices
+
+		def get_data():
+			for start in range(0, int(indptr[-1]), WRITE_ROWS):
+				yield np.ones(min(WRITE_ROWS, int(indptr[-1]) - start), dtype=bool)
+
+		partial_filename = filename + ".tmp"
+		with zipfile.ZipFile(partial_filename, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as npz:
+			write_npz_array(npz, "format", np.array(b"csr"))
+			write_npz_array(npz, "shape", np.array([len(genomes), len(columns)], dtype=np.int64))
+			write_npz_array(npz, "genomes", np.array(genomes, dtype=str))
+			write_npz_array(npz, "uids", columns)
+			write_npz_array(npz, "kmers" if labels is None or labels.dtype == np.uint64 else "unitigs",
+							labels if labels is not None else np.zeros(0, dtype=np.uint64))
+			write_npz_array(npz, "indptr", indptr)
+			write_npz_chunks(npz, "indices", index_dtype, int(indptr[-1]), get_indices())
+			write_npz_chunks(npz, "data", bool, int(indptr[-1]), get_data())
+			write_npz_array(npz, "genome_counts", genome_counts)
+			write_npz_array(npz, "core", genome_counts == len(genomes))
+		os.replace(partial_filename, filename)
+	finally:
+		shutil.rmtree(work_directory, ignore_errors=True)
+
+	LOG.info("Exported a matrix of {0} genomes by {1} nodes, {2} core".format(
+		len(genomes), len(columns), int((genome_counts == len(genomes)).sum()) if len(genomes) else 0))
+	return len(genomes), len(columns)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Membership queries: which genomes hold a set of sequences, such as genes of interest.
+Each query sequence is split into kmers, the kmers of a batch of sequences are
+looked up together, and the coverage of each sequence in every genome, the share of
+its kmers the genome holds, is streamed out a row at a time as TSV.
+"""
+
+import logging
+import numpy as np
+from pans_labyrinth import dgraph, files, kmers, backend
+
+LOG = logging.getLogger('pans_labyrinth')
+
+
+def get_sequences(filenames=(), sequences=()):
+	"""
+	:param filenames: Paths of fasta files of query sequences
+	:param sequences: Query sequences given directly, named sequence_1, sequence_2...
+	:return: Generator of (sequence id, sequence)
+	"""
+	for filename in filenames:
+		for record in files.FastaReader(filename):
+			yield record
+	for i, sequence in enumerate(sequences):
+		yield "sequence_{0}".format(i + 1), sequence
+
+
+def get_query_genomes(client):
+	"""
+	:param client: dgraph client
+	:return: sorted list of the genomes in the graph
+	"""
+	genomes = dgraph.query_genomes_dgraph(client)
+	if dgraph.EDGE_MODEL == dgraph.EDGE_NEXT and not isinstance(client, backend.Backend):
+		genomes.update(dgraph.query_genome_indexes_dgraph(client))
+	return sorted(genomes)
+
+
+def get_sequence_kmers(sequence, kmer_size):
+	"""
+	:param sequence: A query sequence
+	:param kmer_size: Size of kmer
+	:return: numpy array of the packed kmers at each position, canonical if the graph is
+	"""
+	runs = list(kmers.get_kmers_sequence(sequence, kmer_size, max(len(sequence), 2)))
+	kmer_array = np.concatenate(runs) if runs else np.zeros(0, dtype=np.uint64)
+	if dgraph.CANONICAL:
+		kmer_array = kmers.get_canonical_kmers(kmer_array, kmer_size)[0]
+	return kmer_array
+
+
+def get_batch_membership(client, batch, genomes, kmer_size):
+	"""
+	Count the kmers of each sequence in a batch present in each genome
+	:param client: dgraph client
+	:param batch: list of (sequence id, packed kmers)
+	:param genomes: list of genome names in the form genome_hash
+	:param kmer_size: Size of kmer
+	:return: Generator of (sequence id, kmer count, numpy array of present kmer counts by genome)
+	"""
+	all_kmers = np.concatenate([kmer_array for sequence_id, kmer_array in batch])
+	unique_kmers, positions = np.unique(all_kmers, return_inverse=True)
+	present = np.zeros((len(unique_kmers), len(genomes)), dtype=bool)
+	if len(unique_kmers):
+		kmer_uid_dict, missing = dgraph.get_kmers_uids(client, unique_kmers, kmer_size)
+		found = ~np.isin(unique_kmers, missing)
+		uids = [kmer_uid_dict[kmer] for kmer in unique_kmers[found].tolist()]
+		if uids:
+			present[found] = dgraph.query_kmer_genomes_dgraph(client, uids, genomes)
+
+	start = 0
+	for sequence_id, kmer_array in batch:
+		counts = present[positions[start:start + len(kmer_array)]].sum(axis=0)
+		start += len(kmer_array)
+		yield sequence_id, len(kmer_array), counts
+
+
+def get_membership(client, sequences, genomes, kmer_size, batch_size=None):
+	"""
+	Find the genomes holding each query sequence, looking up the kmers of enough
+	sequences to fill a batch at once
+	:param client: dgraph client
+	:param sequences: iterable of (sequence id, sequence)
+	:param genomes: list of genome names in the form genome_hash
+	:param kmer_size: Size of kmer
+	:param batch_size: Kmers looked up together, defaults to dgraph.BATCH_SIZE
+	:return: Generator of (sequence id, kmer count, numpy array of present kmer counts by genome)
+	"""
+	batch_size = batch_size or dgraph.BATCH_SIZE
+	batch = []
+	total = 0
+	for sequence_id, sequence in sequences:
+		kmer_array = get_sequence_kmers(sequence, kmer_size)
+		batch.append((sequence_id, kmer_array))
+		total += len(kmer_array)
+		if total >= batch_size:
+			yield from get_batch_membership(client, batch, genomes, kmer_size)
+			batch = []
+			total = 0
+	if batch:
+		yield from get_batch_membership(client, batch, genomes, kmer_size)
+
+
+def write_membership_tsv(client, sequences, kmer_size, output):
+	"""
+	Write the coverage of each query sequence in each genome as it is found, a row per
+	sequence and a column per genome
+	:param client: dgraph client
+	:param sequences: iterable of (sequence id, sequence)
+	:param kmer_size: Size of kmer
+	:param output: Text file to write to
+	:return: Number of sequences written
+	"""
+	genomes = get_query_genomes(client)
+	LOG.info("Querying membership of sequences in {0} genomes".format(len(genomes)))
+	output.write("\t".join(["sequence", "kmers"] + genomes) + "\n")
+
+	count = 0
+	for sequence_id, kmer_count, counts in get_membership(client, sequences, genomes, kmer_size):
+		coverage = counts / kmer_count if kmer_count else counts.astype(float)
+		output.write("\t".join([sequence_id, str(kmer_count)] + ["{0:.4f}".format(c) for c in coverage.tolist()]) + "\n")
+		output.flush()
+		count += 1
+	LOG.info("Wrote the membership of {0} sequences".format(count))
+	return count
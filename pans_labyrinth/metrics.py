@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""
+Instrumentation of ingestion runs.
+Counters and per stage latency histograms are collected in a Metrics object, and
+written out in the Prometheus text format, suitable for the node_exporter textfile
+collector. A MetricsReporter thread rewrites the file and logs a progress line
+with an ETA at a fixed interval while a load runs.
+"""
+
+import bisect
+import contextlib
+import datetime
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger('pans_labyrinth')
+
+# Prefix of every metric name written
+METRIC_PREFIX = "pans_labyrinth"
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# Stages of ingestion, in pipeline order
+STAGES = ("parse", "extract", "lookup", "node_insert", "edge_insert", "commit")
+
+
+class Metrics(object):
+	"""
+	Thread safe counters, gauges and latency histograms.
+	Counters only grow; gauges hold the last value set.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.started = time.time()
+			self._counters = {}
+			self._gauges = {}
+			self._histograms = {}
+
+	def add(self, name, value=1):
+		"""
+		:param name: Counter name
+		:param value: Amount to add
+		"""
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + value
+
+	def set(self, name, value):
+		"""
+		:param name: Gauge name
+		:param value: Current value
+		"""
+		with self._lock:
+			self._gauges[name] = value
+
+	def observe(self, stage, seconds):
+		"""
+		Record the latency of one run of a stage
+		:param stage: Stage name
+		:param seconds: Time taken
+		"""
+		with self._lock:
+			histogram = self._histograms.get(stage)
+			if histogram is None:
+				histogram = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+				self._histograms[stage] = histogram
+			histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+			histogram['sum'] += seconds
+			histogram['count'] += 1
+
+	@contextlib.contextmanager
+	def time(self, stage):
+		"""
+		Context manager recording the time taken by its block
+		:param stage: Stage name
+		"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(stage, time.perf_counter() - start)
+
+	def iterate(self, iterable, stage):
+		"""
+		Yield from an iterable, recording the time taken to produce each item
+		:param iterable: Any iterable
+		:param stage: Stage name
+		:return: Generator of the items
+		"""
+		iterator = iter(iterable)
+		while True:
+			start = time.perf_counter()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+			self.observe(stage, time.perf_counter() - start)
+			yield item
+
+	def get_counter(self, name):
+		with self._lock:
+			return self._counters.get(name, 0)
+
+	def get_stage_seconds(self):
+		"""
+		:return: dict{stage:total seconds}
+		"""
+		with self._lock:
+			return {stage: histogram['sum'] for stage, histogram in self._histograms.items()}
+
+	def get_prometheus(self):
+		"""
+		:return: Every metric in the Prometheus text exposition format
+		"""
+		with self._lock:
+			lines = []
+			for name in sorted(self._counters):
+				metric = "{0}_{1}_total".format(METRIC_PREFIX, name)
+				lines.append("# TYPE {0} counter".format(metric))
+				lines.append("{0} {1}".format(metric, self._counters[name]))
+			for name in sorted(self._gauges):
+				metric = "{0}_{1}".format(METRIC_PREFIX, name)
+				lines.append("# TYPE {0} gauge".format(metric))
+				lines.append("{0} {1}".format(metric, self._gauges[name]))
+
+			metric = "{0}_stage_seconds".format(METRIC_PREFIX)
+			if self._histograms:
+				lines.append("# TYPE {0} histogram".format(metric))
+			for stage in sorted(self._histograms):
+				histogram = self._histograms[stage]
+				cumulative = 0
+				for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram['buckets']):
+					cumulative += count
+					lines.append('{0}_bucket{{stage="{1}",le="{2}"}} {3}'.format(metric, stage, bound, cumulative))
+				lines.append('{0}_sum{{stage="{1}"}} {2}'.format(metric, stage, histogram['sum']))
+				lines.append('{0}_count{{stage="{1}"}} {2}'.format(metric, stage, histogram['count']))
+			return "\n".join(lines) + "\n"
+
+	def write_prometheus(self, filename):
+		"""
+		Write the metrics to a file, replacing it whole so a collector never reads
+		it half written
+		:param filename: Path of the metrics file
+		"""
+		with open(filename + ".tmp", "w") as f:
+			f.write(self.get_prometheus())
+		os.replace(filename + ".tmp", filename)
+
+
+def get_progress_line(metrics, genomes_total):
+	"""
+	Summarise the progress of a load
+	:param metrics: Metrics of the load
+	:param genomes_total: Number of genomes given to the load, less those skipped as they are counted
+	:return: str with the genomes done, kmer rate, share of time in each stage and ETA
+	"""
+	genomes_total -= metrics.get_counter("genomes_skipped")
+	elapsed = time.time() - metrics.started
+	done = metrics.get_counter("genomes")
+	kmer_count = metrics.get_counter("kmers")
+	line = "Progress: {0}/{1} genomes, {2} kmers at {3:.0f} kmers/s".format(
+		done, genomes_total, kmer_count, kmer_count / elapsed if elapsed else 0)
+
+	# Commits happen within the insert stages, so are left out of the shares
+	stage_seconds = metrics.get_stage_seconds()
+	stage_seconds.pop("commit", None)
+	total_seconds = sum(stage_seconds.values())
+	if total_seconds:
+		shares = ["{0} {1:.0%}".format(stage, stage_seconds[stage] / total_seconds)
+				  for stage in STAGES if stage in stage_seconds]
+		line += ", time in " + ", ".join(shares)
+
+	if done and genomes_total > done:
+		eta = datetime.timedelta(seconds=int(elapsed / done * (genomes_total - done)))
+		line += ", ETA {0}".format(eta)
+	return line
+
+
+class MetricsReporter(threading.Thread):
+	"""
+	Background thread that, every interval, logs a progress line and rewrites the
+	metrics file. Stopping it reports once more.
+	"""
+
+	def __init__(self, metrics, genomes_total, filename=None, interval=10.0, gauges=None):
+		"""
+		:param metrics: Metrics of the load
+		:param genomes_total: Number of genomes given to the load, including those it skips
+		:param filename: Path of the Prometheus metrics file, or None
+		:param interval: Seconds between reports
+		:param gauges: Callable returning dict{gauge name:value}, set before each report
+		"""
+		super(MetricsReporter, self).__init__(daemon=True)
+		self.metrics = metrics
+		self.genomes_total = genomes_total
+		self.filename = filename
+		self.interval = interval
+		self.gauges = gauges
+		self._stopped = threading.Event()
+
+	def report(self):
+		if self.gauges:
+			for name, value in self.gauges().items():
+				self.metrics.set(name, value)
+		LOG.info(get_progress_line(self.metrics, self.genomes_total))
+		if self.filename:
+			self.metrics.write_prometheus(self.filename)
+
+	def run(self):
+		while not self._stopped.wait(self.interval):
+			self.report()
+
+	def stop(self):
+		self._stopped.set()
+		self.join()
+		self.report()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+Pipelined ingestion.
+Each chunk of kmers passes through four stages: extraction from the fasta file,
+lookup of the kmers already in the graph, insertion of the new kmer nodes and
+insertion of the genome edges. Each stage runs in its own threads, joined to the
+next by a bounded queue, so while one chunk waits on dgraph the next is being
+extracted and others are in flight. A full queue blocks the stage feeding it, which
+bounds the chunks held in memory.
+
+New kmer nodes are inserted by a single thread, so no two chunks ever create the
+same kmer. A chunk looked up while an earlier chunk's kmers were being inserted is
+checked against those inserts before its own.
+"""
+
+import collections
+import logging
+import queue
+import threading
+from pans_labyrinth import dgraph, commandline, kmers
+
+LOG = logging.getLogger('pans_labyrinth')
+
+# Default number of chunks held in each queue between stages
+QUEUE_SIZE = 4
+
+# Seconds a blocked stage waits before checking whether the pipeline has failed
+POLL_INTERVAL = 0.1
+
+# Marks the end of the chunks in a queue
+STOP = None
+
+
+class Pipeline(object):
+	"""
+	Inserts genomes through the staged threads. The lookup and edge stages have
+	workers threads each; extraction and node insertion have one.
+	At most workers * 2 + queue_size * 3 + 2 chunks are in flight at once.
+	"""
+
+	def __init__(self, client, kmer_size, workers=4, queue_size=QUEUE_SIZE, progress=None, chunk_size=None):
+		"""
+		:param client: dgraph client, shared by every stage
+		:param kmer_size: Size of kmer
+		:param workers: Number of threads in the lookup and edge stages
+		:param queue_size: Maximum chunks in each queue between stages
+		:param progress: manifest.Manifest to resume from and record progress in
+		:param chunk_size: Maximum number of kmers in a chunk, defaults to dgraph.KMER_CHUNK_SIZE
+		"""
+		self.client = client
+		self.kmer_size = kmer_size
+		self.chunk_size = chunk_size or dgraph.KMER_CHUNK_SIZE
+		self.workers = workers
+		self.progress = progress
+		self._lookup_queue = queue.Queue(queue_size)
+		self._insert_queue = queue.Queue(queue_size)
+		self._edge_queue = queue.Queue(queue_size)
+		self._failed = threading.Event()
+		self._error = None
+		self._lock = threading.Lock()
+		self._genomes = {}
+
+		# Node inserts are numbered; those newer than the oldest lookup in flight are kept
+		self._inserts = 0
+		self._recent = collections.deque()
+		self._lookups = collections.Counter()
+
+	def run(self, filepaths, skip_genomes=()):
+		"""
+		Insert the genomes of the fasta files, returning once all are in the graph
+		:param filepaths: The absolute paths to the fasta files to insert
+		:param skip_genomes: genome names already in the graph, which are not inserted again
+		:return: None
+		"""
+		stages = [
+			([threading.Thread(target=self._guard, args=(self.extract, filepaths, skip_genomes))], self._lookup_queue),
+			([threading.Thread(target=self._guard, args=(self.lookup,)) for i in range(self.workers)], self._insert_queue),
+			([threading.Thread(target=self._guard, args=(self.insert,))], self._edge_queue),
+			([threading.Thread(target=self._guard, args=(self.add_edges,)) for i in range(self.workers)], None),
+		]
+		for threads, output in stages:
+			for thread in threads:
+				thread.daemon = True
+				thread.start()
+
+		# Once a stage has finished, tell each thread of the next that no more chunks will come
+		for i, (threads, output) in enumerate(stages):
+			for thread in threads:
+				thread.join()
+			if output is not None:
+				for thread in stages[i + 1][0]:
+					self._put(output, STOP)
+
+		if self._error is not None:
+			raise self._error
+
+	def _guard(self, stage, *args):
+		"""
+		Run a stage, stopping the whole pipeline if it fails
+		"""
+		try:
+			stage(*args)
+		except BaseException as e:
+			LOG.critical("Pipeline stage {0} failed - {1}".format(stage.__name__, e))
+			with self._lock:
+				if self._error is None:
+					self._error = e
+			self._failed.set()
+
+	def _put(self, output, item):
+		while not self._failed.is_set():
+			try:
+				output.put(item, timeout=POLL_INTERVAL)
+				return
+			except queue.Full:
+				continue
+
+	def _get(self, source):
+		"""
+		:return: The next chunk, or STOP at the end or once the pipeline has failed
+		"""
+		while not self._failed.is_set():
+			try:
+				return source.get(timeout=POLL_INTERVAL)
+			except queue.Empty:
+				continue
+		return STOP
+
+	def extract(self, filepaths, skip_genomes):
+		"""
+		Stage reading the kmers of each genome in turn, in chunks
+		"""
+		for filepath in filepaths:
+			genome = "genome_" + commandline.compute_hash(filepath)
+			if genome in skip_genomes or (self.progress and self.progress.is_genome_done(genome)):
+				LOG.info("Skipping {0}, already in the graph".format(filepath))
+				dgraph.METRICS.add("genomes_skipped")
+				continue
+			dgraph.add_genome_to_schema(self.client, genome)
+
+			state = {'filepath': filepath, 'contigs': [], 'pending': 0, 'extracted': False}
+			with self._lock:
+				self._genomes[genome] = state
+			segments = {}
+			chunk_counts = {}
+			for contig, kmer_array in dgraph.get_kmers_chunks(filepath, self.kmer_size, self.chunk_size):
+				if self._failed.is_set():
+					return
+				dgraph.add_contig_segment(segments, state['contigs'], contig, kmer_array, self.kmer_size)
+				chunk = chunk_counts.get(contig, 0)
+				chunk_counts[contig] = chunk + 1
+				if self.progress and self.progress.is_chunk_done(genome, contig, chunk):
+					continue
+				with self._lock:
+					state['pending'] += 1
+				self._put(self._lookup_queue, {'genome': genome, 'contig': contig, 'chunk': chunk,
+											   'kmers': kmer_array})
+
+			with self._lock:
+				state['extracted'] = True
+				finished = state['pending'] == 0
+			if finished:
+				self.finish_genome(genome)
+
+	def lookup(self):
+		"""
+		Stage resolving the uids of the kmers already in the graph
+		"""
+		while True:
+			item = self._get(self._lookup_queue)
+			if item is STOP:
+				return
+			dgraph.METRICS.add("kmers", len(item['kmers']))
+			item['forward'] = None
+			if dgraph.CANONICAL:
+				item['kmers'], item['forward'] = kmers.get_canonical_kmers(item['kmers'], self.kmer_size)
+
+			with self._lock:
+				item['since'] = self._inserts
+				self._lookups[item['since']] += 1
+			item['uids'], item['missing'] = dgraph.get_kmers_uids(self.client, item['kmers'], self.kmer_size)
+			self._put(self._insert_queue, item)
+
+	def insert(self):
+		"""
+		Stage adding the kmer nodes that are not yet in the graph
+		"""
+		while True:
+			item = self._get(self._insert_queue)
+			if item is STOP:
+				return
+			missing = item['missing']
+			if len(missing):
+				# Nodes inserted since this chunk was looked up are not in its uids
+				for number, inserted in self._recent:
+					if number > item['since']:
+						dgraph.add_kmers_dict(item['uids'], [{'kmer': kmer, 'uid': inserted[kmer]}
+															for kmer in missing.tolist() if kmer in inserted])
+				missing = dgraph.get_kmers_missing(missing, item['uids'])
+
+			if len(missing):
+				txn_result = dgraph.add_kmers_uids(self.client, missing, self.kmer_size, item['uids'])
+				with self._lock:
+					self._inserts += 1
+					self._recent.append((self._inserts, {ku['kmer']: ku['uid'] for ku in txn_result}))
+
+			with self._lock:
+				self._lookups[item['since']] -= 1
+				if not self._lookups[item['since']]:
+					del self._lookups[item['since']]
+				oldest = min(self._lookups) if self._lookups else self._inserts
+				while self._recent and self._recent[0][0] <= oldest:
+					self._recent.popleft()
+			self._put(self._edge_queue, item)
+
+	def add_edges(self):
+		"""
+		Stage adding the genome edges between the kmers of each chunk
+		"""
+		while True:
+			item = self._get(self._edge_queue)
+			if item is STOP:
+				return
+			with dgraph.METRICS.time("edge_insert"):
+				dgraph.add_edges_kmers(self.client, item['kmers'], item['uids'], item['genome'], self.kmer_size,
+									   item['forward'])
+			if self.progress:
+				self.progress.add_chunk(item['genome'], item['contig'], item['chunk'])
+
+			state = self._genomes[item['genome']]
+			with self._lock:
+				state['pending'] -= 1
+				finished = state['extracted'] and state['pending'] == 0
+			if finished:
+				self.finish_genome(item['genome'])
+
+	def finish_genome(self, genome):
+		"""
+		Add the metadata of a genome once all its edges are in the graph
+		:param genome: The genome name in the form genome_hash
+		:return: None
+		"""
+		with self._lock:
+			state = self._genomes.pop(genome)
+		dgraph.add_metadata_dgraph(self.client, genome, state['filepath'], self.kmer_size, state['contigs'])
+		dgraph.METRICS.add("genomes")
+		if self.progress:
+			self.progress.add_genome(genome, state['filepath'])
+		LOG.info("Finished inserting {0}".format(genome))
+
+
+def create_graph_pipeline(client, filepaths, workers, kmer_size=11, progress=None, skip_genomes=(),
+						  queue_size=QUEUE_SIZE):
+	"""
+	Build the graph from many fasta files through a Pipeline
+	:param client: dgraph client
+	:param filepaths: The absolute paths to the fasta files to insert
+	:param workers: Number of threads in the lookup and edge stages
+	:param kmer_size: Size of kmer
+	:param progress: manifest.Manifest to resume from and record progress in
+	:param skip_genomes: genome names already in the graph, which are not inserted again
+	:param queue_size: Maximum chunks in each queue between stages
+	:return: None
+	"""
+	LOG.info("Creating graph through the pipeline with {0} workers".format(workers))
+	Pipeline(client, kmer_size, workers, queue_size, progress).run(list(filepaths), set(skip_genomes))
+	LOG.info("Kmer cache: {hits} hits, {misses} misses, {size} entries".format(**dgraph.KMER_CACHE.stats()))
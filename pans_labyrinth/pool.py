@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+A pool of dgraph client stubs spread over one or more Alpha endpoints.
+ClientPool can be passed anywhere a dgraph client is expected, as it provides the
+txn(), query() and alter() calls used by the dgraph module.
+"""
+
+import grpc
+import itertools
+import logging
+import pydgraph
+import sys
+import threading
+
+LOG = logging.getLogger('pans_labyrinth')
+
+# Ways of picking the stub for the next request
+ROUND_ROBIN = "round_robin"
+LEAST_OUTSTANDING = "least_outstanding"
+
+# gRPC status codes that mean the stub has lost its connection
+CONNECTION_ERRORS = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.CANCELLED)
+
+
+def is_connection_error(error):
+	"""
+	:param error: An exception raised by a gRPC call
+	:return: True if the error means the stub should be reconnected
+	"""
+	return isinstance(error, grpc.RpcError) and error.code() in CONNECTION_ERRORS
+
+
+class PooledTxn(object):
+	"""
+	A transaction holding one stub of the pool until it is discarded.
+	Everything other than discard() is passed straight to the pydgraph Txn.
+	"""
+
+	def __init__(self, pool, slot, txn):
+		self._pool = pool
+		self._slot = slot
+		self._txn = txn
+		self._released = False
+
+	def __getattr__(self, name):
+		attr = getattr(self._txn, name)
+		if not callable(attr):
+			return attr
+
+		def call(*args, **kwargs):
+			try:
+				return attr(*args, **kwargs)
+			except Exception as e:
+				if is_connection_error(e):
+					self._pool.reconnect(self._slot)
+				raise
+		return call
+
+	def discard(self):
+		try:
+			self._txn.discard()
+		finally:
+			if not self._released:
+				self._released = True
+				self._pool.release(self._slot)
+
+
+class ClientPool(object):
+	"""
+	Holds stubs_per_alpha stubs for each Alpha address, each with its own client.
+	Requests are spread over them by round robin, or to the stub with the fewest
+	requests outstanding. A stub that loses its connection is replaced, and queries
+	and schema changes are retried once on another stub.
+	"""
+
+	def __init__(self, addresses, stubs_per_alpha=1, strategy=ROUND_ROBIN):
+		"""
+		:param addresses: list of Alpha addresses in the form host:port
+		:param stubs_per_alpha: Number of stubs opened to each address
+		:param strategy: ROUND_ROBIN or LEAST_OUTSTANDING
+		"""
+		if strategy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+			LOG.critical("Unknown client pool strategy {0}".format(strategy))
+			sys.exit()
+
+		self.strategy = strategy
+		# Interleave the addresses so round robin alternates between Alphas
+		self.addresses = [address for i in range(stubs_per_alpha) for address in addresses]
+		self._lock = threading.Lock()
+		self._next = itertools.count()
+		self._outstanding = [0] * len(self.addresses)
+		self._stubs = []
+		self._clients = []
+		for address in self.addresses:
+			LOG.info("Creating client stub for {0}".format(address))
+			stub = pydgraph.DgraphClientStub(address)
+			self._stubs.append(stub)
+			self._clients.append(pydgraph.DgraphClient(stub))
+
+	def __len__(self):
+		return len(self._stubs)
+
+	def acquire(self):
+		"""
+		Pick the stub for the next request and count it as outstanding
+		:return: index of the stub
+		"""
+		with self._lock:
+			if self.strategy == ROUND_ROBIN:
+				slot = next(self._next) % len(self._stubs)
+			else:
+				slot = self._outstanding.index(min(self._outstanding))
+			self._outstanding[slot] += 1
+		return slot
+
+	def release(self, slot):
+		"""
+		:param slot: index of a stub returned by acquire()
+		"""
+		with self._lock:
+			self._outstanding[slot] -= 1
+
+	def reconnect(self, slot):
+		"""
+		Replace the stub at slot with a new connection to the same address
+		:param slot: index of the stub
+		"""
+		with self._lock:
+			address = self.addresses[slot]
+			LOG.warning("Reconnecting client stub for {0}".format(address))
+			try:
+				self._stubs[slot].close()
+			except Exception:
+				pass
+			stub = pydgraph.DgraphClientStub(address)
+			self._stubs[slot] = stub
+			self._clients[slot] = pydgraph.DgraphClient(stub)
+
+	def _call(self, method, *args, **kwargs):
+		"""
+		Run a client method on a pooled stub, retrying once on another stub if
+		the connection fails.
+		"""
+		for attempt in range(2):
+			slot = self.acquire()
+			try:
+				return getattr(self._clients[slot], method)(*args, **kwargs)
+			except Exception as e:
+				if not is_connection_error(e) or attempt == 1:
+					raise
+				self.reconnect(slot)
+			finally:
+				self.release(slot)
+
+	def txn(self, *args, **kwargs):
+		"""
+		:return: A transaction on a pooled stub, released when discarded
+		"""
+		slot = self.acquire()
+		try:
+			return PooledTxn(self, slot, self._clients[slot].txn(*args, **kwargs))
+		except Exception:
+			self.release(slot)
+			raise
+
+	def query(self, *args, **kwargs):
+		return self._call("query", *args, **kwargs)
+
+	def alter(self, *args, **kwargs):
+		return self._call("alter", *args, **kwargs)
+
+	def close(self):
+		"""
+		Close every stub in the pool
+		"""
+		with self._lock:
+			for stub in self._stubs:
+				stub.close()
@@ -1,6 +1,9 @@
 import pytest
-from pans_labyrinth import main, files, dgraph, commandline, logging_functions
+from pans_labyrinth import main, files, dgraph, commandline, logging_functions, benchmark
 import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from Bio import SeqIO
 
 
@@ -135,4 +138,171 @@ def test_verify_contig():
 			sequence = record.seq
 	sequence_string = str(sequence)
 
-	assert contig == sequence_string[:-1]
+	assert contig == sequence_string
+
+def test_upsert_insert():
+	"""
+	Inserting the same kmers twice through the upsert path must not create
+	duplicate kmer nodes, and the edges must match the query path.
+	"""
+	stub = dgraph.create_client_stub()
+	client = dgraph.create_client(stub)
+	dgraph.drop_all(client)
+	dgraph.add_schema(client)
+	dgraph.add_genome_to_schema(client, "test_genome")
+
+	kmers = {"genome" : ["AAAA", "TTTT", "CCCC", "GGGG"]}
+	dgraph.WRITE_MODE = dgraph.WRITE_UPSERT
+	try:
+		dgraph.add_kmers_dgraph(client, kmers, "test_genome")
+		dgraph.add_kmers_dgraph(client, kmers, "test_genome")
+	finally:
+		dgraph.WRITE_MODE = dgraph.WRITE_QUERY
+
+	sg1 = dgraph.example_query(client, "test_genome")
+	assert [x["kmer"] for x in sg1[:-1]] == kmers["genome"][:-1]
+	assert sg1[-1]["test_genome"][0]["kmer"] == kmers["genome"][-1]
+
+def test_query_genomes():
+	"""
+	Genomes added to the schema must be found for an incremental build.
+	"""
+	stub = dgraph.create_client_stub()
+	client = dgraph.create_client(stub)
+	dgraph.drop_all(client)
+	dgraph.add_schema(client)
+	dgraph.add_genome_to_schema(client, "genome_abc")
+	dgraph.add_genome_to_schema(client, "genome_def")
+
+	assert dgraph.query_genomes_dgraph(client) == {"genome_abc", "genome_def"}
+
+def test_metadata():
+	"""
+	The metadata of a genome must list each contig with its first and last kmers,
+	and the path query must return every contig in order.
+	"""
+	stub = dgraph.create_client_stub()
+	client = dgraph.create_client(stub)
+	dgraph.drop_all(client)
+	dgraph.add_schema(client)
+	dgraph.add_genome_to_schema(client, "genome_test")
+
+	kmers = {"contig_1" : ["AAAA", "TTTT", "CCCC"], "contig_2" : ["GGGG", "ACGT"]}
+	contigs = dgraph.add_kmers_dgraph(client, kmers, "genome_test")
+	dgraph.add_metadata_dgraph(client, "genome_test", "test.fasta", 4, contigs)
+
+	metadata = dgraph.query_metadata_dgraph(client, "genome_test")
+	assert [c["contig_id"] for c in metadata["contigs"]] == ["contig_1", "contig_2"]
+	assert metadata["contigs"][0]["first_kmer"]["kmer"] == "AAAA"
+	assert metadata["contigs"][1]["last_kmer"]["kmer"] == "ACGT"
+
+	paths = list(dgraph.get_genome_paths(client, "genome_test"))
+	assert [[node["kmer"] for node in path] for path in paths] == list(kmers.values())
+
+	# Loading the genome again replaces its contigs
+	dgraph.add_metadata_dgraph(client, "genome_test", "test.fasta", 4, contigs)
+	metadata = dgraph.query_metadata_dgraph(client, "genome_test")
+	assert [c["contig_id"] for c in metadata["contigs"]] == ["contig_1", "contig_2"]
+
+def test_shared_repeat_paths():
+	"""
+	Contigs sharing a repeat must each be rebuilt from their own first kmer to their
+	last, rather than one walk taking the other contig's edges after the repeat.
+	"""
+	stub = dgraph.create_client_stub()
+	client = dgraph.create_client(stub)
+	dgraph.drop_all(client)
+	dgraph.add_schema(client)
+
+	genome, contigs = next(benchmark.get_synthetic_genomes(1, 12000, contigs=3))
+	repeat = next(benchmark.get_synthetic_genomes(1, 300, seed=1))[1][0][1]
+	contigs = [(cid, sequence[:2000] + repeat + sequence[2000:]) if i < 2 else (cid, sequence)
+			   for i, (cid, sequence) in enumerate(contigs)]
+	benchmark.add_genome_synthetic(client, genome, contigs, 15)
+
+	assert list(dgraph.get_genome_sequence(client, genome)) == [sequence for cid, sequence in contigs]
+
+def test_parallel_overlapping_insert():
+	"""
+	Two workers inserting genomes that share most of their kmers at the same time must
+	leave exactly one node for each kmer.
+	"""
+	stub = dgraph.create_client_stub()
+	client = dgraph.create_client(stub)
+	dgraph.drop_all(client)
+	dgraph.add_schema(client)
+
+	genomes = list(benchmark.get_synthetic_genomes(2, 20000, similarity=0.999))
+	with ThreadPoolExecutor(2) as executor:
+		list(executor.map(lambda genome: benchmark.add_genome_synthetic(client, genome[0], genome[1], 11), genomes))
+
+	res = client.txn(read_only=True).query("{ all(func: has(kmer)) { kmer } }")
+	all_kmers = [node["kmer"] for node in json.loads(res.json)["all"]]
+	assert len(all_kmers) == len(set(all_kmers))
+	for genome, contigs in genomes:
+		assert list(dgraph.get_genome_sequence(client, genome)) == [sequence for cid, sequence in contigs]
+
+def test_delete_stale_cache():
+	"""
+	A load whose kmer cache still holds the nodes of a deleted genome must give them
+	back their kmers, and a graph with a genome that has no metadata must refuse deletes.
+	"""
+	stub = dgraph.create_client_stub()
+	client = dgraph.create_client(stub)
+	dgraph.drop_all(client)
+	dgraph.add_schema(client)
+
+	(first, first_contigs), (second, second_contigs) = benchmark.get_synthetic_genomes(2, 2000, similarity=0.95)
+	benchmark.add_genome_synthetic(client, first, first_contigs, 11)
+	packed = np.unique(np.concatenate([chunk for contig, chunk in benchmark.get_kmers_synthetic(first_contigs, 11)]))
+	cached = dgraph.KMER_CACHE.get_uids(packed.tolist())
+	dgraph.delete_genome_dgraph(client, first)
+
+	# As in another process loading while the genome was deleted
+	dgraph.KMER_CACHE.add_kmers([{'kmer': kmer, 'uid': uid} for kmer, uid in cached.items()])
+	benchmark.add_genome_synthetic(client, first, first_contigs, 11)
+	assert list(dgraph.get_genome_sequence(client, first)) == [sequence for cid, sequence in first_contigs]
+
+	dgraph.add_genome_to_schema(client, second)
+	dgraph.add_kmers_dgraph(client, benchmark.get_kmers_synthetic(second_contigs, 11), second, 11)
+	with pytest.raises(SystemExit):
+		dgraph.delete_genome_dgraph(client, first)
+	dgraph.KMER_CACHE.clear()
+
+def test_unitig_paths():
+	"""
+	Genomes compacted into unitigs must share the unitigs of their common sequence,
+	and each genome's sequence must be rebuilt from its path over them.
+	"""
+	stub = dgraph.create_client_stub()
+	client = dgraph.create_client(stub)
+	dgraph.drop_all(client)
+	dgraph.add_schema(client)
+
+	sequences = {"genome_a": "ACGTTGCATGGACCTAGT", "genome_b": "TTGCATGGACCAAGT"}
+	genomes = [(genome, genome, [("contig", chunk) for chunk in dgraph.kmers.get_kmers_sequence(sequence, 5, 100)])
+			   for genome, sequence in sequences.items()]
+	dgraph.add_genomes_unitig_dgraph(client, genomes, 5)
+
+	assert len(dgraph.query_unitigs_dgraph(client, ["TTGCATGGACC"])) == 1
+	for genome, sequence in sequences.items():
+		assert list(dgraph.get_genome_sequence(client, genome)) == [sequence]
+
+def test_kmer_size():
+	"""
+	The graph must record its kmer size, and refuse kmers of another size.
+	"""
+	stub = dgraph.create_client_stub()
+	client = dgraph.create_client(stub)
+	dgraph.drop_all(client)
+	dgraph.add_schema(client)
+	assert dgraph.query_kmer_size_dgraph(client) is None
+
+	dgraph.add_genome_to_schema(client, "genome_test")
+	contigs = dgraph.add_kmers_dgraph(client, {"contig_1" : ["A" * 31, "C" * 31]}, "genome_test")
+	dgraph.add_metadata_dgraph(client, "genome_test", "test.fasta", 31, contigs)
+	assert dgraph.query_kmer_size_dgraph(client) == 31
+
+	dgraph.check_kmer_size_dgraph(client, 31)
+	with pytest.raises(SystemExit):
+		dgraph.check_kmer_size_dgraph(client, 11)
@@ -1,5 +1,8 @@
 import pytest
-from pans_labyrinth import main, files, dgraph, commandline, logging_functions
+from pans_labyrinth import main, files, dgraph, commandline, logging_functions, kmers, cache, pool, export, manifest, benchmark, unitig, backend, metrics, pipeline, membership, matrix, bloom
+import os
+import gzip
+import numpy as np
 
 def inc(x):
     return x + 1
@@ -7,3 +10,592 @@ def inc(x):
 
 def test_query():
     assert inc(3) == 4
+
+
+@pytest.mark.parametrize("kmer_size", [11, 31, 32])
+def test_kmer_chunks(kmer_size):
+    """
+    Chunked kmers must overlap by one kmer and together cover every kmer of the
+    contig, as returned by get_kmers_files().
+    """
+    filename = os.path.abspath("data/genomes/test/test.fasta")
+    all_kmers = dgraph.get_kmers_files(filename, kmer_size)
+    chunks = [(contig, kmers.decode_kmers(chunk, kmer_size))
+              for contig, chunk in dgraph.get_kmers_chunks(filename, kmer_size, chunk_size=50)]
+    for contig, contig_kmers in all_kmers.items():
+        contig_chunks = [c for cid, c in chunks if cid == contig]
+        assert all(len(c) <= 50 for c in contig_chunks)
+        for prev, nxt in zip(contig_chunks, contig_chunks[1:]):
+            assert prev[-1] == nxt[0]
+        joined = contig_chunks[0] + [k for c in contig_chunks[1:] for k in c[1:]]
+        assert joined == contig_kmers
+
+
+def test_packed_kmers():
+    """
+    Packing and unpacking kmers must give back the original strings, and kmers
+    are never built across an ambiguous base.
+    """
+    kmer_list = ["ACGTACGTACG", "TTTTTTTTTTT", "GATTACAGATT"]
+    assert kmers.decode_kmers(kmers.encode_kmers(kmer_list), 11) == kmer_list
+    assert kmers.decode_kmers(kmers.encode_kmers(["A" * 32, "T" * 32]), 32) == ["A" * 32, "T" * 32]
+
+    chunks = list(kmers.get_kmers_sequence("ACGTANNacgtacGT", 4, 100))
+    assert [kmers.decode_kmers(c, 4) for c in chunks] == [["ACGT", "CGTA"],
+                                                        ["ACGT", "CGTA", "GTAC", "TACG", "ACGT"]]
+
+    # The smallest chunks still share a kmer, and chunks of one kmer could not
+    chunks = list(kmers.get_kmers_sequence("ACGTAC", 4, 2))
+    assert [kmers.decode_kmers(c, 4) for c in chunks] == [["ACGT", "CGTA"], ["CGTA", "GTAC"]]
+    with pytest.raises(SystemExit):
+        list(kmers.get_kmers_sequence("ACGTAC", 4, 1))
+
+
+def test_canonical_kmers():
+    """
+    A kmer and its reverse complement must share one canonical kmer, and each
+    strand must be recorded on the edges.
+    """
+    packed = kmers.encode_kmers(["AACGT", "ACGTT", "GGGCC"])
+    assert kmers.decode_kmers(kmers.get_reverse_complement(packed, 5), 5) == ["ACGTT", "AACGT", "GGCCC"]
+    long_kmer = kmers.encode_kmers(["A" * 31 + "C"])
+    assert kmers.decode_kmers(kmers.get_reverse_complement(long_kmer, 32), 32) == ["G" + "T" * 31]
+
+    canonical, forward = kmers.get_canonical_kmers(packed, 5)
+    assert kmers.decode_kmers(canonical, 5) == ["AACGT", "AACGT", "GGCCC"]
+    assert forward.tolist() == [True, False, False]
+    assert dgraph.get_orientation_facets(forward, 3) == [' (orientation="+-")', ' (orientation="--")', '']
+
+    nodes = {"0x1": {"uid": "0x1", "kmer": "AACGT"}, "0x2": {"uid": "0x2", "kmer": "GGCCC"}}
+    path = dgraph.get_path_oriented(["0x1", "0x2"], nodes, {("0x1", "0x2"): "+-"})
+    assert [node["kmer"] for node in path] == ["AACGT", "GGGCC"]
+
+
+def test_kmer_cache():
+    """
+    The cache must count hits and misses and evict the least recently used kmer.
+    """
+    kmer_cache = cache.KmerCache(max_size=2)
+    kmer_cache.add_kmers([{'kmer': 1, 'uid': '0x1'}, {'kmer': 2, 'uid': '0x2'}])
+    assert kmer_cache.get_uids([1, 3]) == {1: '0x1'}
+    kmer_cache.add_kmers([{'kmer': 3, 'uid': '0x3'}])
+    assert kmer_cache.get_uids([1, 2, 3]) == {1: '0x1', 3: '0x3'}
+    stats = kmer_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (3, 2, 2)
+
+
+def test_batches():
+    """
+    Batches must respect both the count and the byte limits without losing quads.
+    """
+    quads = ["<0x{0}> <kmer> \"ACGT\" .\n".format(i) for i in range(25)]
+    batches = list(dgraph.get_batches(quads, batch_size=10, batch_bytes=1000))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    batches = list(dgraph.get_batches(quads, batch_size=100, batch_bytes=len(quads[0]) * 4))
+    assert all(len(''.join(b)) <= len(quads[0]) * 4 for b in batches)
+    assert [q for b in batches for q in b] == quads
+
+
+def test_linked_batches():
+    """
+    Every batch of edges must also set the kmer of each node its edges link, once.
+    """
+    uids = ["0x{0:x}".format(i + 1) for i in range(25)]
+    node_quads = dgraph.get_node_quads(uids, ["ACGT"] * len(uids))
+    edges = [("<{0}> <genome_test> <{1}> .\n".format(s, t), s, t) for s, t in zip(uids, uids[1:])]
+    for batch in dgraph.get_linked_batches(edges, node_quads, batch_size=10, batch_bytes=400):
+        assert len(batch) <= 10 and len(''.join(batch)) <= 400
+        linked = set(uid for quad, s, t in edges if quad in batch for uid in (s, t))
+        assert sorted(q for q in batch if "<kmer>" in q) == sorted(node_quads[uid] for uid in linked)
+
+
+def test_client_pool():
+    """
+    Stubs are handed out round robin, or to the stub with the fewest requests
+    outstanding. Creating stubs does not connect, so no server is needed.
+    """
+    client_pool = pool.ClientPool(["localhost:9080", "localhost:9081"], 2)
+    assert [client_pool.acquire() for i in range(5)] == [0, 1, 2, 3, 0]
+    client_pool.close()
+
+    client_pool = pool.ClientPool(["localhost:9080"], 3, pool.LEAST_OUTSTANDING)
+    first = client_pool.acquire()
+    second = client_pool.acquire()
+    client_pool.release(first)
+    assert client_pool.acquire() == first
+    assert client_pool.acquire() not in (first, second)
+    client_pool.close()
+
+
+def test_export_rdf(tmp_path):
+    """
+    The export must name kmer nodes for the packed kmer, link every kmer of a contig,
+    write the genome edge to the schema, and write the metadata of each contig.
+    """
+    filepath = os.path.abspath("data/genomes/test/test.fasta")
+    genomes = export.export_rdf([filepath], str(tmp_path), 11)
+    genome = "genome_" + commandline.compute_hash(filepath)
+    assert genomes == [genome]
+
+    with open(str(tmp_path / export.SCHEMA_FILENAME)) as f:
+        assert "{0}: [uid] .".format(genome) in f.read()
+
+    with gzip.open(str(tmp_path / (genome + ".rdf.gz")), "rt") as f:
+        quads = f.read().splitlines()
+    all_kmers = dgraph.get_kmers_files(filepath, 11)
+    edges = [q for q in quads if "<{0}>".format(genome) in q]
+    assert len(edges) == sum(len(v) - 1 for v in all_kmers.values())
+    first = list(all_kmers.values())[0][0]
+    packed = kmers.encode_kmers([first]).tolist()[0]
+    assert '_:k{0} <kmer> "{1}" .'.format(packed, first) in quads
+
+    assert len([q for q in quads if "<contig_id>" in q]) == len(all_kmers)
+    assert '_:{0}_c0 <first_kmer> _:k{1} .'.format(genome, packed) in quads
+    assert '_:{0} <filename> "{1}" .'.format(genome, filepath) in quads
+
+
+def test_upsert_block():
+    """
+    Each distinct kmer gets one query variable, and repeated kmers reuse it in the edges.
+    """
+    kmer_array = kmers.encode_kmers(["AAAA", "CCCC", "AAAA", "GGGG"])
+    query, nquads = dgraph.get_upsert_dgraph(kmer_array, "test_genome", 4)
+    assert query.count(" as var(") == 3
+    assert 'k0 as var(func: eq(kmer, "AAAA"))' in query
+    edges = [q for q in nquads.splitlines() if "test_genome" in q]
+    assert edges == ["uid(k0) <test_genome> uid(k1) .",
+                     "uid(k1) <test_genome> uid(k0) .",
+                     "uid(k0) <test_genome> uid(k2) ."]
+
+
+def test_manifest(tmp_path):
+    """
+    Progress written to the manifest must be read back on resume, ignoring a line
+    cut short by a crash, and discarded when not resuming.
+    """
+    filename = str(tmp_path / "manifest.jsonl")
+    progress = manifest.Manifest(filename)
+    progress.add_chunk("genome_a", "contig_1", 0)
+    progress.add_genome("genome_b", "b.fasta")
+    progress.close()
+    with open(filename, "a") as f:
+        f.write('{"genome": "genome_a", "con')
+
+    progress = manifest.Manifest(filename)
+    assert progress.is_chunk_done("genome_a", "contig_1", 0)
+    assert not progress.is_chunk_done("genome_a", "contig_1", 1)
+    assert progress.is_genome_done("genome_b")
+    assert not progress.is_genome_done("genome_a")
+    progress.add_genome("genome_c", "c.fasta")
+    progress.close()
+    assert manifest.Manifest(filename).is_genome_done("genome_c")
+
+    progress = manifest.Manifest(filename, resume=False)
+    assert not progress.is_genome_done("genome_b")
+    progress.close()
+
+
+def test_path_walk():
+    """
+    The walk must follow a linear path from its start, and use every edge of a
+    path that revisits a kmer.
+    """
+    successors = {"0x1": ["0x2"], "0x2": ["0x3"], "0x3": []}
+    assert dgraph.get_path_walk(successors, "0x1") == ["0x1", "0x2", "0x3"]
+
+    # 1 -> 2 -> 3 -> 2 -> 4
+    successors = {"0x1": ["0x2"], "0x2": ["0x4", "0x3"], "0x3": ["0x2"]}
+    walk = dgraph.get_path_walk(successors, "0x1")
+    assert walk == ["0x1", "0x2", "0x3", "0x2", "0x4"]
+    assert not any(successors.values())
+
+
+def test_unitigs():
+    """
+    Genomes compacted together must split into the same unitigs where they share
+    sequence, and their unitigs must spell the genome back out.
+    """
+    sequences = {"genome_a": "ACGTTGCATGGACCTAGT", "genome_b": "TTGCATGGACCAAGT"}
+    genomes = {genome: [("contig", c) for c in kmers.get_kmers_sequence(sequence, 5, 4)]
+               for genome, sequence in sequences.items()}
+    paths, unitigs = unitig.get_genomes_unitigs(genomes, 5)
+
+    # genome_b starts at TTGCA and leaves genome_a after GGACC
+    assert paths["genome_a"] == [("contig", ["ACGTTGC", "TTGCATGGACC", "GACCTAGT"])]
+    assert paths["genome_b"] == [("contig", ["TTGCATGGACC", "GACCAAGT"])]
+    assert unitigs == sorted({u for genome in paths.values() for contig, path in genome for u in path})
+    for genome, sequence in sequences.items():
+        path = paths[genome][0][1]
+        assert path[0] + ''.join(u[4:] for u in path[1:]) == sequence
+
+
+def test_synthetic_genomes():
+    """
+    Synthetic genomes must be repeatable, split into the requested contigs and
+    differ from each other by roughly the requested rate.
+    """
+    genomes = list(benchmark.get_synthetic_genomes(3, 10000, similarity=0.99, contigs=4))
+    assert genomes == list(benchmark.get_synthetic_genomes(3, 10000, similarity=0.99, contigs=4))
+    assert all(len(contigs) == 4 for name, contigs in genomes)
+    first = ''.join(seq for cid, seq in genomes[0][1])
+    second = ''.join(seq for cid, seq in genomes[1][1])
+    assert len(first) == 10000
+    assert 0 < sum(a != b for a, b in zip(first, second)) < 500
+
+
+def test_genome_facet():
+    """
+    Genomes are packed into bitmask facets without reaching the sign bit.
+    """
+    assert dgraph.get_genome_facet(0) == ("g0", 1)
+    assert dgraph.get_genome_facet(62) == ("g0", 1 << 62)
+    assert dgraph.get_genome_facet(63) == ("g1", 1)
+
+
+def test_kmer_index():
+    """
+    The hash index must find every kmer added, through collisions and growth, and
+    no others.
+    """
+    keys = np.unique(np.random.default_rng(0).integers(0, 2 ** 63, 5000, dtype=np.uint64))
+    index = backend.KmerIndex(capacity=16)
+    index.add(keys[:3000], np.arange(3000))
+    assert len(index) == 3000
+    assert index.get(keys[:3000]).tolist() == list(range(3000))
+    assert (index.get(keys[3000:]) == -1).all()
+
+
+def test_memory_backend(tmp_path):
+    """
+    Genomes built in the memory backend must be read back as they were inserted,
+    sharing their kmers, and again after saving and loading the graph.
+    """
+    client = backend.MemoryBackend()
+    dgraph.drop_all(client)
+    dgraph.add_schema(client)
+    genomes = list(benchmark.get_synthetic_genomes(3, 2000, contigs=2))
+    for genome, contigs in genomes:
+        benchmark.add_genome_synthetic(client, genome, contigs, 11)
+
+    assert dgraph.query_genomes_dgraph(client) == {genome for genome, contigs in genomes}
+    assert dgraph.query_kmer_size_dgraph(client) == 11
+    assert client._count < 3 * 2000
+    for genome, contigs in genomes:
+        assert list(dgraph.get_genome_sequence(client, genome)) == [sequence for cid, sequence in contigs]
+
+    client.save(str(tmp_path))
+    loaded = backend.MemoryBackend.load(str(tmp_path), mmap=True)
+    for genome, contigs in genomes:
+        assert list(dgraph.get_genome_sequence(loaded, genome)) == [sequence for cid, sequence in contigs]
+    dgraph.KMER_CACHE.clear()
+
+
+def test_benchmark_hot_paths():
+    """
+    The hot path benchmark must report every stage, counting every kmer of the
+    synthetic genomes.
+    """
+    results = benchmark.benchmark_hot_paths(backend.MemoryBackend(), genome_count=2, length=2000, contigs=2)
+    stages = {result['stage']: result for result in results}
+    assert set(stages) == {'get_kmers_files', 'get_kmers_chunks', 'query_kmers_dgraph', 'add_kmers_batch_dgraph',
+                           'add_edges_kmers', 'path_query', 'create_graph'}
+    assert stages['get_kmers_files']['kmers'] == 2 * (2000 - 2 * 10)
+    assert all(result['peak_rss_kb'] > 0 for result in results)
+    dgraph.KMER_CACHE.clear()
+
+
+def test_metrics(tmp_path):
+    """
+    Metrics must be written in the Prometheus text format with cumulative buckets,
+    and summarised in a progress line.
+    """
+    load = metrics.Metrics()
+    load.add("kmers", 500)
+    load.add("genomes")
+    load.set("kmer_cache_size", 250)
+    load.observe("lookup", 0.002)
+    load.observe("lookup", 2.0)
+    with load.time("edge_insert"):
+        pass
+    assert list(load.iterate([1, 2, 3], "parse")) == [1, 2, 3]
+
+    filename = str(tmp_path / "load.prom")
+    load.write_prometheus(filename)
+    with open(filename) as f:
+        text = f.read()
+    assert "pans_labyrinth_kmers_total 500\n" in text
+    assert "pans_labyrinth_kmer_cache_size 250\n" in text
+    assert 'pans_labyrinth_stage_seconds_bucket{stage="lookup",le="0.001"} 0\n' in text
+    assert 'pans_labyrinth_stage_seconds_bucket{stage="lookup",le="0.005"} 1\n' in text
+    assert 'pans_labyrinth_stage_seconds_bucket{stage="lookup",le="+Inf"} 2\n' in text
+    assert 'pans_labyrinth_stage_seconds_count{stage="parse"} 3\n' in text
+
+    line = metrics.get_progress_line(load, 4)
+    assert line.startswith("Progress: 1/4 genomes, 500 kmers")
+    assert "lookup" in line and "ETA" in line
+    load.add("genomes_skipped", 2)
+    assert metrics.get_progress_line(load, 4).startswith("Progress: 1/2 genomes")
+
+
+class StrictBackend(backend.MemoryBackend):
+    """
+    A memory backend that fails if a kmer node is added twice.
+    """
+
+    def add_kmers(self, kmer_array, kmer_size):
+        assert self.query_kmers(kmer_array, kmer_size) is None
+        return super(StrictBackend, self).add_kmers(kmer_array, kmer_size)
+
+
+def test_pipeline(tmp_path):
+    """
+    Genomes inserted through the pipeline, with many small chunks in flight, must
+    never add a kmer twice and must read back as the sequences inserted.
+    """
+    client = StrictBackend()
+    dgraph.KMER_CACHE.clear()
+    genomes = list(benchmark.get_synthetic_genomes(4, 3000, contigs=2))
+    filepaths = benchmark.write_synthetic_fasta(str(tmp_path), genomes)
+    pipeline.Pipeline(client, 11, workers=4, queue_size=2, chunk_size=50).run(filepaths)
+
+    for filepath, (name, contigs) in zip(filepaths, genomes):
+        genome = "genome_" + commandline.compute_hash(filepath)
+        assert list(dgraph.get_genome_sequence(client, genome)) == [sequence for cid, sequence in contigs]
+    dgraph.KMER_CACHE.clear()
+
+
+def test_fasta_reader(tmp_path):
+    """
+    Plain and gzipped fasta files must read back the same records, with the contig
+    id cut at the first whitespace, and the hash of the raw bytes.
+    """
+    text = ">c1 first contig\nACGTAC\nGTNN\n>c2\r\nTTGCA\r\n>c3\n"
+    plain = str(tmp_path / "genome.fna")
+    with open(plain, "w", newline="") as f:
+        f.write(text)
+    compressed = str(tmp_path / "genome.fa.gz")
+    with gzip.open(compressed, "wt", newline="") as f:
+        f.write(text)
+
+    for filename in (plain, compressed):
+        assert files.is_fasta(filename)
+        reader = files.FastaReader(filename)
+        assert list(reader) == [("c1", "ACGTACGTNN"), ("c2", "TTGCA"), ("c3", "")]
+        assert reader.hexdigest() == commandline.compute_hash(filename)
+    assert not files.is_fasta("genome.txt.gz")
+
+
+def test_membership():
+    """
+    A sequence taken from one genome must be fully covered by it, and a sequence
+    found in no genome covered by none.
+    """
+    client = backend.MemoryBackend()
+    dgraph.KMER_CACHE.clear()
+    genomes = list(benchmark.get_synthetic_genomes(3, 2000, similarity=0.9))
+    for genome, contigs in genomes:
+        benchmark.add_genome_synthetic(client, genome, contigs, 11)
+
+    names = membership.get_query_genomes(client)
+    assert names == sorted(genome for genome, contigs in genomes)
+    first = dict(genomes)[names[0]][0][1]
+    queries = [("gene", first[100:400]), ("absent", "A" * 50), ("short", "ACGT")]
+    rows = list(membership.get_membership(client, queries, names, 11, batch_size=100))
+
+    assert [row[0] for row in rows] == ["gene", "absent", "short"]
+    sequence_id, kmer_count, counts = rows[0]
+    assert kmer_count == 290 and counts[0] == 290 and counts[1:].max() < 290
+    assert rows[1][2].sum() == 0 and rows[2][1] == 0
+
+    # The graph records that its kmers are not canonical
+    assert dgraph.query_canonical_dgraph(client) is False
+    with pytest.raises(SystemExit):
+        dgraph.check_canonical_dgraph(client, True)
+    dgraph.KMER_CACHE.clear()
+
+
+def test_export_matrix(tmp_path):
+    """
+    Each row of the matrix must hold exactly the kmers of its genome, and the core
+    columns those held by every genome.
+    """
+    client = backend.MemoryBackend()
+    dgraph.KMER_CACHE.clear()
+    genomes = dict(benchmark.get_synthetic_genomes(3, 2000, similarity=0.95, contigs=2))
+    for genome, contigs in genomes.items():
+        benchmark.add_genome_synthetic(client, genome, contigs, 11)
+
+    filename = str(tmp_path / "matrix.npz")
+    assert matrix.export_matrix([client], filename, workers=2)[0] == 3
+    with np.load(filename) as npz:
+        assert npz["format"].item() == b"csr"
+        names = list(npz["genomes"])
+        kmer_sets = []
+        for row, genome in enumerate(names):
+            indices = npz["indices"][npz["indptr"][row]:npz["indptr"][row + 1]]
+            expected = np.unique(np.concatenate([chunk for contig, chunk in benchmark.get_kmers_synthetic(genomes[genome], 11)]))
+            assert np.array_equal(np.sort(npz["kmers"][indices]), expected)
+            kmer_sets.append(set(expected.tolist()))
+        assert set(npz["kmers"][npz["core"]].tolist()) == set.intersection(*kmer_sets)
+        assert npz["data"].all() and len(npz["data"]) == len(npz["indices"])
+    assert names == sorted(genomes)
+    dgraph.KMER_CACHE.clear()
+
+
+def test_delete_genome(tmp_path):
+    """
+    Deleting a genome must remove its edges and the kmers only it held, keep the
+    other genomes whole, and survive a save and load.
+    """
+    client = backend.MemoryBackend()
+    dgraph.KMER_CACHE.clear()
+    genomes = dict(benchmark.get_synthetic_genomes(3, 2000, similarity=0.95, contigs=2))
+    for genome, contigs in genomes.items():
+        benchmark.add_genome_synthetic(client, genome, contigs, 11)
+    first, *rest = sorted(genomes)
+
+    def get_kmer_set(genome):
+        return set(np.concatenate([chunk for contig, chunk in benchmark.get_kmers_synthetic(genomes[genome], 11)]).tolist())
+
+    owned = get_kmer_set(first) - get_kmer_set(rest[0]) - get_kmer_set(rest[1])
+    assert dgraph.delete_genome_dgraph(client, first) == len(owned)
+    assert dgraph.query_genomes_dgraph(client) == set(rest)
+    assert dgraph.query_metadata_dgraph(client, first) is None
+    assert client.query_kmers(np.array(sorted(owned), dtype=np.uint64), 11) is None
+    assert not dgraph.KMER_CACHE.get_uids(sorted(owned))
+
+    client.save(str(tmp_path))
+    loaded = backend.MemoryBackend.load(str(tmp_path))
+    benchmark.add_genome_synthetic(loaded, first, genomes[first], 11)
+    for genome in sorted(genomes):
+        assert list(dgraph.get_genome_sequence(loaded, genome)) == [sequence for cid, sequence in genomes[genome]]
+    dgraph.KMER_CACHE.clear()
+
+
+def test_genomes_loaded(tmp_path):
+    """
+    Without a manifest only the genomes whose metadata was written are loaded, and
+    with one only those it records.
+    """
+    client = backend.MemoryBackend()
+    (first, first_contigs), (second, second_contigs) = benchmark.get_synthetic_genomes(2, 500)
+    benchmark.add_genome_synthetic(client, first, first_contigs, 11)
+    dgraph.add_genome_to_schema(client, second)
+    dgraph.add_kmers_dgraph(client, benchmark.get_kmers_synthetic(second_contigs, 11), second, 11)
+    assert dgraph.get_genomes_loaded(client) == {first}
+
+    progress = manifest.Manifest(str(tmp_path / "manifest.jsonl"), False)
+    progress.add_genome(second, "second.fasta")
+    assert dgraph.get_genomes_loaded(client, progress) == {second}
+    progress.close()
+    dgraph.KMER_CACHE.clear()
+
+
+def test_reload_metadata():
+    """
+    Loading a genome again must replace its contigs rather than list them twice.
+    """
+    client = backend.MemoryBackend()
+    genome, contigs = next(benchmark.get_synthetic_genomes(1, 3000, contigs=3))
+    benchmark.add_genome_synthetic(client, genome, contigs, 11)
+    benchmark.add_genome_synthetic(client, genome, contigs, 11)
+    assert [c['contig_id'] for c in dgraph.query_metadata_dgraph(client, genome)['contigs']] == [cid for cid, sequence in contigs]
+    assert list(dgraph.get_genome_sequence(client, genome)) == [sequence for cid, sequence in contigs]
+    dgraph.KMER_CACHE.clear()
+
+
+def test_create_graph_streams_kmers(monkeypatch):
+    """
+    A serially loaded genome must be named from the file hash before it is read, and
+    its kmer chunks passed on as they are read rather than collected into a list.
+    """
+    filepath = os.path.abspath("data/genomes/test/test.fasta")
+    genome = "genome_" + commandline.compute_hash(filepath)
+    add_kmers_dgraph = dgraph.add_kmers_dgraph
+
+    def add_kmers_streamed(client, all_kmers, *args):
+        assert not isinstance(all_kmers, list)
+        return add_kmers_dgraph(client, all_kmers, *args)
+
+    monkeypatch.setattr(dgraph, "add_kmers_dgraph", add_kmers_streamed)
+    client = backend.MemoryBackend()
+    with open(filepath, 'rb') as file:
+        dgraph.create_graph(client, file, filepath, kmer_size=11)
+    assert dgraph.query_genomes_dgraph(client) == {genome}
+    dgraph.KMER_CACHE.clear()
+
+
+class LookupCountingBackend(backend.MemoryBackend):
+    """
+    A memory backend counting the kmers looked up, and failing if a kmer node is added twice.
+    """
+
+    def __init__(self):
+        super(LookupCountingBackend, self).__init__()
+        self.queried = 0
+
+    def query_kmers(self, kmer_array, kmer_size):
+        self.queried += len(kmer_array)
+        return super(LookupCountingBackend, self).query_kmers(kmer_array, kmer_size)
+
+    def add_kmers(self, kmer_array, kmer_size):
+        assert backend.MemoryBackend.query_kmers(self, kmer_array, kmer_size) is None
+        return super(LookupCountingBackend, self).add_kmers(kmer_array, kmer_size)
+
+
+def test_kmer_filter(tmp_path):
+    """
+    Kmers the kmer filter has never seen must be inserted without a lookup, while the
+    kmers already in the graph are still found, also after a save and load.
+    """
+    client = LookupCountingBackend()
+    dgraph.KMER_CACHE.clear()
+    dgraph.KMER_FILTER = bloom.BloomFilter(100000)
+    try:
+        genomes = list(benchmark.get_synthetic_genomes(3, 2000, similarity=0.95, contigs=2))
+        name, contigs = genomes[0]
+        benchmark.add_genome_synthetic(client, name, contigs, 11)
+        all_kmers = np.unique(np.concatenate([chunk for contig, chunk in benchmark.get_kmers_synthetic(contigs, 11)]))
+        lookups = client.queried
+        assert lookups < len(all_kmers) * 0.05
+
+        filename = str(tmp_path / "kmers.filter")
+        dgraph.KMER_FILTER.save(filename, "first")
+        dgraph.set_kmer_filter_stamp_dgraph(client, "first")
+        dgraph.KMER_FILTER = bloom.load_kmer_filter(filename, dgraph.query_kmer_filter_stamp_dgraph(client))
+        assert dgraph.KMER_FILTER.contains(all_kmers).all()
+        # A load since the filter was saved clears the stamp, and the filter is not loaded back
+        dgraph.set_kmer_filter_stamp_dgraph(client, None)
+        assert bloom.load_kmer_filter(filename, dgraph.query_kmer_filter_stamp_dgraph(client)) is None
+        dgraph.KMER_CACHE.clear()
+        for name, contigs in genomes[1:]:
+            benchmark.add_genome_synthetic(client, name, contigs, 11)
+        assert client.queried > lookups
+        for name, contigs in genomes:
+            assert list(dgraph.get_genome_sequence(client, name)) == [sequence for cid, sequence in contigs]
+
+        dgraph.drop_all(client)
+        assert not dgraph.KMER_FILTER.contains(all_kmers).any()
+    finally:
+        dgraph.KMER_FILTER = None
+        dgraph.KMER_CACHE.clear()
+
+
+def test_shared_repeat_paths():
+    """
+    Contigs sharing a repeat must each be walked from their own first kmer to their
+    last, and a contig that cannot be walked over its length must be reported.
+    """
+    name, contigs = next(benchmark.get_synthetic_genomes(1, 12000, contigs=3))
+    repeat = next(benchmark.get_synthetic_genomes(1, 300, seed=1))[1][0][1]
+    contigs = [(cid, sequence[:2000] + repeat + sequence[2000:]) if i < 2 else (cid, sequence)
+               for i, (cid, sequence) in enumerate(contigs)]
+    client = backend.MemoryBackend()
+    dgraph.KMER_CACHE.clear()
+    benchmark.add_genome_synthetic(client, name, contigs, 15)
+    assert list(dgraph.get_genome_sequence(client, name)) == [sequence for cid, sequence in contigs]
+
+    client._metadata[name]['contigs'][0]['contig_length'] += 1
+    with pytest.raises(dgraph.PathError):
+        list(dgraph.get_genome_sequence(client, name))
+    dgraph.KMER_CACHE.clear()
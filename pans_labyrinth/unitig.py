@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Compaction of kmer paths into unitigs, the maximal runs of kmers without a branch.
+A batch of genomes is compacted together: a unitig ends at a kmer with more than one
+edge out, before a kmer with more than one edge in, and at the start and end of every
+contig in the batch. Every genome in the batch then splits into the same unitigs
+wherever it shares sequence, and its path is stored over the unitigs rather than
+over every kmer. A genome added in a later batch would not split the unitigs already
+stored at its branches, so a load compacts all of its genomes in one batch.
+"""
+
+import numpy as np
+from pans_labyrinth import kmers
+
+
+def get_segments(all_kmers):
+	"""
+	Join the chunks of each unbroken run of kmers, as from dgraph.get_kmers_chunks()
+	:param all_kmers: iterable of (contig, packed kmers), chunks of one run sharing a kmer
+	:return: list of (contig, packed kmers) with one entry for each run
+	"""
+	segments = []
+	last = {}
+	for contig, kmer_array in all_kmers:
+		if len(kmer_array) == 0:
+			continue
+		if last.get(contig) == int(kmer_array[0]):
+			segments[-1][1].append(kmer_array[1:])
+		else:
+			segments.append((contig, [kmer_array]))
+		last[contig] = int(kmer_array[-1])
+	return [(contig, np.concatenate(chunks)) for contig, chunks in segments]
+
+
+# Number of bases set in a 4 bit mask of bases, and the base of a mask with one set
+BIT_COUNTS = np.array([bin(mask).count("1") for mask in range(16)], dtype=np.uint8)
+BIT_BASES = np.array([mask.bit_length() - 1 if mask else 0 for mask in range(16)], dtype=np.uint64)
+
+
+def get_unitig_ends(kmer_arrays, kmer_size):
+	"""
+	Mark the kmers a unitig ends at, over every run of kmers in a batch.
+	The edges of a kmer are counted from the bases that follow and precede it, as a
+	4 bit mask for each distinct kmer, so no table of edges is built.
+	:param kmer_arrays: list of numpy arrays of packed kmers, one for each run
+	:param kmer_size: Size of kmer
+	:return: list of numpy bool arrays, one for each run, True at each kmer that ends a unitig
+	"""
+	lengths = np.array([len(a) for a in kmer_arrays], dtype=np.int64)
+	if not lengths.sum():
+		return [np.zeros(n, dtype=bool) for n in lengths]
+
+	stops = np.cumsum(lengths)
+	starts = stops - lengths
+	filled = lengths > 0
+	all_kmers = np.concatenate(kmer_arrays).astype(np.uint64)
+	unique_kmers, index = np.unique(all_kmers, return_inverse=True)
+
+	# Every position but the last of its run has an edge to the next position
+	linked = np.ones(len(all_kmers), dtype=bool)
+	linked[stops[filled] - 1] = False
+	positions = np.flatnonzero(linked)
+	out_bases = np.zeros(len(unique_kmers), dtype=np.uint8)
+	in_bases = np.zeros(len(unique_kmers), dtype=np.uint8)
+	np.bitwise_or.at(out_bases, index[positions],
+					 np.left_shift(1, all_kmers[positions + 1] & np.uint64(3)).astype(np.uint8))
+	np.bitwise_or.at(in_bases, index[positions + 1],
+					 np.left_shift(1, all_kmers[positions] >> np.uint64(2 * (kmer_size - 1))).astype(np.uint8))
+	out_counts = BIT_COUNTS[out_bases]
+	in_counts = BIT_COUNTS[in_bases]
+
+	starts_contig = np.zeros(len(unique_kmers), dtype=bool)
+	starts_contig[index[starts[filled]]] = True
+	ends = out_counts > 1
+	ends[index[stops[filled] - 1]] = True
+
+	# A kmer with a single edge out still ends its unitig if the kmer after it
+	# is joined from elsewhere, or starts a contig
+	single = np.flatnonzero(out_counts == 1)
+	mask = np.uint64((1 << (2 * kmer_size)) - 1)
+	successors = ((unique_kmers[single] << np.uint64(2)) | BIT_BASES[out_bases[single]]) & mask
+	successors = np.searchsorted(unique_kmers, successors)
+	ends[single[(in_counts[successors] > 1) | starts_contig[successors]]] = True
+
+	return np.split(ends[index], stops[:-1])
+
+
+def get_unitigs(kmer_array, ends, kmer_size):
+	"""
+	Split a run of kmers after each kmer that ends a unitig
+	:param kmer_array: numpy array of packed kmers
+	:param ends: numpy bool array from get_unitig_ends() for the run
+	:param kmer_size: Size of kmer
+	:return: list of the unitig sequences in order
+	"""
+	cuts = np.flatnonzero(ends[:-1]) + 1
+	starts = [0] + cuts.tolist()
+	stops = cuts.tolist() + [len(kmer_array)]
+	# Spell the run once, and slice each unitig out of it
+	sequence = get_sequence(kmer_array, kmer_size)
+	return [sequence[start:stop + kmer_size - 1] for start, stop in zip(starts, stops)]
+
+
+def get_sequence(kmer_array, kmer_size):
+	"""
+	:param kmer_array: numpy array of a run of packed kmers
+	:param kmer_size: Size of kmer
+	:return: The sequence the kmers spell
+	"""
+	first = kmers.decode_kmers(kmer_array[:1], kmer_size)[0]
+	last_bases = kmers.CODE_BASES[kmer_array[1:] & np.uint64(3)]
+	return first + last_bases.tobytes().decode("ascii")
+
+
+def get_genomes_unitigs(genomes, kmer_size):
+	"""
+	Compact a batch of genomes together into unitigs.
+	:param genomes: dict{genome:[(contig, packed kmers)]} of chunks, as from
+	dgraph.get_kmers_chunks()
+	:param kmer_size: Size of kmer
+	:return: dict{genome:[(contig, [unitig sequences])]} with a path for each run of
+	kmers, and the sorted list of distinct unitig sequences in the batch
+	"""
+	segments = {genome: get_segments(all_kmers) for genome, all_kmers in genomes.items()}
+	ends = iter(get_unitig_ends([a for genome_segments in segments.values() for contig, a in genome_segments],
+								kmer_size))
+
+	paths = {}
+	sequences = set()
+	for genome, genome_segments in segments.items():
+		paths[genome] = []
+		for contig, kmer_array in genome_segments:
+			path = get_unitigs(kmer_array, next(ends), kmer_size)
+			sequences.update(path)
+			paths[genome].append((contig, path))
+	return paths, sorted(sequences)